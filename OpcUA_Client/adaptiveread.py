@@ -0,0 +1,267 @@
+import logging
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from opcua import ua
+import metrics
+
+# Read requests sized and pipelined at runtime, instead of a chunk size tuned by hand per server.
+# The chunk size (ReadValueIds per Read request) starts from the given value, never goes over the
+# MaxNodesPerRead operation limit of the server, and is adjusted AIMD style from what the server
+# answers, together with the number of Read requests in flight on the secure channel:
+#   - request answered within targetLatencyInSec: chunk size doubled until the first decrease or the
+#     size limit (slow start, as TCP), then one more request in flight up to maxRequestsInFlight,
+#     then chunk size + increaseStep
+#   - request slower than targetLatencyInSec: half the requests in flight, or half the chunk size
+#     when there is only one in flight
+#   - request rejected because of its size (BadTooManyOperations, BadResponseTooLarge...): chunk
+#     size halved and the rejected size is never tried again; the nodes are read again in smaller chunks
+#   - no answer in time (BadTimeout or the client timeout): chunk size and requests in flight halved
+#   - server too busy: requests in flight halved
+# Only the answers to requests sent with the current parameters change them (one change per round
+# trip), the answers to older requests do not count twice.
+# python-opcua matches the responses to the requests by request id, so several threads calling
+# uaclient.read pipeline their requests on the one session.
+# getTuning() gives the parameters found, to pin them (adaptive=False) on the next runs.
+
+DEFAULT_MAX_CHUNK_SIZE = 10000 # When the server does not report MaxNodesPerRead
+DEFAULT_MAX_REQUESTS_IN_FLIGHT = 8
+DEFAULT_TARGET_LATENCY_IN_SEC = 0.5
+DECREASE_FACTOR = 0.5
+
+OPERATION_LIMITS = ["MaxNodesPerRead", "MaxNodesPerWrite", "MaxNodesPerBrowse", "MaxNodesPerRegisterNodes",
+                    "MaxNodesPerTranslateBrowsePathsToNodeIds", "MaxNodesPerHistoryReadData", "MaxMonitoredItemsPerCall"]
+
+# Request too big for the server: retried in smaller chunks
+SIZE_STATUS_CODES = frozenset((ua.StatusCodes.BadTooManyOperations, ua.StatusCodes.BadResponseTooLarge, ua.StatusCodes.BadRequestTooLarge,
+                               ua.StatusCodes.BadEncodingLimitsExceeded))
+TIMEOUT_STATUS_CODES = frozenset((ua.StatusCodes.BadTimeout, ua.StatusCodes.BadRequestTimeout))
+BUSY_STATUS_CODES = frozenset((ua.StatusCodes.BadTcpServerTooBusy, ua.StatusCodes.BadResourceUnavailable))
+
+READ_LATENCY = metrics.histogram("opcua_read_request_seconds", "Round trip time of the Read requests")
+READ_REQUESTS = metrics.counter("opcua_read_requests_total", "Read requests sent")
+READ_REQUEST_FAILURES = metrics.counter("opcua_read_request_failures_total", "Read requests rejected as a whole")
+VALUES_READ = metrics.counter("opcua_values_read_total", "Attribute values read")
+READ_CHUNK_SIZE = metrics.gauge("opcua_read_chunk_size", "ReadValueIds per Read request chosen by the read tuner")
+READ_REQUESTS_IN_FLIGHT = metrics.gauge("opcua_read_requests_in_flight", "Read requests in flight chosen by the read tuner")
+
+logger = logging.getLogger(__name__)
+
+def readOperationLimits(session):
+    """
+    OperationLimits of the server (name -> value), read in one Read request.
+    A limit the server does not expose, or reports as 0 (no limit), is None.
+    """
+    params = ua.ReadParameters()
+    for name in OPERATION_LIMITS:
+        readValueId = ua.ReadValueId()
+        readValueId.NodeId = ua.NodeId(getattr(ua.ObjectIds, "Server_ServerCapabilities_OperationLimits_" + name))
+        readValueId.AttributeId = ua.AttributeIds.Value
+        params.NodesToRead.append(readValueId)
+    limits = dict((name, None) for name in OPERATION_LIMITS)
+    try:
+        dataValues = session.uaclient.read(params)
+    except Exception as e:
+        logger.warning("OperationLimits not read: %s", e)
+        return limits
+    for name, dataValue in zip(OPERATION_LIMITS, dataValues):
+        if dataValue.StatusCode.is_good() and dataValue.Value is not None and dataValue.Value.Value:
+            limits[name] = int(dataValue.Value.Value)
+    return limits
+
+class ReadTuner(object):
+    """
+    Chunk size and Read requests in flight, adjusted from the answers of the server (see above).
+    With adaptive=False they stay at chunkSize (capped by maxChunkSize) and requestsInFlight.
+    """
+    def __init__(self, chunkSize, requestsInFlight=1, maxChunkSize=DEFAULT_MAX_CHUNK_SIZE, maxRequestsInFlight=DEFAULT_MAX_REQUESTS_IN_FLIGHT,
+                 adaptive=True, targetLatencyInSec=DEFAULT_TARGET_LATENCY_IN_SEC, increaseStep=None):
+        self.adaptive = adaptive
+        self.maxChunkSize = max(1, maxChunkSize)
+        self.chunkSize = max(1, min(chunkSize, self.maxChunkSize))
+        self.maxRequestsInFlight = max(1, maxRequestsInFlight if adaptive else requestsInFlight)
+        self.requestsInFlight = max(1, min(requestsInFlight, self.maxRequestsInFlight))
+        self.targetLatencyInSec = targetLatencyInSec
+        self.increaseStep = increaseStep if increaseStep else max(1, self.chunkSize // 4)
+        self.ceiling = self.maxChunkSize # largest chunk size not rejected by the server
+        self.slowStart = True
+        self.generation = 0 # changes with the parameters, requests older than it do not change them again
+        self.lock = threading.Lock()
+
+        self.increases = 0
+        self.decreases = 0
+        self.rejections = 0
+        self.timeouts = 0
+        self.slowResponses = 0
+        self.publish()
+
+    def publish(self):
+        READ_CHUNK_SIZE.set(self.chunkSize)
+        READ_REQUESTS_IN_FLIGHT.set(self.requestsInFlight)
+
+    def changed(self, reason):
+        self.generation += 1
+        self.publish()
+        logger.info("Read tuning %s: chunkSize %d, requestsInFlight %d", reason, self.chunkSize, self.requestsInFlight)
+
+    def onAnswer(self, size, latencyInSec, generation):
+        """ size ReadValueIds read in latencyInSec by a request sent with the parameters of generation. """
+        if not self.adaptive:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            if latencyInSec > self.targetLatencyInSec:
+                self.slowResponses += 1
+                self.decreases += 1
+                self.slowStart = False
+                if self.requestsInFlight > 1:
+                    self.requestsInFlight = max(1, int(self.requestsInFlight * DECREASE_FACTOR))
+                else:
+                    self.chunkSize = max(1, int(self.chunkSize * DECREASE_FACTOR))
+                self.changed("slow response (" + str(round(latencyInSec, 3)) + " sec)")
+            elif size >= self.chunkSize: # a short chunk (end of the list) says nothing about the chunk size
+                if self.slowStart and self.chunkSize < self.ceiling:
+                    self.chunkSize = min(self.ceiling, self.chunkSize * 2)
+                elif self.requestsInFlight < self.maxRequestsInFlight:
+                    self.requestsInFlight += 1
+                elif self.chunkSize < self.ceiling:
+                    self.chunkSize = min(self.ceiling, self.chunkSize + self.increaseStep)
+                else:
+                    return
+                self.increases += 1
+                self.changed("increase")
+
+    def onRejected(self, size, error, generation):
+        """
+        A request of size ReadValueIds failed with error.
+        Returns True when the request can be sent again (in smaller chunks), False when its nodes have to be read one by one.
+        """
+        code = error.code if isinstance(error, ua.UaStatusCodeError) else None
+        isTimeout = code in TIMEOUT_STATUS_CODES or isinstance(error, FutureTimeoutError)
+        if code not in SIZE_STATUS_CODES and code not in BUSY_STATUS_CODES and not isTimeout:
+            return False
+        if not self.adaptive:
+            return code in SIZE_STATUS_CODES
+        with self.lock:
+            if code in SIZE_STATUS_CODES:
+                self.rejections += 1
+                self.ceiling = max(1, min(self.ceiling, size - 1))
+            elif isTimeout:
+                self.timeouts += 1
+            if generation != self.generation:
+                return True
+            self.decreases += 1
+            self.slowStart = False
+            if code in SIZE_STATUS_CODES or isTimeout:
+                self.chunkSize = max(1, min(self.ceiling, int(self.chunkSize * DECREASE_FACTOR)))
+            if code in BUSY_STATUS_CODES or isTimeout:
+                self.requestsInFlight = max(1, int(self.requestsInFlight * DECREASE_FACTOR))
+            self.changed("after " + (ua.StatusCode(code).name if code is not None else "timeout"))
+        return True
+
+    def getTuning(self):
+        d = dict()
+        d['chunkSize'] = self.chunkSize
+        d['requestsInFlight'] = self.requestsInFlight
+        d['maxChunkSize'] = self.maxChunkSize # server's MaxNodesPerRead or DEFAULT_MAX_CHUNK_SIZE
+        d['ceiling'] = self.ceiling
+        d['adaptive'] = self.adaptive
+        d['increases'] = self.increases
+        d['decreases'] = self.decreases
+        d['rejections'] = self.rejections
+        d['timeouts'] = self.timeouts
+        d['slowResponses'] = self.slowResponses
+        return d
+
+class PipelinedReader(object):
+    """
+    Read attributes of many nodes with multi-node Read requests, sized and kept in flight as the tuner says.
+    readOne(readValueId) reads one attribute on its own and returns its DataValue, bad DataValue on error:
+    used for the nodes of a request rejected for another reason than its size.
+    """
+    def __init__(self, session, tuner, readOne):
+        self.session = session
+        self.tuner = tuner
+        self.readOne = readOne
+        self.pool = None
+        self.poolLock = threading.Lock()
+
+    def read(self, nodes, attributeIds=(ua.AttributeIds.Value,), chunkSize=None):
+        """
+        One list of DataValues (one per attributeId) for each node, in the same order as nodes.
+        chunkSize (optional) replaces the chunk size of a tuner which is not adaptive for this call, capped by its maxChunkSize.
+        """
+        fixedChunkSize = None
+        if chunkSize and not self.tuner.adaptive:
+            fixedChunkSize = max(1, min(chunkSize, self.tuner.maxChunkSize))
+        with self.poolLock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.tuner.maxRequestsInFlight, thread_name_prefix="Read")
+            pool = self.pool
+        valuesPerNode = len(attributeIds)
+        results = [None] * len(nodes)
+        retries = deque() # (start, end) of the nodes of rejected requests, sent again before the next ones
+        running = dict()  # future -> (start, end)
+        position = 0
+        while position < len(nodes) or retries or running:
+            chunkSize = self.tuner.chunkSize if fixedChunkSize is None else fixedChunkSize
+            while len(running) < self.tuner.requestsInFlight and (retries or position < len(nodes)):
+                if retries:
+                    start, end = retries.popleft()
+                else:
+                    start = position
+                    end = position = min(len(nodes), start + max(1, chunkSize // valuesPerNode))
+                running[pool.submit(self.readRange, nodes[start:end], attributeIds, self.tuner.generation)] = (start, end)
+
+            done, notDone = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                start, end = running.pop(future)
+                dataValues, retry = future.result()
+                if dataValues is None and retry and end - start > 1:
+                    # Smaller than the rejected request whatever the chunk size, so it ends
+                    size = min(max(1, chunkSize // valuesPerNode), (end - start + 1) // 2)
+                    retries.extendleft(reversed([(i, min(end, i + size)) for i in range(start, end, size)]))
+                    continue
+                if dataValues is None:
+                    dataValues = [self.readOne(self.getReadValueId(node, attributeId)) for node in nodes[start:end] for attributeId in attributeIds]
+                VALUES_READ.inc(len(dataValues))
+                for i in range(start, end):
+                    first = (i - start) * valuesPerNode
+                    results[i] = dataValues[first:first + valuesPerNode]
+        return results
+
+    def getReadValueId(self, node, attributeId):
+        readValueId = ua.ReadValueId()
+        readValueId.NodeId = node.nodeid
+        readValueId.AttributeId = attributeId
+        return readValueId
+
+    def readRange(self, nodes, attributeIds, generation):
+        """ One Read request. Returns (dataValues, None) or (None, whether the nodes can be sent again in smaller requests). """
+        params = ua.ReadParameters()
+        params.TimestampsToReturn = ua.TimestampsToReturn.Both
+        for node in nodes:
+            for attributeId in attributeIds:
+                params.NodesToRead.append(self.getReadValueId(node, attributeId))
+
+        startTime = time.perf_counter()
+        try:
+            dataValues = self.session.uaclient.read(params)
+        except Exception as e:
+            READ_REQUEST_FAILURES.inc()
+            return None, self.tuner.onRejected(len(params.NodesToRead), e, generation)
+        latencyInSec = time.perf_counter() - startTime
+        READ_LATENCY.observe(latencyInSec)
+        READ_REQUESTS.inc()
+        self.tuner.onAnswer(len(params.NodesToRead), latencyInSec, generation)
+        return dataValues, None
+
+    def close(self):
+        with self.poolLock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown()
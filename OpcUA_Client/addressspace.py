@@ -0,0 +1,361 @@
+import sys
+import hashlib
+import logging
+import sqlite3
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from opcua import ua
+from opcua.common.node import Node
+
+# Address space index: the server is crawled from the Objects folder following the
+# hierarchical references, and NodeId -> browse path, data type and access level of every
+# Object/Variable is saved in a SQLite file. Tag lists can then be validated and resolved
+# against this file without connecting to the server.
+#
+# Browse requests carry many nodes each (MaxNodesPerBrowse), their continuation points are
+# followed with BrowseNext, and a bounded number of requests is in flight at a time.
+#
+# Incremental crawl: the hash of the children of every browsed node (and of its browse path,
+# so that renaming or moving an ancestor refreshes the browse paths stored below it) is kept
+# in the index. When they did not change since the last crawl, its Variable children
+# (and their properties) are not browsed nor read again, only the Objects below it are
+# browsed to look for changes further down. Use the "full" option to crawl everything.
+#
+# Commands:
+#     addressspace.py crawl [OpcUaUrl] [IndexFile] [Workers] [full]
+#     addressspace.py validate [IndexFile] [Inputfile] [ResolvedTaglistFile]
+
+DEFAULT_WORKERS = 4 # Browse/Read requests in flight at the same time
+DEFAULT_BROWSE_BATCH_SIZE = 500 # Nodes per Browse request when the server does not report MaxNodesPerBrowse
+DEFAULT_READ_CHUNK_SIZE = 1000
+BROWSED_NODE_CLASSES = ua.NodeClass.Object | ua.NodeClass.Variable
+
+logger = logging.getLogger(__name__)
+
+class AddressSpaceIndex(object):
+    """ SQLite file with one row per node. A crawl is one transaction, an interrupted crawl leaves the previous index. """
+    def __init__(self, fileName):
+        self.connection = sqlite3.connect(fileName, check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS nodes (
+                                       nodeId TEXT PRIMARY KEY, parentNodeId TEXT, browseName TEXT, browsePath TEXT,
+                                       nodeClass INTEGER, dataType TEXT, accessLevel INTEGER, childrenHash TEXT, crawlId INTEGER)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS nodesByParent ON nodes (parentNodeId)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS nodesByBrowsePath ON nodes (browsePath)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS nodesByBrowseName ON nodes (browseName)")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS crawls (
+                                       crawlId INTEGER PRIMARY KEY, url TEXT, startTime REAL, durationInSec REAL,
+                                       nodes INTEGER, browseRequests INTEGER, readRequests INTEGER, skippedSubtrees INTEGER)""")
+        self.connection.commit()
+
+    def newCrawlId(self):
+        row = self.connection.execute("SELECT MAX(crawlId) FROM crawls").fetchone()
+        return (row[0] or 0) + 1
+
+    def getChildrenHash(self, nodeId):
+        row = self.connection.execute("SELECT childrenHash FROM nodes WHERE nodeId = ?", (nodeId,)).fetchone()
+        return row[0] if row else None
+
+    def setChildrenHash(self, nodeId, childrenHash):
+        self.connection.execute("UPDATE nodes SET childrenHash = ? WHERE nodeId = ?", (childrenHash, nodeId))
+
+    def putNodes(self, rows, crawlId):
+        """ rows: (nodeId, parentNodeId, browseName, browsePath, nodeClass). The attributes already read are kept. """
+        self.connection.executemany("""INSERT INTO nodes (nodeId, parentNodeId, browseName, browsePath, nodeClass, crawlId) VALUES (?, ?, ?, ?, ?, ?)
+                                       ON CONFLICT(nodeId) DO UPDATE SET parentNodeId = excluded.parentNodeId, browseName = excluded.browseName,
+                                       browsePath = excluded.browsePath, nodeClass = excluded.nodeClass, crawlId = excluded.crawlId""",
+                                    [row + (crawlId,) for row in rows])
+
+    def putAttributes(self, rows):
+        """ rows: (dataType, accessLevel, nodeId) """
+        self.connection.executemany("UPDATE nodes SET dataType = ?, accessLevel = ? WHERE nodeId = ?", rows)
+
+    def touchSubtrees(self, nodeIds, crawlId):
+        """ Mark the nodes and all their descendants as seen by this crawl without browsing them. """
+        for nodeId in nodeIds:
+            self.connection.execute("""WITH RECURSIVE subtree(nodeId) AS (
+                                           SELECT ? UNION SELECT nodes.nodeId FROM nodes JOIN subtree ON nodes.parentNodeId = subtree.nodeId)
+                                       UPDATE nodes SET crawlId = ? WHERE nodeId IN subtree""", (nodeId, crawlId))
+
+    def endCrawl(self, crawlId, url, statistics):
+        """ Remove the nodes not seen by this crawl (deleted from the server) and commit. """
+        self.connection.execute("DELETE FROM nodes WHERE crawlId <> ?", (crawlId,))
+        self.connection.execute("INSERT INTO crawls VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (crawlId, url, statistics['startTime'], statistics['durationInSec'], statistics['nodes'],
+                                 statistics['browseRequests'], statistics['readRequests'], statistics['skippedSubtrees']))
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def getNode(self, nodeId):
+        """ (nodeId, browsePath, nodeClass, dataType, accessLevel) or None """
+        return self.connection.execute("SELECT nodeId, browsePath, nodeClass, dataType, accessLevel FROM nodes WHERE nodeId = ?", (nodeId,)).fetchone()
+
+    def findNodes(self, browsePathOrName):
+        """ Nodes with this browse path, else the nodes with this browse name. """
+        rows = self.connection.execute("SELECT nodeId, browsePath, nodeClass, dataType, accessLevel FROM nodes WHERE browsePath = ?", (browsePathOrName,)).fetchall()
+        if not rows:
+            rows = self.connection.execute("SELECT nodeId, browsePath, nodeClass, dataType, accessLevel FROM nodes WHERE browseName = ?", (browsePathOrName,)).fetchall()
+        return rows
+
+    def close(self):
+        self.connection.close()
+
+def childrenHash(references, browsePath=""):
+    h = hashlib.sha1(browsePath.encode("utf-8"))
+    for reference in sorted(ref.NodeId.to_string() + "|" + ref.BrowseName.to_string() + "|" + str(ref.NodeClass.value) for ref in references):
+        h.update(reference.encode("utf-8"))
+    return h.hexdigest()
+
+def dataTypeName(dataTypeNodeId):
+    if dataTypeNodeId.NamespaceIndex == 0 and dataTypeNodeId.Identifier in ua.ObjectIdNames:
+        return ua.ObjectIdNames[dataTypeNodeId.Identifier]
+    return dataTypeNodeId.to_string()
+
+class AddressSpaceCrawler(object):
+    """
+    Crawl the address space of the opcUaClient session into an AddressSpaceIndex.
+    Browse and Read requests are sent by a pool of worker threads sharing the session,
+    the index is only written by the thread calling crawl.
+    """
+    def __init__(self, opcua_client, index, workers=DEFAULT_WORKERS, fullCrawl=False):
+        self.opcua_client = opcua_client
+        self.session = opcua_client.session
+        self.index = index
+        self.workers = workers
+        self.fullCrawl = fullCrawl
+        self.browseBatchSize = self.getMaxNodesPerBrowse(DEFAULT_BROWSE_BATCH_SIZE)
+        self.readChunkSize = opcua_client.getMaxNodesPerRead(DEFAULT_READ_CHUNK_SIZE)
+        if opcua_client.reader is None:
+            opcua_client.configureReads(self.readChunkSize, adaptive=False) # before the workers read in parallel
+        self.statistics = {"nodes": 0, "variables": 0, "browseRequests": 0, "browseNextRequests": 0, "readRequests": 0,
+                           "browseErrors": 0, "skippedSubtrees": 0}
+
+    def getMaxNodesPerBrowse(self, defaultValue):
+        try:
+            maxNodesPerBrowse = self.session.get_node(ua.ObjectIds.Server_ServerCapabilities_OperationLimits_MaxNodesPerBrowse).get_value()
+        except Exception:
+            return defaultValue
+        if not maxNodesPerBrowse:
+            return defaultValue
+        return min(int(maxNodesPerBrowse), defaultValue)
+
+    def browseNodes(self, nodeIds):
+        """
+        Worker: forward hierarchical references of every node (one Browse request, then BrowseNext while needed).
+        Returns the list of references of every node and the number of BrowseNext requests and bad results.
+        """
+        params = ua.BrowseParameters()
+        for nodeId in nodeIds:
+            description = ua.BrowseDescription()
+            description.NodeId = nodeId
+            description.BrowseDirection = ua.BrowseDirection.Forward
+            description.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HierarchicalReferences)
+            description.IncludeSubtypes = True
+            description.NodeClassMask = BROWSED_NODE_CLASSES
+            description.ResultMask = ua.BrowseResultMask.TargetInfo
+            params.NodesToBrowse.append(description)
+        results = self.session.uaclient.browse(params)
+
+        references = []
+        continuationPoints = []
+        browseNextRequests = 0
+        browseErrors = 0
+        for i, result in enumerate(results):
+            if not result.StatusCode.is_good():
+                browseErrors += 1
+            references.append(list(result.References))
+            if result.ContinuationPoint:
+                continuationPoints.append((i, result.ContinuationPoint))
+
+        while continuationPoints:
+            nextParams = ua.BrowseNextParameters()
+            nextParams.ReleaseContinuationPoints = False
+            nextParams.ContinuationPoints = [continuationPoint for i, continuationPoint in continuationPoints]
+            nextResults = self.session.uaclient.browse_next(nextParams)
+            browseNextRequests += 1
+            nextContinuationPoints = []
+            for (i, continuationPoint), result in zip(continuationPoints, nextResults):
+                references[i].extend(result.References)
+                if result.ContinuationPoint:
+                    nextContinuationPoints.append((i, result.ContinuationPoint))
+            continuationPoints = nextContinuationPoints
+        return references, browseNextRequests, browseErrors
+
+    def readAttributes(self, nodeIds):
+        """ Worker: DataType and AccessLevel of the variables. """
+        nodes = [Node(self.session.uaclient, nodeId) for nodeId in nodeIds]
+        dataValues = self.opcua_client.readDataValuesInChunks(nodes, self.readChunkSize, (ua.AttributeIds.DataType, ua.AttributeIds.AccessLevel))
+        rows = []
+        for nodeId, (dataType, accessLevel) in zip(nodeIds, dataValues):
+            rows.append((dataTypeName(dataType.Value.Value) if dataType.StatusCode.is_good() else None,
+                         accessLevel.Value.Value if accessLevel.StatusCode.is_good() else None,
+                         nodeId.to_string()))
+        return rows
+
+    def crawl(self, url, rootNodeId=ua.ObjectIds.ObjectsFolder):
+        startTime = time.time()
+        crawlId = self.index.newCrawlId()
+        rootNodeId = ua.NodeId(rootNodeId)
+        rootBrowseName = self.session.get_node(rootNodeId).get_browse_name()
+        self.index.putNodes([(rootNodeId.to_string(), None, rootBrowseName.Name, rootBrowseName.to_string(), ua.NodeClass.Object.value)], crawlId)
+
+        frontier = deque([(rootNodeId, rootBrowseName.to_string())]) # nodes to browse: (NodeId, browse path)
+        attributesToRead = []
+        visited = set([rootNodeId.to_string()])
+        pending = dict() # future -> (kind, nodes)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                while frontier or attributesToRead or pending:
+                    while len(pending) < self.workers and (frontier or attributesToRead):
+                        if len(attributesToRead) >= self.readChunkSize or (attributesToRead and not frontier):
+                            chunk, attributesToRead = attributesToRead[:self.readChunkSize], attributesToRead[self.readChunkSize:]
+                            pending[pool.submit(self.readAttributes, chunk)] = ("read", chunk)
+                        else:
+                            chunk = [frontier.popleft() for i in range(min(self.browseBatchSize, len(frontier)))]
+                            pending[pool.submit(self.browseNodes, [nodeId for nodeId, browsePath in chunk])] = ("browse", chunk)
+
+                    done, notDone = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        kind, chunk = pending.pop(future)
+                        if kind == "read":
+                            self.index.putAttributes(future.result())
+                            self.statistics['readRequests'] += 1
+                        else:
+                            allReferences, browseNextRequests, browseErrors = future.result()
+                            self.statistics['browseRequests'] += 1
+                            self.statistics['browseNextRequests'] += browseNextRequests
+                            self.statistics['browseErrors'] += browseErrors
+                            for (nodeId, browsePath), references in zip(chunk, allReferences):
+                                attributesToRead.extend(self.addChildren(nodeId, browsePath, references, frontier, visited, crawlId))
+
+            self.statistics['startTime'] = startTime
+            self.statistics['durationInSec'] = round(time.time() - startTime, 3)
+            self.index.endCrawl(crawlId, url, self.statistics)
+        except BaseException:
+            self.index.rollback()
+            raise
+        return self.statistics
+
+    def addChildren(self, parentNodeId, parentBrowsePath, references, frontier, visited, crawlId):
+        """ Store the children of a browsed node, queue the ones to browse. Returns the variables whose attributes have to be read. """
+        parent = parentNodeId.to_string()
+        newHash = childrenHash(references, parentBrowsePath)
+        unchanged = not self.fullCrawl and self.index.getChildrenHash(parent) == newHash
+        self.index.setChildrenHash(parent, newHash)
+
+        rows = []
+        skippedVariables = []
+        variablesToRead = []
+        for reference in references:
+            if reference.NodeId.ServerIndex: # node of another server
+                continue
+            nodeId = ua.NodeId(reference.NodeId.Identifier, reference.NodeId.NamespaceIndex, reference.NodeId.NodeIdType)
+            key = nodeId.to_string()
+            if key in visited:
+                continue
+            visited.add(key)
+            self.statistics['nodes'] += 1
+            browsePath = parentBrowsePath + "/" + reference.BrowseName.to_string()
+            if reference.NodeClass == ua.NodeClass.Variable:
+                self.statistics['variables'] += 1
+                if unchanged:
+                    skippedVariables.append(key)
+                    continue
+                variablesToRead.append(nodeId)
+            rows.append((key, parent, reference.BrowseName.Name, browsePath, reference.NodeClass.value))
+            frontier.append((nodeId, browsePath))
+
+        self.index.putNodes(rows, crawlId)
+        if skippedVariables:
+            self.statistics['skippedSubtrees'] += len(skippedVariables)
+            self.index.touchSubtrees(skippedVariables, crawlId)
+        return variablesToRead
+
+def isReadable(accessLevel):
+    return accessLevel is not None and accessLevel & (1 << ua.AccessLevel.CurrentRead.value) != 0
+
+def validateTagList(index, tagList):
+    """
+    Check every tag of the tag list against the index, without the server.
+    A tag can be a NodeId, a browse path ("0:Objects/2:Folder/2:Tag") or a unique browse name.
+    Yields (tag, status, nodeId, detail) with status OK, RESOLVED, UNKNOWN, AMBIGUOUS, NOT_VARIABLE or NOT_READABLE.
+    """
+    for x in tagList:
+        tag = x.strip()
+        if not tag:
+            continue
+        row = None
+        status = "OK"
+        try:
+            row = index.getNode(ua.NodeId.from_string(tag).to_string())
+        except Exception:
+            pass # not a NodeId
+        if row is None:
+            rows = index.findNodes(tag)
+            if len(rows) == 1:
+                row, status = rows[0], "RESOLVED"
+            elif len(rows) > 1:
+                yield tag, "AMBIGUOUS", None, str(len(rows)) + " nodes with this browse name: " + ", ".join(r[0] for r in rows[:5])
+                continue
+            else:
+                yield tag, "UNKNOWN", None, "not found in the address space index"
+                continue
+
+        nodeId, browsePath, nodeClass, dataType, accessLevel = row
+        if nodeClass != ua.NodeClass.Variable.value:
+            yield tag, "NOT_VARIABLE", nodeId, browsePath
+        elif accessLevel is not None and not isReadable(accessLevel):
+            yield tag, "NOT_READABLE", nodeId, browsePath
+        else:
+            yield tag, status, nodeId, browsePath + " (" + str(dataType) + ")"
+
+def crawlServer(url, indexFile, workers, fullCrawl):
+    from gettags_improvement import opcUaClient
+
+    opcua_client = opcUaClient(url)
+    index = AddressSpaceIndex(indexFile)
+    try:
+        crawler = AddressSpaceCrawler(opcua_client, index, workers, fullCrawl)
+        statistics = crawler.crawl(url)
+        print("Crawl", statistics)
+    finally:
+        index.close()
+        opcua_client.disconnect()
+
+def validateTagListFile(indexFile, tagListFile, resolvedTagListFile=None):
+    """ Print the tags which are not OK. The OK and resolved tags are written as NodeIds to resolvedTagListFile. """
+    index = AddressSpaceIndex(indexFile)
+    counts = dict()
+    resolved = open(resolvedTagListFile, "w") if resolvedTagListFile else None
+    try:
+        with open(tagListFile, "r") as tagList:
+            for tag, status, nodeId, detail in validateTagList(index, tagList):
+                counts[status] = counts.get(status, 0) + 1
+                if status != "OK":
+                    print(tag, ",\t", status, ",\t", nodeId or "", ",\t", detail)
+                if resolved is not None and status in ("OK", "RESOLVED"):
+                    resolved.write(nodeId + "\n")
+    finally:
+        index.close()
+        if resolved is not None:
+            resolved.close()
+    print("Validation", counts)
+    return counts
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.ERROR)
+
+    if len(sys.argv) >= 4 and sys.argv[1] == "crawl":
+        workers = int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_WORKERS
+        crawlServer(sys.argv[2], sys.argv[3], workers, len(sys.argv) > 5 and sys.argv[5] == "full")
+    elif len(sys.argv) >= 4 and sys.argv[1] == "validate":
+        validateTagListFile(sys.argv[2], sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else None)
+    else:
+        print("Syntax: " , sys.argv[0], "crawl", "[OpcUaUrl]", "[IndexFile]", "[Workers]", "[full]")
+        print("        " , sys.argv[0], "validate", "[IndexFile]", "[Inputfile]", "[ResolvedTaglistFile]")
+        sys.exit(-1)
@@ -0,0 +1,855 @@
+import argparse
+import csv
+import gc
+import io
+import logging
+import sys
+import time
+
+from array import array
+from collections import namedtuple
+from datetime import datetime
+
+try:
+    import numpy
+except ImportError:
+    raise ImportError("aggregate.py needs numpy: pip install numpy")
+
+import metrics
+from opcua import ua
+from resultwriters import BinaryResultWriter, CsvResultWriter, toMicroseconds
+from tagencoder import SEVERITY_BAD, SEVERITY_MASK
+
+# Per tag aggregates of the result files of the collector, in time windows (1 min, 1 h...):
+#   samples, good samples, min, max, mean, time weighted average and last value of every tag in every window.
+# Usage: python aggregate.py resultFile [resultFile...] [--output summary] [--windows 60,3600] [--follow]
+#   The result files (text, csv, binary or parquet, recognised by their header) are read in chunks of
+#   --chunk-samples samples turned into NumPy columns, the aggregates of a chunk are computed with sorts and
+#   ufunc.reduceat and merged into the windows still open. A window is written to the summary file once the
+#   newest timestamp read is --lateness sec past its end, so the memory holds one chunk and the open windows
+#   whatever the size of the files. --follow keeps reading the last file while the collector writes it.
+#   Only the samples with a quality accepted by --quality (good, or good and uncertain) and a numeric value
+#   (booleans as 0/1) go into min/max/mean/last and the time weighted average, the other ones are only counted.
+# Time weighted average: every value is held until the next sample of its tag, a bad sample stops it. Windows
+# without samples are not written, the value held through them counts in the next window from its start.
+# A sample older than the previous sample of its tag (file not in time order, as a history backfill run with
+# parallel windows) is counted in its window but not in the time weighted average; a sample of a window
+# already written is only counted in lateSamples.
+
+DEFAULT_WINDOWS_IN_SEC = (60, 3600)
+DEFAULT_CHUNK_SAMPLES = 500000
+DEFAULT_ALLOWED_LATENESS_IN_SEC = 60
+SUMMARY_FILE_EXTENSIONS = {"csv": ".csv", "parquet": ".parquet"}
+SUMMARY_COLUMNS = ["tagid", "windowStart", "samples", "goodSamples", "min", "max", "mean", "timeWeightedAverage", "last", "lastTimestamp"]
+
+NO_TIMESTAMP = BinaryResultWriter.NO_TIMESTAMP
+MAX_TIMESTAMP = numpy.iinfo(numpy.int64).max
+WINDOW_BITS = 34 # key of a window: tagIndex << WINDOW_BITS | window index (1 sec windows until the year 2514)
+WINDOW_MASK = (1 << WINDOW_BITS) - 1
+
+# Sample of the binary result file with an 8 bytes value (VALUE_INT, VALUE_UINT or VALUE_DOUBLE, kinds 2 to 4)
+WIDE_SAMPLE = numpy.dtype([("kind", "u1"), ("tagIndex", "<u4"), ("statusCode", "<u4"), ("timestamp", "<i8"), ("variantType", "u1"), ("value", "<u8")])
+LINE_BLOCK_BYTES = 4 * 1024 * 1024 # text of the csv and text result files decoded at a time
+MIN_RUN_PROBE = 64 # samples checked for the length of a run of them, doubled up to MAX_RUN_PROBE while the runs go on
+MAX_RUN_PROBE = 65536
+
+# Variant types with a numeric value, the others (strings, arrays, Null...) are only counted
+BOOLEAN_TYPE = ua.VariantType.Boolean.value
+NUMERIC_TYPES = sorted(BinaryResultWriter.VALUE_KINDS)
+STATUS_CODES_BY_TEXT = dict((str(ua.StatusCode(code)), code) for code in ua.status_codes.code_to_name_doc)
+VARIANT_TYPES_BY_NAME = dict((str(variantType), variantType.value) for variantType in ua.VariantType)
+
+SAMPLES_AGGREGATED = metrics.counter("samples_aggregated_total", "Samples of result files aggregated")
+
+logger = logging.getLogger(__name__)
+
+SampleChunk = namedtuple("SampleChunk", ["tagIndexes", "timestamps", "statusCodes", "values"])
+SampleChunk.__doc__ = """
+Columns of a chunk of samples: tagIndexes (int64, see TagTable), timestamps (int64, microseconds since 1970-01-01,
+NO_TIMESTAMP if missing), statusCodes (uint32) and values (float64, NaN if not numeric).
+"""
+
+class TagTable(object):
+    """ tagid <-> dense index, shared by every file of one aggregation. """
+    def __init__(self):
+        self.tagids = []
+        self.indexes = dict()
+
+    def __len__(self):
+        return len(self.tagids)
+
+    def indexOf(self, tagid):
+        index = self.indexes.get(tagid)
+        if index is None:
+            index = len(self.tagids)
+            self.indexes[tagid] = index
+            self.tagids.append(tagid)
+        return index
+
+    def indexesOf(self, tagids):
+        """ Indexes of a sequence of tagids as an array. """
+        get = self.indexes.get
+        indexes = numpy.array([get(tagid, -1) for tagid in tagids], dtype=numpy.int64)
+        for i in numpy.flatnonzero(indexes < 0).tolist():
+            indexes[i] = self.indexOf(tagids[i])
+        return indexes
+
+def parseNumbers(texts):
+    """ float64 array of a sequence of texts, NaN for the ones which are not numbers. """
+    try:
+        return numpy.array(texts, dtype=numpy.float64)
+    except ValueError:
+        numbers = numpy.full(len(texts), numpy.nan)
+        for i, text in enumerate(texts):
+            try:
+                numbers[i] = float(text)
+            except ValueError:
+                pass
+        return numbers
+
+def parseTimestamps(texts):
+    """ Microseconds since 1970-01-01 of an array of ISO 8601 texts ("...Z"), NO_TIMESTAMP for the empty ones. """
+    texts = numpy.char.rstrip(texts, "Z")
+    try:
+        return texts.astype("datetime64[us]").view(numpy.int64) # NaT is NO_TIMESTAMP
+    except ValueError:
+        # Timestamps with an UTC offset
+        timestamps = numpy.full(len(texts), NO_TIMESTAMP, dtype=numpy.int64)
+        for i, text in enumerate(texts.tolist()):
+            try:
+                timestamps[i] = toMicroseconds(datetime.fromisoformat(text))
+            except ValueError:
+                pass
+        return timestamps
+
+def chunkFromTexts(tags, tagids, valueTexts, variantTypes, statusCodes, timestampTexts):
+    """ SampleChunk of the text columns (sequences of texts) of the csv and text result files. """
+    variantTypes = numpy.array(variantTypes, dtype=numpy.int64)
+    numeric = numpy.isin(variantTypes, NUMERIC_TYPES) & (variantTypes != BOOLEAN_TYPE)
+    if numeric.all():
+        values = parseNumbers(valueTexts)
+    else:
+        values = numpy.full(len(variantTypes), numpy.nan)
+        numericIndexes = numpy.flatnonzero(numeric)
+        values[numericIndexes] = parseNumbers([valueTexts[i] for i in numericIndexes.tolist()])
+        booleanIndexes = numpy.flatnonzero(variantTypes == BOOLEAN_TYPE)
+        values[booleanIndexes] = [valueTexts[i] == "True" for i in booleanIndexes.tolist()]
+    statusCodes = numpy.array(statusCodes, dtype=numpy.int64).astype(numpy.uint32)
+    return SampleChunk(tags.indexesOf(tagids), parseTimestamps(numpy.array(timestampTexts)), statusCodes, values)
+
+def arraysChunk(tagIndexes, timestamps, statusCodes, values):
+    """ SampleChunk of the typed arrays (array module) of a decoder. """
+    return SampleChunk(numpy.frombuffer(tagIndexes, dtype=numpy.int64), numpy.frombuffer(timestamps, dtype=numpy.int64),
+                       numpy.frombuffer(statusCodes, dtype=numpy.uint32), numpy.frombuffer(values, dtype=numpy.float64))
+
+def concatenateChunks(chunks):
+    if len(chunks) == 1:
+        return chunks[0]
+    return SampleChunk(*[numpy.concatenate(columns) for columns in zip(*chunks)])
+
+class SampleReader(object):
+    """
+    Reads the samples of a result file chunk by chunk.
+    readChunk returns a SampleChunk of about chunkSamples samples, or None at the end of the file. A file still
+    being written can be read further by calling readChunk again later: the incomplete entry or line at its end
+    is kept until the rest of it is written.
+    """
+    bytesPerSample = 40 # rough size of a sample in the file, to size the reads
+
+    def __init__(self, fileName, tags, chunkSamples=DEFAULT_CHUNK_SAMPLES):
+        self.fileName = fileName
+        self.tags = tags
+        self.chunkSamples = chunkSamples
+        self.file = open(fileName, "rb")
+        self.pending = b""
+        self.samplesRead = 0
+
+    def readChunk(self):
+        while True:
+            data = self.file.read(self.chunkSamples * self.bytesPerSample)
+            if not data:
+                return None
+            # The decoding creates millions of short lived objects (rows, texts) without any cycle: the cyclic
+            # garbage collector would go through them thousands of times per chunk for nothing
+            gcEnabled = gc.isenabled()
+            gc.disable()
+            try:
+                chunk = self.decode(self.pending + data)
+            finally:
+                if gcEnabled:
+                    gc.enable()
+            if chunk is not None and len(chunk.tagIndexes):
+                self.samplesRead += len(chunk.tagIndexes)
+                return chunk
+
+    def decode(self, data):
+        """ SampleChunk of the complete entries of data, keeps the rest in self.pending. """
+        raise NotImplementedError()
+
+    def close(self):
+        if self.pending:
+            logger.warning("%s: incomplete entry of %s bytes at the end of the file ignored", self.fileName, len(self.pending))
+        self.file.close()
+
+class BinarySampleReader(SampleReader):
+    """
+    Samples of a file of BinaryResultWriter, decoded straight into arrays, without records.
+    The samples with an 8 bytes value (int, uint, double: nearly all of them) have the same size: a run of them
+    is decoded as one structured array (WIDE_SAMPLE), the other entries (tags, messages, bool, null and text
+    values) one by one.
+    """
+    bytesPerSample = WIDE_SAMPLE.itemsize
+
+    def __init__(self, fileName, tags, chunkSamples=DEFAULT_CHUNK_SAMPLES):
+        SampleReader.__init__(self, fileName, tags, chunkSamples)
+        if self.file.read(len(BinaryResultWriter.MAGIC)) != BinaryResultWriter.MAGIC:
+            self.file.close()
+            raise ValueError(fileName + " is not a binary result file")
+        self.fileTags = [] # tag index in the file -> index in the TagTable
+        self.fileTagArray = numpy.zeros(0, dtype=numpy.int64)
+
+    def getFileTagArray(self):
+        if len(self.fileTagArray) != len(self.fileTags):
+            self.fileTagArray = numpy.array(self.fileTags, dtype=numpy.int64)
+        return self.fileTagArray
+
+    def wideChunk(self, samples):
+        w = BinaryResultWriter
+        kinds = samples["kind"]
+        rawValues = numpy.ascontiguousarray(samples["value"])
+        values = numpy.where(kinds == w.VALUE_DOUBLE, rawValues.view(numpy.float64),
+                             numpy.where(kinds == w.VALUE_INT, rawValues.view(numpy.int64), rawValues))
+        return SampleChunk(self.getFileTagArray()[samples["tagIndex"]], samples["timestamp"].astype(numpy.int64),
+                           samples["statusCode"].astype(numpy.uint32), values.astype(numpy.float64))
+
+    def decode(self, data):
+        w = BinaryResultWriter
+        pieces = [] # SampleChunks, in the order of the file
+        tagIndexes, timestamps, statusCodes, values = array("q"), array("q"), array("I"), array("d") # entries decoded one by one
+        unpackSample, sampleSize = w.SAMPLE_HEADER.unpack_from, w.SAMPLE_HEADER.size
+        valueStructs = dict((kind, (valueStruct.unpack_from, valueStruct.size)) for kind, valueStruct in w.VALUE_STRUCTS.items())
+        wideSize = WIDE_SAMPLE.itemsize
+        fileTags = self.fileTags
+        nan = float("nan")
+        probe = MIN_RUN_PROBE
+        offset, end = 0, len(data)
+        while offset < end:
+            kind = data[offset]
+            if w.VALUE_INT <= kind <= w.VALUE_DOUBLE:
+                # Length of the run: the kinds every wideSize bytes, up to the first one of another size.
+                # The probe grows while the runs are long and restarts small after a short one.
+                count = min(probe, (end - offset) // wideSize)
+                if count == 0:
+                    break
+                kinds = numpy.frombuffer(data, dtype=numpy.uint8, count=count * wideSize, offset=offset)[::wideSize]
+                others = numpy.flatnonzero((kinds < w.VALUE_INT) | (kinds > w.VALUE_DOUBLE))
+                runLength = int(others[0]) if len(others) else count
+                probe = min(probe * 2, MAX_RUN_PROBE) if runLength == count else MIN_RUN_PROBE
+                if len(tagIndexes):
+                    pieces.append(arraysChunk(tagIndexes, timestamps, statusCodes, values))
+                    tagIndexes, timestamps, statusCodes, values = array("q"), array("q"), array("I"), array("d")
+                pieces.append(self.wideChunk(numpy.frombuffer(data, dtype=WIDE_SAMPLE, count=runLength, offset=offset)))
+                offset += runLength * wideSize
+            elif kind == w.KIND_TAG:
+                start = offset + w.TAG_HEADER.size
+                if start > end:
+                    break
+                length = w.TAG_HEADER.unpack_from(data, offset)[2]
+                if start + length > end:
+                    break
+                fileTags.append(self.tags.indexOf(data[start:start + length].decode("utf-8")))
+                offset = start + length
+            elif kind == w.KIND_MESSAGE:
+                start = offset + w.MESSAGE_HEADER.size
+                if start > end:
+                    break
+                length = w.MESSAGE_HEADER.unpack_from(data, offset)[1]
+                if start + length > end:
+                    break
+                offset = start + length
+            else:
+                start = offset + sampleSize
+                if start > end:
+                    break
+                valueKind, tagIndex, statusCode, timestamp, variantType = unpackSample(data, offset)
+                valueStruct = valueStructs.get(valueKind)
+                if valueStruct is not None:
+                    if start + valueStruct[1] > end:
+                        break
+                    value = valueStruct[0](data, start)[0]
+                    start += valueStruct[1]
+                else:
+                    value = nan
+                    if valueKind == w.VALUE_TEXT:
+                        if start + w.LENGTH.size > end:
+                            break
+                        start += w.LENGTH.size + w.LENGTH.unpack_from(data, start)[0]
+                        if start > end:
+                            break
+                tagIndexes.append(fileTags[tagIndex])
+                timestamps.append(timestamp)
+                statusCodes.append(statusCode)
+                values.append(value)
+                offset = start
+        self.pending = data[offset:]
+        pieces.append(arraysChunk(tagIndexes, timestamps, statusCodes, values))
+        return concatenateChunks(pieces)
+
+class LineSampleReader(SampleReader):
+    """ Base of the readers of the line based files: only the complete lines are decoded. """
+    bytesPerSample = 80
+    def __init__(self, fileName, tags, chunkSamples=DEFAULT_CHUNK_SAMPLES):
+        SampleReader.__init__(self, fileName, tags, chunkSamples)
+        self.header = self.file.readline().decode("utf-8", "replace")
+
+    def decode(self, data):
+        # Blocks of lines: the rows of a whole chunk as Python objects would take 10 times the size of their text
+        cut = data.rfind(b"\n") + 1
+        self.pending = data[cut:]
+        chunks = []
+        start = 0
+        while start < cut:
+            blockEnd = data.rfind(b"\n", start, start + LINE_BLOCK_BYTES) + 1
+            if blockEnd <= start:
+                blockEnd = data.find(b"\n", start) + 1
+            chunk = self.decodeLines(data[start:blockEnd].decode("utf-8", "replace"))
+            if chunk is not None:
+                chunks.append(chunk)
+            start = blockEnd
+        return concatenateChunks(chunks) if chunks else None
+
+    def decodeLines(self, text):
+        raise NotImplementedError()
+
+class CsvSampleReader(LineSampleReader):
+    """ Samples of a file of CsvResultWriter, the message rows (no tagid) are skipped. """
+    def __init__(self, fileName, tags, chunkSamples=DEFAULT_CHUNK_SAMPLES):
+        LineSampleReader.__init__(self, fileName, tags, chunkSamples)
+        if next(csv.reader([self.header]), []) != CsvResultWriter.COLUMNS:
+            self.file.close()
+            raise ValueError(fileName + " is not a csv result file")
+
+    def decodeLines(self, text):
+        columnCount = len(CsvResultWriter.COLUMNS)
+        rows = [row for row in csv.reader(io.StringIO(text)) if len(row) == columnCount and row[0]]
+        if not rows:
+            return None
+        tagids, browseNames, valueTexts, variantTypes, statusCodes, timestamps, errorMessages = zip(*rows)
+        return chunkFromTexts(self.tags, tagids, valueTexts, variantTypes, statusCodes, timestamps)
+
+class TextSampleReader(LineSampleReader):
+    """
+    Samples of a file of TextResultWriter (the original ",\t" format). The lines which are not samples (header,
+    messages) are skipped. The format is lossy: commas in the values were replaced by ";".
+    """
+    def __init__(self, fileName, tags, chunkSamples=DEFAULT_CHUNK_SAMPLES):
+        LineSampleReader.__init__(self, fileName, tags, chunkSamples)
+        # "Tag from file", Tagid and BrowseName columns in the files of gettags.py
+        self.statusColumn = 4 if self.header.startswith("Tag from file") else 3 if "BrowseName" in self.header else 2
+
+    def decodeLines(self, text):
+        statusColumn = self.statusColumn
+        tagids, valueTexts, variantTypes, statusCodes, timestamps = [], [], [], [], []
+        for line in text.splitlines():
+            parts = line.split(" ,\t ", statusColumn + 1)
+            if len(parts) <= statusColumn:
+                continue
+            statusCode = STATUS_CODES_BY_TEXT.get(parts[statusColumn])
+            if statusCode is None:
+                continue
+            rest = parts[statusColumn + 1] if len(parts) > statusColumn + 1 else ""
+            typeStart = rest.rfind(";type:") + len(";type:")
+            tagids.append(parts[0])
+            valueTexts.append(parts[statusColumn - 1])
+            variantTypes.append(VARIANT_TYPES_BY_NAME.get(rest[typeStart:rest.find(")", typeStart)], 0))
+            statusCodes.append(statusCode)
+            timestamp = rest.split(",\t", 1)[0]
+            timestamps.append(timestamp if timestamp[:1].isdigit() else "")
+        if not tagids:
+            return None
+        return chunkFromTexts(self.tags, tagids, valueTexts, variantTypes, statusCodes, timestamps)
+
+class ParquetSampleReader(SampleReader):
+    """ Samples of a file of ParquetResultWriter, read a row batch at a time through pyarrow (optional dependency). """
+    def __init__(self, fileName, tags, chunkSamples=DEFAULT_CHUNK_SAMPLES):
+        try:
+            import pyarrow
+            import pyarrow.compute
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet result files need pyarrow: pip install pyarrow")
+        self.pa = pyarrow
+        self.fileName = fileName
+        self.tags = tags
+        self.chunkSamples = chunkSamples
+        self.samplesRead = 0
+        self.parquetFile = pyarrow.parquet.ParquetFile(fileName)
+        self.batches = self.parquetFile.iter_batches(batch_size=chunkSamples, columns=["tagid", "numericValue", "statusCode", "sourceTimestamp"])
+
+    def readChunk(self):
+        pa = self.pa
+        for batch in self.batches:
+            tagids = batch.column(0).dictionary_encode()
+            lookup = numpy.array([self.tags.indexOf(tagid) if tagid else -1 for tagid in tagids.dictionary.to_pylist()], dtype=numpy.int64)
+            tagIndexes = lookup[tagids.indices.to_numpy()]
+            values = batch.column(1).to_numpy(zero_copy_only=False).astype(numpy.float64)
+            statusCodes = batch.column(2).fill_null(0).to_numpy().astype(numpy.uint32)
+            timestamps = pa.compute.fill_null(batch.column(3).cast(pa.int64()), NO_TIMESTAMP).to_numpy()
+            samples = tagIndexes >= 0 # the messages have no tagid
+            if samples.any():
+                self.samplesRead += int(samples.sum())
+                return SampleChunk(tagIndexes[samples], timestamps[samples], statusCodes[samples], values[samples])
+        return None
+
+    def close(self):
+        self.parquetFile.close()
+
+def detectFormat(fileName):
+    """ Output format of a result file (text, csv, binary or parquet), from its first bytes. """
+    with open(fileName, "rb") as f:
+        start = f.read(256)
+    if start.startswith(BinaryResultWriter.MAGIC):
+        return "binary"
+    if start.startswith(b"PAR1"):
+        return "parquet"
+    if start.startswith(",".join(CsvResultWriter.COLUMNS).encode("utf-8")):
+        return "csv"
+    if start.startswith(b"Tagid") or start.startswith(b"Tag from file"):
+        return "text"
+    raise ValueError(fileName + " is not a result file (text, csv, binary or parquet)")
+
+SAMPLE_READERS = {"text": TextSampleReader, "csv": CsvSampleReader, "binary": BinarySampleReader, "parquet": ParquetSampleReader}
+
+def openSampleReader(fileName, tags, chunkSamples=DEFAULT_CHUNK_SAMPLES):
+    return SAMPLE_READERS[detectFormat(fileName)](fileName, tags, chunkSamples)
+
+# Open windows: one row per (tag, window), columns of the same length sorted by key.
+# lastTimestamp/lastValue are the ones of the last usable sample, weightedSum (value x microseconds) and
+# coveredTime (microseconds) the parts of the time weighted average.
+WINDOW_COLUMNS = ["keys", "samples", "goodSamples", "sum", "min", "max", "firstTimestamp", "lastTimestamp", "lastValue", "weightedSum", "coveredTime"]
+
+def emptyWindows(size=0):
+    """ Window table of size rows holding nothing: merging it with another one changes nothing. """
+    return {"keys": numpy.zeros(size, dtype=numpy.int64), "samples": numpy.zeros(size, dtype=numpy.int64),
+            "goodSamples": numpy.zeros(size, dtype=numpy.int64), "sum": numpy.zeros(size),
+            "min": numpy.full(size, numpy.inf), "max": numpy.full(size, -numpy.inf),
+            "firstTimestamp": numpy.full(size, MAX_TIMESTAMP, dtype=numpy.int64), "lastTimestamp": numpy.full(size, NO_TIMESTAMP, dtype=numpy.int64),
+            "lastValue": numpy.full(size, numpy.nan), "weightedSum": numpy.zeros(size), "coveredTime": numpy.zeros(size)}
+
+def selectWindows(windows, selection):
+    return dict((column, values[selection]) for column, values in windows.items())
+
+def groupStarts(keys):
+    """ Index of the first row of every run of equal keys (keys sorted). """
+    if not len(keys):
+        return numpy.zeros(0, dtype=numpy.int64)
+    return numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+
+def mergeWindows(tables):
+    """ One row per key of the window tables, their aggregates combined. """
+    windows = dict((column, numpy.concatenate([table[column] for table in tables])) for column in WINDOW_COLUMNS)
+    if not len(windows["keys"]):
+        return windows
+    windows = selectWindows(windows, numpy.lexsort((windows["lastTimestamp"], windows["keys"])))
+    starts = groupStarts(windows["keys"])
+    ends = numpy.concatenate((starts[1:], [len(windows["keys"])])) - 1
+    merged = {"keys": windows["keys"][starts],
+              "firstTimestamp": numpy.minimum.reduceat(windows["firstTimestamp"], starts),
+              "min": numpy.minimum.reduceat(windows["min"], starts),
+              "max": numpy.maximum.reduceat(windows["max"], starts),
+              "lastTimestamp": windows["lastTimestamp"][ends], # rows sorted by lastTimestamp within a key
+              "lastValue": windows["lastValue"][ends]}
+    for column in ("samples", "goodSamples", "sum", "weightedSum", "coveredTime"):
+        merged[column] = numpy.add.reduceat(windows[column], starts)
+    return merged
+
+def sortChunk(chunk):
+    """ The samples of a chunk which have a timestamp, sorted by tag then timestamp, as WindowAggregator.add expects them. """
+    hasTimestamp = chunk.timestamps != NO_TIMESTAMP
+    if not hasTimestamp.all():
+        chunk = SampleChunk(*[column[hasTimestamp] for column in chunk])
+    order = numpy.lexsort((chunk.timestamps, chunk.tagIndexes))
+    return SampleChunk(*[column[order] for column in chunk])
+
+class WindowAggregator(object):
+    """
+    Aggregates of every tag in windows of windowSizeInSec (0: one window per tag over the whole data).
+    add(chunk) merges the samples of a chunk into the open windows, closeWindows returns the windows complete.
+    The last sample of every tag is kept (carry*) to compute the time weighted average across the chunks and
+    windows: holdFrom is where its value starts counting again, the end of the last window it was counted in.
+    """
+    def __init__(self, windowSizeInSec, allowedLatenessInSec=DEFAULT_ALLOWED_LATENESS_IN_SEC, includeUncertain=False):
+        if windowSizeInSec != 0 and windowSizeInSec < 1:
+            raise ValueError("Windows of at least 1 sec expected, not " + str(windowSizeInSec))
+        self.windowSizeInSec = windowSizeInSec
+        self.windowSize = int(windowSizeInSec * 1000000) # microseconds
+        self.allowedLateness = int(allowedLatenessInSec * 1000000)
+        self.qualityMask = SEVERITY_BAD if includeUncertain else SEVERITY_MASK
+        self.windows = emptyWindows()
+        self.closedBefore = 0 # the windows with a lower index have been closed
+        self.maxTimestamp = NO_TIMESTAMP
+        self.carryTimestamp = numpy.zeros(0, dtype=numpy.int64)
+        self.holdFrom = numpy.zeros(0, dtype=numpy.int64)
+        self.carryValue = numpy.zeros(0)
+        self.carryUsable = numpy.zeros(0, dtype=bool)
+        self.samples = 0
+        self.lateSamples = 0
+        self.outOfOrderSamples = 0
+        self.windowsClosed = 0
+
+    def windowOf(self, timestamps):
+        if not self.windowSize:
+            return numpy.zeros(len(timestamps), dtype=numpy.int64)
+        return numpy.maximum(timestamps, 0) // self.windowSize
+
+    def windowStart(self, windows):
+        return windows * self.windowSize
+
+    def windowEnd(self, windows):
+        if not self.windowSize:
+            return numpy.full(len(windows), MAX_TIMESTAMP, dtype=numpy.int64)
+        return (windows + 1) * self.windowSize
+
+    def growCarry(self, tagCount):
+        missing = tagCount - len(self.carryTimestamp)
+        if missing > 0:
+            self.carryTimestamp = numpy.concatenate((self.carryTimestamp, numpy.full(missing, NO_TIMESTAMP, dtype=numpy.int64)))
+            self.holdFrom = numpy.concatenate((self.holdFrom, numpy.full(missing, NO_TIMESTAMP, dtype=numpy.int64)))
+            self.carryValue = numpy.concatenate((self.carryValue, numpy.full(missing, numpy.nan)))
+            self.carryUsable = numpy.concatenate((self.carryUsable, numpy.zeros(missing, dtype=bool)))
+
+    def add(self, chunk):
+        """ Merge a chunk of samples sorted by sortChunk. """
+        if not len(chunk.tagIndexes):
+            return
+        tags, timestamps, values = chunk.tagIndexes, chunk.timestamps, chunk.values
+        usable = ((chunk.statusCodes & self.qualityMask) == 0) & ~numpy.isnan(values)
+        windows = self.windowOf(timestamps)
+        keys = (tags << WINDOW_BITS) | windows
+        self.growCarry(int(tags.max()) + 1)
+        self.samples += len(tags)
+        self.maxTimestamp = max(self.maxTimestamp, int(timestamps.max()))
+
+        # Aggregates of the samples of the chunk by window, the samples of closed windows are only counted
+        late = windows < self.closedBefore
+        self.lateSamples += int(late.sum())
+        onTime = ~late
+        chunkWindows = self.aggregateSamples(keys[onTime], timestamps[onTime], values[onTime], usable[onTime])
+
+        # Time weighted average: the samples newer than the last one of their tag, after it
+        inOrder = timestamps >= self.carryTimestamp[tags]
+        self.outOfOrderSamples += int(len(inOrder) - inOrder.sum())
+        chunkTags = numpy.unique(tags[inOrder])
+        carryTags = chunkTags[self.carryTimestamp[chunkTags] != NO_TIMESTAMP]
+        sequenceTags = numpy.concatenate((carryTags, tags[inOrder]))
+        sequenceTimestamps = numpy.concatenate((self.carryTimestamp[carryTags], timestamps[inOrder]))
+        sequenceStarts = numpy.concatenate((self.holdFrom[carryTags], timestamps[inOrder]))
+        sequenceValues = numpy.concatenate((self.carryValue[carryTags], values[inOrder]))
+        sequenceUsable = numpy.concatenate((self.carryUsable[carryTags], usable[inOrder]))
+        order = numpy.lexsort((sequenceTimestamps, sequenceTags)) # stable: the carried sample stays first on equal timestamps
+        sequenceTags, sequenceTimestamps = sequenceTags[order], sequenceTimestamps[order]
+        sequenceStarts, sequenceValues, sequenceUsable = sequenceStarts[order], sequenceValues[order], sequenceUsable[order]
+        heldWindows = self.holdContributions(sequenceTags, sequenceTimestamps, sequenceStarts, sequenceValues, sequenceUsable)
+
+        # The last sample of every tag of the chunk is carried to the next one
+        lasts = numpy.flatnonzero(numpy.concatenate((sequenceTags[1:] != sequenceTags[:-1], [True])))
+        lastTags = sequenceTags[lasts]
+        self.carryTimestamp[lastTags] = sequenceTimestamps[lasts]
+        self.holdFrom[lastTags] = sequenceStarts[lasts]
+        self.carryValue[lastTags] = sequenceValues[lasts]
+        self.carryUsable[lastTags] = sequenceUsable[lasts]
+
+        self.windows = mergeWindows([self.windows, chunkWindows, heldWindows])
+
+    def aggregateSamples(self, keys, timestamps, values, usable):
+        """ Window table of samples sorted by key then timestamp. """
+        starts = groupStarts(keys)
+        if not len(starts):
+            return emptyWindows()
+        positions = numpy.where(usable, numpy.arange(len(keys)), -1)
+        lasts = numpy.maximum.reduceat(positions, starts)
+        hasLast = lasts >= 0
+        return {"keys": keys[starts],
+                "samples": numpy.diff(numpy.concatenate((starts, [len(keys)]))),
+                "goodSamples": numpy.add.reduceat(usable.astype(numpy.int64), starts),
+                "sum": numpy.add.reduceat(numpy.where(usable, values, 0.0), starts),
+                "min": numpy.minimum.reduceat(numpy.where(usable, values, numpy.inf), starts),
+                "max": numpy.maximum.reduceat(numpy.where(usable, values, -numpy.inf), starts),
+                "firstTimestamp": timestamps[starts],
+                "lastTimestamp": numpy.where(hasLast, timestamps[lasts], NO_TIMESTAMP),
+                "lastValue": numpy.where(hasLast, values[lasts], numpy.nan),
+                "weightedSum": numpy.zeros(len(starts)),
+                "coveredTime": numpy.zeros(len(starts))}
+
+    def holdContributions(self, tags, timestamps, starts, values, usable):
+        """
+        Window table of the time the values are held, samples sorted by tag then timestamp.
+        The value of a usable sample counts from its start until the next sample of its tag: in the window of the
+        start (up to its end) when the sample or the next one is in it, and in the window of the next sample from
+        its start. The windows in between have no sample and are not written.
+        """
+        pairs = numpy.flatnonzero((tags[1:] == tags[:-1]) & usable[:-1])
+        if not len(pairs):
+            return emptyWindows()
+        pairTags, values = tags[pairs], values[pairs]
+        holdStarts, holdEnds = starts[pairs], numpy.maximum(timestamps[pairs + 1], starts[pairs])
+        startWindows, endWindows = self.windowOf(holdStarts), self.windowOf(holdEnds)
+        ownWindows = self.windowOf(timestamps[pairs])
+
+        inStartWindow = (startWindows == ownWindows) | (startWindows == endWindows)
+        firstDurations = numpy.minimum(holdEnds, self.windowEnd(startWindows)) - holdStarts
+        inEndWindow = endWindows > startWindows
+        secondDurations = holdEnds - self.windowStart(endWindows)
+
+        keys = numpy.concatenate(((pairTags << WINDOW_BITS) | startWindows, (pairTags << WINDOW_BITS) | endWindows))
+        durations = numpy.concatenate((firstDurations, secondDurations)).astype(numpy.float64)
+        selected = numpy.concatenate((inStartWindow, inEndWindow)) & (durations > 0) & ((keys & WINDOW_MASK) >= self.closedBefore)
+        windows = emptyWindows(int(selected.sum()))
+        windows["keys"] = keys[selected]
+        windows["coveredTime"] = durations[selected]
+        windows["weightedSum"] = numpy.concatenate((values, values))[selected] * durations[selected]
+        return windows
+
+    def closeWindows(self, final=False):
+        """
+        Remove and return the windows complete: the ones ending allowedLateness before the newest timestamp
+        read, all of them when final. The value held at the end of a closed window is counted up to its end
+        (up to the newest timestamp when final).
+        """
+        if final:
+            closeBefore = WINDOW_MASK + 1
+        elif self.windowSize and self.maxTimestamp != NO_TIMESTAMP:
+            closeBefore = max(0, self.maxTimestamp - self.allowedLateness) // self.windowSize
+        else:
+            return emptyWindows()
+        windowIndexes = self.windows["keys"] & WINDOW_MASK
+        closing = windowIndexes < closeBefore
+        closed = selectWindows(self.windows, closing)
+        self.windows = selectWindows(self.windows, ~closing)
+        self.closedBefore = max(self.closedBefore, closeBefore)
+        if not len(closed["keys"]):
+            return closed
+
+        tags, windowIndexes = closed["keys"] >> WINDOW_BITS, windowIndexes[closing]
+        ends = self.windowEnd(windowIndexes)
+        if final:
+            ends = numpy.minimum(ends, self.maxTimestamp)
+        holding = (self.carryTimestamp[tags] != NO_TIMESTAMP) & (self.windowOf(self.holdFrom[tags]) == windowIndexes) & (ends > self.holdFrom[tags])
+        durations = numpy.where(holding & self.carryUsable[tags], ends - self.holdFrom[tags], 0).astype(numpy.float64)
+        closed["weightedSum"] = closed["weightedSum"] + numpy.where(durations > 0, self.carryValue[tags] * durations, 0.0)
+        closed["coveredTime"] = closed["coveredTime"] + durations
+        self.holdFrom[tags[holding]] = ends[holding]
+        self.windowsClosed += len(tags)
+        return closed
+
+    def getStatistics(self):
+        return {"windowSizeInSec": self.windowSizeInSec, "samples": self.samples, "lateSamples": self.lateSamples, "outOfOrderSamples": self.outOfOrderSamples,
+                "openWindows": len(self.windows["keys"]), "windowsWritten": self.windowsClosed}
+
+def summarize(windows, aggregator, tags):
+    """ Summary columns (SUMMARY_COLUMNS) of closed windows, ordered by window then tag. """
+    tagIndexes, windowIndexes = windows["keys"] >> WINDOW_BITS, windows["keys"] & WINDOW_MASK
+    order = numpy.lexsort((tagIndexes, windowIndexes))
+    windows = selectWindows(windows, order)
+    tagIndexes, windowIndexes = tagIndexes[order], windowIndexes[order]
+    goodSamples = windows["goodSamples"]
+    noGood = goodSamples == 0
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        mean = windows["sum"] / goodSamples
+        timeWeightedAverage = numpy.where(windows["coveredTime"] > 0, windows["weightedSum"] / windows["coveredTime"], numpy.nan)
+    if aggregator.windowSize:
+        windowStarts = aggregator.windowStart(windowIndexes)
+    else:
+        windowStarts = windows["firstTimestamp"]
+    return {"tagid": numpy.array(tags.tagids, dtype=object)[tagIndexes], "windowStart": windowStarts,
+            "samples": windows["samples"], "goodSamples": goodSamples,
+            "min": numpy.where(noGood, numpy.nan, windows["min"]), "max": numpy.where(noGood, numpy.nan, windows["max"]),
+            "mean": numpy.where(noGood, numpy.nan, mean), "timeWeightedAverage": timeWeightedAverage,
+            "last": windows["lastValue"], "lastTimestamp": windows["lastTimestamp"]}
+
+def timestampTexts(timestamps):
+    """ ISO 8601 texts (UTC, milliseconds) of microsecond timestamps, "" for NO_TIMESTAMP. """
+    texts = numpy.datetime_as_string(timestamps.astype("datetime64[us]"), unit="ms")
+    return numpy.where(timestamps == NO_TIMESTAMP, "", numpy.char.add(texts, "Z"))
+
+def numberTexts(numbers):
+    return numpy.where(numpy.isnan(numbers), "", numbers.astype(str))
+
+class CsvSummaryWriter(object):
+    """ Summary rows as CSV, the numbers without a value (no good sample) left empty. """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.file = open(fileName, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(SUMMARY_COLUMNS)
+        self.rowsWritten = 0
+
+    def writeSummary(self, summary):
+        columns = []
+        for column in SUMMARY_COLUMNS:
+            values = summary[column]
+            if column in ("windowStart", "lastTimestamp"):
+                values = timestampTexts(values)
+            elif values.dtype == numpy.float64:
+                values = numberTexts(values)
+            columns.append(values.tolist())
+        self.writer.writerows(zip(*columns))
+        self.rowsWritten += len(summary["tagid"])
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class ParquetSummaryWriter(object):
+    """ Summary rows as Parquet through pyarrow (optional dependency), one row group per writeSummary. """
+    def __init__(self, fileName):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("The parquet summary format needs pyarrow: pip install pyarrow")
+        self.pa = pyarrow
+        self.fileName = fileName
+        self.schema = pyarrow.schema([("tagid", pyarrow.string()), ("windowStart", pyarrow.timestamp("us")),
+                                      ("samples", pyarrow.int64()), ("goodSamples", pyarrow.int64())] +
+                                     [(column, pyarrow.float64()) for column in ("min", "max", "mean", "timeWeightedAverage", "last")] +
+                                     [("lastTimestamp", pyarrow.timestamp("us"))])
+        self.writer = pyarrow.parquet.ParquetWriter(fileName, self.schema)
+        self.rowsWritten = 0
+
+    def writeSummary(self, summary):
+        pa = self.pa
+        arrays = []
+        for field in self.schema:
+            values = summary[field.name]
+            if field.name == "tagid":
+                arrays.append(pa.array(values.tolist(), type=field.type))
+            elif field.name in ("windowStart", "lastTimestamp"):
+                arrays.append(pa.array(values, type=pa.int64(), mask=values == NO_TIMESTAMP).cast(field.type))
+            else:
+                arrays.append(pa.array(values, type=field.type, from_pandas=True)) # NaN -> null
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.rowsWritten += len(summary["tagid"])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.writer.close()
+
+def createSummaryWriter(summaryFormat, fileName):
+    if summaryFormat == "csv":
+        return CsvSummaryWriter(fileName)
+    if summaryFormat == "parquet":
+        return ParquetSummaryWriter(fileName)
+    raise ValueError("Unknown summary format: " + str(summaryFormat))
+
+def windowLabel(windowSizeInSec):
+    """ Suffix of the summary file of a window size: 60 -> 1m, 3600 -> 1h, 0 -> all. """
+    if windowSizeInSec == 0:
+        return "all"
+    if windowSizeInSec % 3600 == 0:
+        return "%dh" % (windowSizeInSec // 3600)
+    if windowSizeInSec % 60 == 0:
+        return "%dm" % (windowSizeInSec // 60)
+    return "%gs" % windowSizeInSec
+
+def writeWindows(writer, windows, aggregator, tags):
+    if len(windows["keys"]):
+        writer.writeSummary(summarize(windows, aggregator, tags))
+
+def getParameters(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Per tag aggregates of result files of the collector, in time windows")
+    parser.add_argument("inputFiles", nargs="+", metavar="resultFile", help="result files (text, csv, binary or parquet), read in this order")
+    parser.add_argument("--output", default="summary", help="summary file name, the window and the extension are appended")
+    parser.add_argument("--windows", default=",".join(str(w) for w in DEFAULT_WINDOWS_IN_SEC),
+                        help="comma separated window sizes in sec, 0 for one window over the whole data")
+    parser.add_argument("--format", default="csv", help="summary format: " + ", ".join(SUMMARY_FILE_EXTENSIONS))
+    parser.add_argument("--quality", default="good", help="samples in min/max/mean/last and the time weighted average: good, or uncertain (good and uncertain)")
+    parser.add_argument("--chunk-samples", type=int, default=DEFAULT_CHUNK_SAMPLES, help="samples read and aggregated at a time")
+    parser.add_argument("--lateness", type=float, default=DEFAULT_ALLOWED_LATENESS_IN_SEC,
+                        help="sec a window stays open after the newest timestamp passed its end, for the samples arriving late")
+    parser.add_argument("--follow", action="store_true", help="keep reading the last file while the collector writes it (Ctrl+C to stop)")
+    parser.add_argument("--poll-interval", type=float, default=1, help="sec between two reads of the file with --follow")
+    parser.add_argument("--idle-timeout", type=float, default=0, help="with --follow, stop after this many sec without new samples, 0 never")
+    args = parser.parse_args(argv)
+
+    d = dict()
+    d['inputFiles'] = args.inputFiles
+    d['outputFileName'] = args.output
+    d['windowsInSec'] = [float(w) for w in args.windows.split(",") if w]
+    d['summaryFormat'] = args.format
+    d['includeUncertain'] = args.quality == "uncertain"
+    d['chunkSamples'] = args.chunk_samples
+    d['allowedLatenessInSec'] = args.lateness
+    d['follow'] = args.follow
+    d['pollIntervalInSec'] = args.poll_interval
+    d['idleTimeoutInSec'] = args.idle_timeout
+    if args.quality not in ("good", "uncertain"):
+        parser.error("--quality: good or uncertain expected, not " + args.quality)
+    if args.format not in SUMMARY_FILE_EXTENSIONS:
+        parser.error("--format: " + " or ".join(SUMMARY_FILE_EXTENSIONS) + " expected, not " + args.format)
+    return d
+
+def run(parameters):
+    tags = TagTable()
+    aggregators = [WindowAggregator(windowSizeInSec, parameters["allowedLatenessInSec"], parameters["includeUncertain"])
+                   for windowSizeInSec in parameters["windowsInSec"]]
+    writers = [createSummaryWriter(parameters["summaryFormat"], parameters["outputFileName"] + "_" + windowLabel(aggregator.windowSizeInSec)
+                                   + SUMMARY_FILE_EXTENSIONS[parameters["summaryFormat"]]) for aggregator in aggregators]
+    startTime = time.perf_counter()
+    samplesRead = 0
+    samplesWithoutTimestamp = 0
+    try:
+        for i, fileName in enumerate(parameters["inputFiles"]):
+            follow = parameters["follow"] and i == len(parameters["inputFiles"]) - 1
+            reader = openSampleReader(fileName, tags, parameters["chunkSamples"])
+            if follow and isinstance(reader, ParquetSampleReader):
+                raise ValueError(fileName + ": a parquet file can not be followed, it is only readable once closed")
+            lastChunkTime = time.time()
+            try:
+                while True:
+                    chunk = reader.readChunk()
+                    if chunk is None:
+                        if not follow or (parameters["idleTimeoutInSec"] and time.time() - lastChunkTime > parameters["idleTimeoutInSec"]):
+                            break
+                        time.sleep(parameters["pollIntervalInSec"])
+                        continue
+                    lastChunkTime = time.time()
+                    SAMPLES_AGGREGATED.inc(len(chunk.tagIndexes))
+                    sortedChunk = sortChunk(chunk)
+                    samplesWithoutTimestamp += len(chunk.tagIndexes) - len(sortedChunk.tagIndexes)
+                    for aggregator, writer in zip(aggregators, writers):
+                        aggregator.add(sortedChunk)
+                        writeWindows(writer, aggregator.closeWindows(), aggregator, tags)
+                        if follow:
+                            writer.flush()
+            finally:
+                samplesRead += reader.samplesRead
+                reader.close()
+    except KeyboardInterrupt:
+        print("Stopped, writing the open windows")
+    finally:
+        for aggregator, writer in zip(aggregators, writers):
+            writeWindows(writer, aggregator.closeWindows(final=True), aggregator, tags)
+            writer.close()
+    elapsedTime = time.perf_counter() - startTime
+
+    statistics = {"samples": samplesRead, "samplesWithoutTimestamp": samplesWithoutTimestamp, "tags": len(tags), "seconds": round(elapsedTime, 3),
+                  "samplesPerSec": int(samplesRead / elapsedTime) if elapsedTime > 0 else 0,
+                  "windows": [aggregator.getStatistics() for aggregator in aggregators],
+                  "summaryFiles": [writer.fileName for writer in writers]}
+    print("Aggregation statistics: " + str(statistics))
+    return statistics
+
+def main(argv=None, prog=None):
+    parameters = getParameters(argv, prog)
+    try:
+        run(parameters)
+    except (OSError, ValueError) as e:
+        sys.exit("aggregate: " + str(e))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+
+from datetime import datetime, timedelta
+from opcua import Node, ua
+from tagencoder import TextRowEncoder, encodeChunk
+
+# Rows/sec of the DataValue formatting: the original readNodeValues (five try/except blocks,
+# str() and replace() of every field, one print per value) against tagencoder.
+# Usage: python bench_encoder.py [NumberOfRows] [NumberOfTags]
+
+def makeDataValues(numberOfRows, numberOfTags):
+    """ Synthetic notifications: mostly doubles, some integers, booleans and strings, a few bad values. """
+    random.seed(1)
+    startTime = datetime(2020, 1, 1)
+    tagNodes = [Node(None, ua.NodeId("0:FIC-31-%04d:Z.X.Parameters.Value" % i, 2)) for i in range(numberOfTags)]
+    nodes = []
+    dataValues = []
+    for i in range(numberOfRows):
+        kind = i % 10
+        if i % 100 == 0:
+            dataValue = ua.DataValue(status=ua.StatusCode(ua.StatusCodes.BadCommunicationError))
+        elif kind < 6:
+            dataValue = ua.DataValue(ua.Variant(random.uniform(-1000, 1000), ua.VariantType.Double))
+        elif kind < 8:
+            dataValue = ua.DataValue(ua.Variant(random.randint(0, 100000), ua.VariantType.Int32))
+        elif kind < 9:
+            dataValue = ua.DataValue(ua.Variant(bool(i % 2), ua.VariantType.Boolean))
+        else:
+            dataValue = ua.DataValue(ua.Variant("degC, gauge", ua.VariantType.String))
+        dataValue.SourceTimestamp = startTime + timedelta(milliseconds=i)
+        nodes.append(tagNodes[i % numberOfTags])
+        dataValues.append(dataValue)
+    return nodes, dataValues
+
+def legacyReadNodeValues(var, dataValue):
+    """ The original formatting of gettags_subscription.py, kept here as the reference. """
+    message = ""
+    error = False
+    try:
+        tagid = var.nodeid.Identifier
+    except Exception as e:
+        error = True
+        tagid = ". Error message: "  + str(e)
+        message = message + ",\t error trying to read the tagId from the tag. "
+    try:
+        variantValue = str(dataValue.Value).replace(",", ";")
+    except Exception as e:
+        error = True
+        variantValue = ". Error message: "  + str(e)
+        message = message + ",\t error trying to read the variant value from the tag. "
+    try:
+        value = str(dataValue.Value.Value).replace(",", ";")
+    except Exception as e:
+        error = True
+        value = ". Error message: "  + str(e)
+        message = message + ",\t error trying to read the value from the tag. "
+    try:
+        statusCode = str(dataValue.StatusCode).replace(",", ";")
+    except Exception as e:
+        error = True
+        statusCode = ". Error message: "  + str(e)
+        message = message + ",\t error trying to read the statusCode from the tag. "
+    try:
+        timestamp =dataValue.SourceTimestamp.isoformat('T')+"Z"
+    except Exception as e:
+        error = True
+        timestamp = ". Error message: "  + str(e)
+        message = message + ",\t error trying to read the SourceTimestamp from the tag. "
+    if error:
+        message = tagid + " ,\t " + value + " ,\t " + statusCode + " ,\t " + timestamp + ",\t Whole variant value: " + variantValue + ",\t Error message: " + message + " ."
+    else:
+        message = tagid + " ,\t " + value + " ,\t " + statusCode + " ,\t " + timestamp + ",\t Whole variant value: " + variantValue + " ."
+    print("ReadNodeValues \n" , message)
+    return message + "\n"
+
+def benchmark(name, function, numberOfRows):
+    startTime = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - startTime
+    return {"encoder": name, "seconds": round(elapsed, 3), "rowsPerSec": int(numberOfRows / elapsed)}
+
+if __name__ == "__main__":
+    numberOfRows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    numberOfTags = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    nodes, dataValues = makeDataValues(numberOfRows, numberOfTags)
+
+    def legacy():
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            return [legacyReadNodeValues(node, dataValue) for node, dataValue in zip(nodes, dataValues)]
+
+    def records():
+        return encodeChunk(nodes, dataValues)
+
+    def textLines():
+        encode = TextRowEncoder().encode
+        return [encode(record) for record in encodeChunk(nodes, dataValues)]
+
+    results = [benchmark("legacy (print to devnull)", legacy, numberOfRows),
+               benchmark("tagencoder records", records, numberOfRows),
+               benchmark("tagencoder text lines", textLines, numberOfRows)]
+    for result in results:
+        result["speedVsLegacy"] = round(result["rowsPerSec"] / results[0]["rowsPerSec"], 2)
+    print(json.dumps(results, indent=2))
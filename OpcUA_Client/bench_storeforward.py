@@ -0,0 +1,164 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_writers import makeRecords
+from resultwriters import createResultWriter, iterBinaryLog
+from storeforward import Forwarder, SegmentLog, StoreForwardWriter
+
+# Throughput and crash recovery of the store and forward log (storeforward.py), with a local
+# stand-in for the downstream system: a binary result file, optionally slow or offline.
+# Usage: python bench_storeforward.py [NumberOfRecords]
+#   direct:    records written straight to the result file (baseline)
+#   ingest:    records appended to the log, pages flushed every 4 MB / 1 sec (default) or after every batch
+#   forward:   log drained into the sink
+#   outage:    sink offline for a while during the ingest, time to catch up once it is back
+#   recovery:  writer process killed during the ingest, time to open the log again and records recovered
+
+BATCH_SIZE = 1000 # Records per writeRecords call, as a subscription writer batch
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+class StandInSink(object):
+    """ Sink in front of a result file: latencyInSec per batch, refuses everything while offline. """
+    def __init__(self, writer, latencyInSec=0):
+        self.writer = writer
+        self.fileName = writer.fileName
+        self.latencyInSec = latencyInSec
+        self.offline = False
+
+    def writeRecords(self, records):
+        if self.offline:
+            raise ConnectionError("sink offline")
+        if self.latencyInSec:
+            time.sleep(self.latencyInSec)
+        self.writer.writeRecords(records)
+
+    def writeMessage(self, message):
+        self.writer.writeMessage(message)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+def countRecords(fileName):
+    return sum(1 for item in iterBinaryLog(fileName) if not isinstance(item, str))
+
+def batches(records):
+    for i in range(0, len(records), BATCH_SIZE):
+        yield records[i:i + BATCH_SIZE]
+
+def result(name, records, seconds, **extra):
+    d = {"test": name, "records": records, "seconds": round(seconds, 3), "recordsPerSec": int(records / seconds) if seconds > 0 else 0}
+    d.update(extra)
+    return d
+
+def benchDirect(records, directory):
+    writer = createResultWriter("binary", os.path.join(directory, "direct.bin"))
+    startTime = time.perf_counter()
+    for batch in batches(records):
+        writer.writeRecords(batch)
+        writer.flush()
+    writer.close()
+    return result("direct", len(records), time.perf_counter() - startTime)
+
+def benchIngest(records, directory, name, **logOptions):
+    log = SegmentLog(os.path.join(directory, name), segmentSize=SEGMENT_SIZE, **logOptions)
+    startTime = time.perf_counter()
+    for batch in batches(records):
+        log.appendRecords(batch)
+    log.close()
+    elapsed = time.perf_counter() - startTime
+    return result(name, len(records), elapsed, megabytesPerSec=round(log.bytesAppended / elapsed / 1e6, 1), syncs=log.syncCount)
+
+def benchForward(records, directory):
+    """ Drain the log filled by benchIngest (ingest) into a file sink. """
+    log = SegmentLog(os.path.join(directory, "ingest"), segmentSize=SEGMENT_SIZE)
+    sink = StandInSink(createResultWriter("binary", os.path.join(directory, "forward.bin")))
+    forwarder = Forwarder(log, sink)
+    startTime = time.perf_counter()
+    forwarder.start()
+    forwarder.stop(drainTimeoutInSec=600)
+    elapsed = time.perf_counter() - startTime
+    log.close()
+    sink.close()
+    return result("forward", forwarder.forwardedRecords, elapsed, recordsInSink=countRecords(sink.fileName))
+
+def benchOutage(records, directory, outageInSec=2):
+    """ The sink goes offline after a third of the records and comes back outageInSec later. """
+    sink = StandInSink(createResultWriter("binary", os.path.join(directory, "outage.bin")), latencyInSec=0.001)
+    writer = StoreForwardWriter(os.path.join(directory, "outage"), sink, drainTimeoutInSec=600, segmentSize=SEGMENT_SIZE)
+    writer.forwarder.retryDelayInSec = 0.2
+    writer.forwarder.maxRetryDelayInSec = 0.2
+    startTime = time.perf_counter()
+    outageEndTime = None
+    for i, batch in enumerate(batches(records)):
+        if i == len(records) // BATCH_SIZE // 3:
+            sink.offline = True
+            outageEndTime = time.perf_counter() + outageInSec
+        if outageEndTime is not None and time.perf_counter() >= outageEndTime:
+            sink.offline = False
+            outageEndTime = None
+        writer.writeRecords(batch)
+    ingestTime = time.perf_counter() - startTime
+    if outageEndTime is not None:
+        time.sleep(max(0, outageEndTime - time.perf_counter()))
+        sink.offline = False
+    catchUpStartTime = time.perf_counter()
+    writer.close()
+    return result("outage", len(records), ingestTime, outageInSec=outageInSec, catchUpInSec=round(time.perf_counter() - catchUpStartTime, 3),
+                  sinkErrors=writer.forwarder.sinkErrors, recordsInSink=countRecords(sink.fileName))
+
+def ingestChild(directory):
+    """ Child process of benchRecovery: ingest until killed, print the records acknowledged (synced) so far. """
+    records = makeRecords(100000, 2000)
+    log = SegmentLog(directory, segmentSize=SEGMENT_SIZE)
+    appended = 0
+    syncCount = log.syncCount
+    while True:
+        for batch in batches(records):
+            log.appendRecords(batch)
+            appended += len(batch)
+            if log.syncCount != syncCount:
+                syncCount = log.syncCount
+                print(appended, flush=True)
+
+def benchRecovery(directory, runTimeInSec=3):
+    logDirectory = os.path.join(directory, "recovery")
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--ingest-child", logDirectory], stdout=subprocess.PIPE, text=True)
+    time.sleep(runTimeInSec)
+    child.kill()
+    output = child.communicate()[0].split()
+    acknowledged = int(output[-1]) if output else 0
+
+    startTime = time.perf_counter()
+    log = SegmentLog(logDirectory, segmentSize=SEGMENT_SIZE)
+    recoveryTimeInSec = time.perf_counter() - startTime
+    sink = StandInSink(createResultWriter("binary", os.path.join(directory, "recovered.bin")))
+    forwarder = Forwarder(log, sink)
+    forwarder.start()
+    forwarder.stop(drainTimeoutInSec=600)
+    log.close()
+    sink.close()
+    recovered = countRecords(sink.fileName)
+    return {"test": "recovery", "recoveryTimeInSec": round(recoveryTimeInSec, 4), "recordsAcknowledged": acknowledged,
+            "recordsRecovered": recovered, "acknowledgedLost": max(0, acknowledged - recovered), "bytesCut": log.cutBytes}
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--ingest-child":
+        ingestChild(sys.argv[2])
+    numberOfRecords = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    records = makeRecords(numberOfRecords, 2000)
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = [benchDirect(records, directory),
+                   benchIngest(records, directory, "ingest"),
+                   benchIngest(records, directory, "ingest sync every batch", syncBytes=1),
+                   benchForward(records, directory),
+                   benchOutage(records, directory),
+                   benchRecovery(directory)]
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,62 @@
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+from opcua import ua
+from resultwriters import ScanRecord, RESULT_FILE_EXTENSIONS, createResultWriter
+
+# Compare the output size and the write throughput of the result writers.
+# Usage: python bench_writers.py [NumberOfRecords] [NumberOfTags]
+
+def makeRecords(numberOfRecords, numberOfTags):
+    """ Synthetic scan: mostly doubles, some integers, booleans and strings, a few bad values. """
+    random.seed(1)
+    startTime = datetime(2020, 1, 1)
+    records = []
+    for i in range(numberOfRecords):
+        tagid = "0:FIC-31-%04d:Z.X.Parameters.Value" % (i % numberOfTags)
+        kind = i % 10
+        if kind < 6:
+            value, variantType = random.uniform(-1000, 1000), ua.VariantType.Double.value
+        elif kind < 8:
+            value, variantType = random.randint(0, 100000), ua.VariantType.Int32.value
+        elif kind < 9:
+            value, variantType = bool(i % 2), ua.VariantType.Boolean.value
+        else:
+            value, variantType = "degC, gauge", ua.VariantType.String.value
+        statusCode = ua.StatusCodes.Good if i % 100 else ua.StatusCodes.BadCommunicationError
+        records.append(ScanRecord(tagid, "", value, variantType, statusCode, startTime + timedelta(milliseconds=i), ""))
+    return records
+
+def benchmarkWriter(outputFormat, records, directory):
+    fileName = os.path.join(directory, "bench_" + outputFormat + RESULT_FILE_EXTENSIONS[outputFormat])
+    try:
+        startTime = time.perf_counter()
+        writer = createResultWriter(outputFormat, fileName)
+        writer.writeRecords(records)
+        writer.close()
+        elapsed = time.perf_counter() - startTime
+    except ImportError as e:
+        return {"format": outputFormat, "skipped": str(e)}
+    size = os.path.getsize(fileName)
+    return {"format": outputFormat, "bytes": size, "bytesPerRecord": round(size / len(records), 1),
+            "seconds": round(elapsed, 3), "recordsPerSec": int(len(records) / elapsed)}
+
+if __name__ == "__main__":
+    numberOfRecords = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    numberOfTags = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    records = makeRecords(numberOfRecords, numberOfTags)
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = [benchmarkWriter(outputFormat, records, directory) for outputFormat in ("text", "csv", "binary", "parquet")]
+
+    baseline = results[0]
+    for result in results:
+        if "bytes" in result:
+            result["sizeVsText"] = round(result["bytes"] / baseline["bytes"], 2)
+            result["speedVsText"] = round(result["recordsPerSec"] / baseline["recordsPerSec"], 2)
+    print(json.dumps(results, indent=2))
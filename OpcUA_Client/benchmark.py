@@ -0,0 +1,400 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from datetime import datetime
+
+# Benchmark harness for the tag readers.
+# Starts a simulated OPC UA server (python-opcua Server) with a configurable number of
+# variables, data types and update rate, runs every reader against it and reports
+# tags/sec, p50/p99 latency, peak RSS and dropped notifications. Results are saved as
+# JSON and can be compared with a previous run:
+#   python benchmark.py --tags 5000 --output bench.json
+#   python benchmark.py --tags 5000 --compare bench.json
+# The server and every reader run in their own process, so a reader is not slowed down
+# by the server sharing its GIL and its peak RSS is its own.
+
+READERS = ["node", "batch", "stream", "adaptive", "async", "subscription", "connect"]
+DATA_TYPES = ["Double", "Int32", "Boolean", "String"]
+SIM_NAMESPACE = "urn:opcua-client:benchmark"
+
+def simulatedTagIds(numberOfTags):
+    return ["ns=2;s=Sim.Tag%06d" % i for i in range(numberOfTags)]
+
+def simulatedValue(dataType, i, tick):
+    if dataType == "Double":
+        return float(i) + tick * 0.1
+    if dataType == "Int32":
+        return i + tick
+    if dataType == "Boolean":
+        return (i + tick) % 2 == 0
+    return "value %d" % (i + tick)
+
+def runSimulatedServer(url, numberOfTags, dataTypes, updateRateInSec, ready, stop):
+    """ Process target: serve numberOfTags variables and change all of them every updateRateInSec. """
+    import logging
+    from opcua import Server, ua
+    logging.getLogger("opcua").setLevel(logging.ERROR)
+
+    server = Server()
+    server.set_endpoint(url)
+    server.register_namespace(SIM_NAMESPACE)
+    simulation = server.get_objects_node().add_object("ns=2;s=Sim", "Simulation")
+    variables = []
+    for i, tagid in enumerate(simulatedTagIds(numberOfTags)):
+        dataType = dataTypes[i % len(dataTypes)]
+        variantType = getattr(ua.VariantType, dataType)
+        variable = simulation.add_variable(tagid, tagid[7:], simulatedValue(dataType, i, 0), variantType)
+        variables.append((variable.nodeid, dataType, variantType, i))
+    server.start()
+    ready.set()
+    try:
+        tick = 0
+        while not stop.wait(updateRateInSec if updateRateInSec > 0 else 3600):
+            tick += 1
+            for nodeid, dataType, variantType, i in variables:
+                dataValue = ua.DataValue(ua.Variant(simulatedValue(dataType, i, tick), variantType))
+                dataValue.SourceTimestamp = datetime.utcnow()
+                server.set_attribute_value(nodeid, dataValue)
+    finally:
+        server.stop()
+
+class SimulatedServer(object):
+    """ Simulated OPC UA server running in a child process, usable as a context manager. """
+    def __init__(self, numberOfTags, dataTypes=DATA_TYPES, updateRateInSec=1.0, port=48400):
+        self.url = "opc.tcp://127.0.0.1:%d/benchmark/" % port
+        self.numberOfTags = numberOfTags
+        self.ready = multiprocessing.Event()
+        self.stop = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=runSimulatedServer, daemon=True,
+                                               args=(self.url, numberOfTags, list(dataTypes), updateRateInSec, self.ready, self.stop))
+
+    def __enter__(self):
+        self.process.start()
+        if not self.ready.wait(60 + self.numberOfTags / 500):
+            self.process.terminate()
+            raise RuntimeError("The simulated server did not start")
+        return self
+
+    def __exit__(self, *args):
+        self.stop.set()
+        self.process.join(30)
+        if self.process.is_alive():
+            self.process.terminate()
+
+def percentile(sortedValues, p):
+    if not sortedValues:
+        return None
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * p / 100.0))]
+
+def peakRssKB():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def timeCalls(function, latencies):
+    """ Wrap function so the duration of every call is appended to latencies (seconds). """
+    def timed(*args, **kwargs):
+        startTime = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - startTime)
+    return timed
+
+def timeCallsAsync(coroutineFunction, latencies):
+    """ Same as timeCalls for a coroutine function. """
+    async def timed(*args, **kwargs):
+        startTime = time.perf_counter()
+        try:
+            return await coroutineFunction(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - startTime)
+    return timed
+
+def runOneShotReader(reader, url, tagFile, outputDir, config):
+    """
+    Run one of the gettags_improvement.py read modes, returns the tags read, the seconds taken and the request latencies.
+    "adaptive" is the stream mode with the Read requests sized and pipelined at runtime (adaptiveread.py).
+    """
+    import gettags_improvement
+    from resultwriters import createResultWriter
+
+    latencies = []
+    opcua_client = gettags_improvement.opcUaClient(url)
+    resultWriter = createResultWriter("binary", os.path.join(outputDir, reader + ".bin"))
+    try:
+        with open(tagFile) as tagList:
+            startTime = time.perf_counter()
+            if reader == "node":
+                gettags_improvement.readNodeValues = timeCalls(gettags_improvement.readNodeValues, latencies)
+                arrayNodes = opcua_client.getArrayNodesFromOpcServer(tagList, resultWriter)
+                records = gettags_improvement.readValuesNodeByNode(arrayNodes)
+            else:
+                if reader == "adaptive":
+                    opcua_client.configureReads(config["chunkSize"], maxRequestsInFlight=config["requestsInFlight"])
+                opcua_client.readDataValuesInChunks = timeCalls(opcua_client.readDataValuesInChunks, latencies)
+                if reader == "batch":
+                    arrayNodes = opcua_client.getArrayNodesFromOpcServer(tagList, resultWriter)
+                    records = gettags_improvement.readValuesInChunks(opcua_client, arrayNodes, config["chunkSize"])
+                else:
+                    records = gettags_improvement.iterValuesStreaming(opcua_client, tagList, config["chunkSize"])
+            numberOfTags = 0
+            for record in records:
+                resultWriter.writeRecord(record)
+                numberOfTags += 1
+            elapsed = time.perf_counter() - startTime
+        readTuning = opcua_client.getReadTuning()
+    finally:
+        resultWriter.close()
+        opcua_client.disconnect()
+    return {"tags": numberOfTags, "seconds": elapsed, "latencies": latencies, "readTuning": readTuning}
+
+def runAsyncReader(url, tagFile, outputDir, config):
+    import asyncio
+    import get_tags_async
+    from asyncua import Client
+
+    latencies = []
+    get_tags_async.readTag = timeCallsAsync(get_tags_async.readTag, latencies)
+
+    async def run():
+        async with Client(url=url) as client:
+            with open(tagFile) as f, open(os.path.join(outputDir, "async.txt"), "w", encoding="utf-8") as w:
+                startTime = time.perf_counter()
+                await get_tags_async.readTags(client, f, w, config["concurrency"])
+                return time.perf_counter() - startTime
+
+    elapsed = asyncio.run(run())
+    return {"tags": len(latencies), "seconds": elapsed, "latencies": latencies}
+
+def runSubscriptionReader(url, tagFile, outputDir, config):
+    """
+    Subscribe to every tag for durationInSec. Latency is the time between the SourceTimestamp set by
+    the server and the notification reaching the handler (both processes share the same clock).
+    The tags are split across subscriptions as gettags_subscription.py does (maxItemsPerSubscription,
+    samplingIntervals given to the tags in turn), the latency is also reported per subscription.
+    """
+    import gettags_subscription
+    from resultwriters import createResultWriter
+
+    latencies = []
+    opcua_client = gettags_subscription.opcUaClient(url)
+    resultWriter = createResultWriter("binary", os.path.join(outputDir, "subscription.bin"))
+    try:
+        with open(tagFile) as tagList:
+            arrayNodes = opcua_client.getArrayNodesFromOpcServer(tagList, resultWriter)
+        notificationWriter = gettags_subscription.NotificationWriter(resultWriter, config["queueSize"], 1000, 1)
+        push = notificationWriter.push
+        def timedPush(node, dataValue):
+            if dataValue.SourceTimestamp is not None:
+                latencies.append((datetime.utcnow() - dataValue.SourceTimestamp).total_seconds())
+            return push(node, dataValue)
+        notificationWriter.push = timedPush
+        notificationWriter.start()
+
+        samplingIntervals = None
+        if config["samplingIntervals"]:
+            samplingIntervals = dict((node.nodeid, config["samplingIntervals"][i % len(config["samplingIntervals"])]) for i, node in enumerate(arrayNodes))
+        shards = gettags_subscription.planSubscriptionShards(arrayNodes, config["publishingIntervalInSec"], config["maxItemsPerSubscription"], samplingIntervals,
+                                                             publishRequests=config["publishRequests"])
+        subscriptions = gettags_subscription.createSubscriptions(opcua_client.session, resultWriter, shards, notificationWriter, None, arrayNodes, config["chunkSize"], 0)
+        subscriptionLatencies = []
+        for subscription in subscriptions:
+            subscriptionLatencies.append(timeNotifications(subscription.handler))
+        startTime = time.perf_counter()
+        time.sleep(config["durationInSec"])
+        elapsed = time.perf_counter() - startTime
+        subscriptionStatistics = []
+        for subscription, shardLatencies in zip(subscriptions, subscriptionLatencies):
+            statistics = subscription.getStatistics()
+            shardLatencies = sorted(shardLatencies)
+            statistics["p50LatencyMs"] = None if not shardLatencies else round(percentile(shardLatencies, 50) * 1000, 3)
+            statistics["p99LatencyMs"] = None if not shardLatencies else round(percentile(shardLatencies, 99) * 1000, 3)
+            subscriptionStatistics.append(statistics)
+            subscription.close_Subscription()
+        notificationWriter.stop()
+        statistics = notificationWriter.getStatistics()
+    finally:
+        resultWriter.close()
+        opcua_client.session.disconnect()
+    return {"tags": len(arrayNodes), "notifications": statistics["enqueued"] + statistics["dropped"],
+            "notificationsDropped": statistics["dropped"], "maxQueueDepth": statistics["maxQueueDepth"],
+            "seconds": elapsed, "latencies": latencies, "subscriptions": subscriptionStatistics}
+
+def timeNotifications(handler):
+    """ Wrap the datachange_notification of a subscription handler, returns the list its latencies (seconds) are appended to. """
+    latencies = []
+    notify = handler.datachange_notification
+    def timedNotify(node, val, data):
+        sourceTimestamp = data.monitored_item.Value.SourceTimestamp
+        if sourceTimestamp is not None:
+            latencies.append((datetime.utcnow() - sourceTimestamp).total_seconds())
+        return notify(node, val, data)
+    handler.datachange_notification = timedNotify
+    return latencies
+
+def runConnectReader(url, tagFile, outputDir, config):
+    """
+    Startup time of opcUaClient with an empty metadata cache (cold) and then with the cache
+    written by the first connect (warm). The browse names of the tags are resolved in between.
+    """
+    import gettags_improvement
+
+    cacheDir = os.path.join(outputDir, "metadata")
+    startTime = time.perf_counter()
+    opcua_client = gettags_improvement.opcUaClient(url, cacheDir)
+    coldStartupTime = time.perf_counter() - startTime
+    try:
+        with open(tagFile) as tagList:
+            arrayNodes = list(gettags_improvement.iterNodes(opcua_client.session, gettags_improvement.iterTags(tagList), opcua_client.nodeIdCache))
+        for chunkNodes in gettags_improvement.batch(arrayNodes, config["chunkSize"]):
+            opcua_client.metadata.getBrowseNames(chunkNodes)
+    finally:
+        opcua_client.disconnect()
+
+    startTime = time.perf_counter()
+    opcua_client = gettags_improvement.opcUaClient(url, cacheDir)
+    warmStartupTime = time.perf_counter() - startTime
+    cacheHit = opcua_client.metadata.cacheHit
+    opcua_client.disconnect()
+    return {"tags": len(arrayNodes), "seconds": coldStartupTime + warmStartupTime, "latencies": [],
+            "coldStartupSec": round(coldStartupTime, 3), "warmStartupSec": round(warmStartupTime, 3), "warmCacheHit": cacheHit}
+
+def runReader(reader, url, tagFile, config, results):
+    """ Process target: run one reader and put its summary into the results queue. """
+    if config["quiet"]:
+        sys.stdout = open(os.devnull, "w")  # the readers print every value
+    with tempfile.TemporaryDirectory() as outputDir:
+        try:
+            if reader == "async":
+                run = runAsyncReader(url, tagFile, outputDir, config)
+            elif reader == "subscription":
+                run = runSubscriptionReader(url, tagFile, outputDir, config)
+            elif reader == "connect":
+                run = runConnectReader(url, tagFile, outputDir, config)
+            else:
+                run = runOneShotReader(reader, url, tagFile, outputDir, config)
+        except Exception as e:
+            results.put({"reader": reader, "error": repr(e)})
+            return
+
+    latencies = sorted(run.pop("latencies"))
+    summary = {"reader": reader}
+    summary.update(run)
+    if reader == "subscription":
+        summary["notificationsPerSec"] = round(run["notifications"] / run["seconds"], 1)
+    else:
+        summary["tagsPerSec"] = round(run["tags"] / run["seconds"], 1)
+    summary["seconds"] = round(run["seconds"], 3)
+    summary["latencySamples"] = len(latencies)
+    summary["p50LatencyMs"] = None if not latencies else round(percentile(latencies, 50) * 1000, 3)
+    summary["p99LatencyMs"] = None if not latencies else round(percentile(latencies, 99) * 1000, 3)
+    summary["peakRssKB"] = peakRssKB()
+    results.put(summary)
+
+def runBenchmark(config):
+    """ Start the simulated server, run every reader in its own process and return the results. """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        tagFile = os.path.join(directory, "taglist.txt")
+        with open(tagFile, "w") as f:
+            f.write("\n".join(simulatedTagIds(config["tags"])) + "\n")
+
+        with SimulatedServer(config["tags"], config["dataTypes"], config["updateRateInSec"], config["port"]) as server:
+            for reader in config["readers"]:
+                queue = multiprocessing.Queue()
+                process = multiprocessing.Process(target=runReader, args=(reader, server.url, tagFile, config, queue))
+                process.start()
+                try:
+                    summary = queue.get(timeout=config["timeoutInSec"])
+                except Exception:
+                    summary = {"reader": reader, "error": "timeout"}
+                process.join(10)
+                if process.is_alive():
+                    process.terminate()
+                print(json.dumps(summary), file=sys.stderr)
+                results.append(summary)
+
+    return {"date": datetime.utcnow().isoformat('T') + "Z", "config": config, "results": results}
+
+def compareResults(current, previous):
+    """ Print the change of throughput and latency of every reader against a previous run. """
+    previousByReader = dict((r["reader"], r) for r in previous["results"])
+    for result in current["results"]:
+        old = previousByReader.get(result["reader"])
+        if old is None or "error" in result or "error" in old:
+            continue
+        line = result["reader"].ljust(14)
+        for key in ("tagsPerSec", "notificationsPerSec", "p50LatencyMs", "p99LatencyMs", "peakRssKB", "coldStartupSec", "warmStartupSec"):
+            if result.get(key) and old.get(key):
+                line += " %s %+.1f%%" % (key, (result[key] - old[key]) * 100.0 / old[key])
+        print(line)
+
+def getParameters(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Benchmark the tag readers against a simulated OPC UA server")
+    parser.add_argument("--tags", type=int, default=1000, help="number of simulated variables")
+    parser.add_argument("--data-types", default=",".join(DATA_TYPES), help="comma separated list of: " + ", ".join(DATA_TYPES))
+    parser.add_argument("--update-rate", type=float, default=1.0, help="seconds between value changes, 0 for static values")
+    parser.add_argument("--readers", default=",".join(READERS), help="comma separated list of: " + ", ".join(READERS))
+    parser.add_argument("--chunk-size", type=int, default=1000, help="ReadValueIds per Read request / items per subscription batch")
+    parser.add_argument("--concurrency", type=int, default=50, help="requests in flight for the async reader")
+    parser.add_argument("--requests-in-flight", type=int, default=8, help="max Read requests in flight for the adaptive reader")
+    parser.add_argument("--duration", type=float, default=10, help="seconds the subscription reader listens")
+    parser.add_argument("--publishing-interval", type=float, default=1, help="subscription publishing interval in seconds")
+    parser.add_argument("--queue-size", type=int, default=100000, help="notification queue size of the subscription reader")
+    parser.add_argument("--max-items-per-subscription", type=int, default=5000, help="monitored items per subscription, more tags use several subscriptions")
+    parser.add_argument("--sampling-intervals", default="", help="comma separated sampling intervals in seconds given to the tags in turn (one subscription group each)")
+    parser.add_argument("--publish-requests", type=int, default=2, help="Publish requests kept waiting on the server per subscription (2: the ones python-opcua sends)")
+    parser.add_argument("--port", type=int, default=48400)
+    parser.add_argument("--timeout", type=float, default=600, help="max seconds per reader")
+    parser.add_argument("--verbose", action="store_true", help="keep the per-value console output of the readers")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare with")
+    args = parser.parse_args(argv)
+
+    d = dict()
+    d['tags'] = args.tags
+    d['dataTypes'] = [t for t in args.data_types.split(",") if t]
+    d['updateRateInSec'] = args.update_rate
+    d['readers'] = [r for r in args.readers.split(",") if r]
+    d['chunkSize'] = args.chunk_size
+    d['concurrency'] = args.concurrency
+    d['requestsInFlight'] = args.requests_in_flight
+    d['durationInSec'] = args.duration
+    d['publishingIntervalInSec'] = args.publishing_interval
+    d['queueSize'] = args.queue_size
+    d['maxItemsPerSubscription'] = args.max_items_per_subscription
+    d['samplingIntervals'] = [float(x) for x in args.sampling_intervals.split(",") if x]
+    d['publishRequests'] = args.publish_requests
+    d['port'] = args.port
+    d['timeoutInSec'] = args.timeout
+    d['quiet'] = not args.verbose
+    return d, args.output, args.compare
+
+def main(argv=None, prog=None):
+    config, outputFile, compareFile = getParameters(argv, prog)
+    for dataType in config["dataTypes"]:
+        if dataType not in DATA_TYPES:
+            sys.exit("Unknown data type: " + dataType)
+    for reader in config["readers"]:
+        if reader not in READERS:
+            sys.exit("Unknown reader: " + reader)
+
+    current = runBenchmark(config)
+    print(json.dumps(current, indent=2))
+    if outputFile:
+        with open(outputFile, "w") as f:
+            json.dump(current, f, indent=2)
+    if compareFile:
+        with open(compareFile) as f:
+            compareResults(current, json.load(f))
+
+if __name__ == "__main__":
+    main()
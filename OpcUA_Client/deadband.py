@@ -0,0 +1,220 @@
+import csv
+import logging
+import time
+
+from array import array
+from opcua import ua
+
+logger = logging.getLogger(__name__)
+
+# Deadband and report-by-exception filtering.
+# A value is written only when it moved more than its deadband since the last written
+# value, when its StatusCode changed, or when nothing was written for maxSilenceInSec
+# (heartbeat). Deadbands are set per tag:
+#   absolute: |value - last| must be greater than absoluteDeadband
+#   percent:  |value - last| must be greater than percentDeadband % of the EU range
+#             (EURange property of the tag, read when the filter is built; a tag without
+#             one has no percent deadband, as the server would reject it too)
+# A tag with both deadbands uses the larger of the two.
+# Subscriptions also ask the server to apply the deadband (DataChangeFilter) so the
+# filtered values are not even sent; the client side filter is always applied as well.
+# A subscription gets nothing while a tag does not change: its heartbeats come from a
+# timer calling heartbeat() (see HeartbeatTimer in gettags_subscription.py).
+#
+# Deadband file (optional): CSV lines "tag,absoluteDeadband,percentDeadband,maxSilenceInSec"
+#     ns=2;s=0:FIC-31-0114:Z.X.Value,0.5,0,300
+
+NEVER_REPORTED = 0
+NUMERIC = 1
+HASHED = 2
+
+class DeadbandFilter(object):
+    """
+    Compare-to-last-value filter keyed by node index (0 .. size-1).
+    The last written value of each node is kept in flat arrays, numeric values as doubles
+    and any other value as a hash, so memory is a few dozen bytes per node.
+    """
+    def __init__(self, size, absoluteDeadband=0.0, percentDeadband=0.0, maxSilenceInSec=0.0):
+        self.size = size
+        self.absoluteDeadbands = array('d', [absoluteDeadband]) * size
+        self.percentDeadbands = array('d', [percentDeadband]) * size
+        self.maxSilences = array('d', [maxSilenceInSec]) * size
+        self.euSpans = array('d', [0.0]) * size
+        self.lastValues = array('d', [0.0]) * size
+        self.lastHashes = array('q', [0]) * size
+        self.lastStatusCodes = array('L', [0]) * size
+        self.lastReportTimes = array('d', [0.0]) * size
+        self.states = bytearray(size)
+        self.reportedCount = 0
+        self.suppressedCount = 0
+        self.heartbeatCount = 0
+
+    def configure(self, index, absoluteDeadband, percentDeadband, maxSilenceInSec):
+        self.absoluteDeadbands[index] = absoluteDeadband
+        self.percentDeadbands[index] = percentDeadband
+        self.maxSilences[index] = maxSilenceInSec
+
+    def setEURange(self, index, low, high):
+        self.euSpans[index] = abs(high - low)
+
+    def getDeadband(self, index):
+        """ Deadband of the node in engineering units: the larger of the absolute and the percent one. """
+        return max(self.absoluteDeadbands[index], self.euSpans[index] * self.percentDeadbands[index] / 100.0)
+
+    def isReportable(self, index, value, statusCode, now=None):
+        """ True if the value has to be written. The value is then remembered as the last written one. """
+        if now is None:
+            now = time.monotonic()
+        state = self.states[index]
+        isNumeric = isinstance(value, (int, float)) and not isinstance(value, bool)
+
+        report = state == NEVER_REPORTED or statusCode != self.lastStatusCodes[index]
+        if not report and self.maxSilences[index] > 0 and now - self.lastReportTimes[index] >= self.maxSilences[index]:
+            report = True
+        if not report:
+            if isNumeric and state == NUMERIC:
+                report = abs(value - self.lastValues[index]) > self.getDeadband(index)
+            elif not isNumeric and state == HASHED:
+                report = valueHash(value) != self.lastHashes[index]
+            else:
+                report = True  # the type of the value changed
+
+        if not report:
+            self.suppressedCount += 1
+            return False
+
+        if isNumeric:
+            self.states[index] = NUMERIC
+            self.lastValues[index] = value
+        else:
+            self.states[index] = HASHED
+            self.lastHashes[index] = valueHash(value)
+        self.lastStatusCodes[index] = statusCode
+        self.lastReportTimes[index] = now
+        self.reportedCount += 1
+        return True
+
+    def heartbeat(self, index, now=None):
+        """
+        True if the node has a heartbeat, was written once and nothing was written for its maxSilenceInSec:
+        its last value has to be written again, which counts as a write.
+        """
+        if now is None:
+            now = time.monotonic()
+        maxSilence = self.maxSilences[index]
+        if maxSilence <= 0 or self.states[index] == NEVER_REPORTED or now - self.lastReportTimes[index] < maxSilence:
+            return False
+        self.lastReportTimes[index] = now
+        self.heartbeatCount += 1
+        return True
+
+    def getStatistics(self):
+        d = dict()
+        d['reported'] = self.reportedCount
+        d['suppressed'] = self.suppressedCount
+        d['heartbeats'] = self.heartbeatCount
+        return d
+
+def valueHash(value):
+    try:
+        return hash(value)
+    except TypeError:  # lists, extension objects...
+        return hash(str(value))
+
+def loadDeadbandFile(fileName):
+    """ Returns a dict NodeId -> (absoluteDeadband, percentDeadband, maxSilenceInSec). """
+    perTagDeadbands = dict()
+    with open(fileName, newline="") as f:
+        for row in csv.reader(f):
+            if not row or not row[0].strip() or row[0].startswith("#"):
+                continue
+            # The NodeId itself may contain commas, the three numbers are always the last columns
+            tag = ",".join(row[:-3]).strip()
+            absoluteDeadband, percentDeadband, maxSilenceInSec = (float(x or 0) for x in row[-3:])
+            perTagDeadbands[ua.NodeId.from_string(tag)] = (absoluteDeadband, percentDeadband, maxSilenceInSec)
+    return perTagDeadbands
+
+def createDeadbandFilter(nodes, absoluteDeadband=0.0, percentDeadband=0.0, maxSilenceInSec=0.0, perTagDeadbands=None, session=None):
+    """
+    Filter for the nodes (node index = position in nodes) with the default deadbands,
+    overridden by perTagDeadbands (see loadDeadbandFile).
+    The EU ranges of the tags with a percent deadband are read from the session.
+    Returns None when no deadband nor heartbeat is configured at all.
+    """
+    if not perTagDeadbands and absoluteDeadband <= 0 and percentDeadband <= 0 and maxSilenceInSec <= 0:
+        return None
+    deadbandFilter = DeadbandFilter(len(nodes), absoluteDeadband, percentDeadband, maxSilenceInSec)
+    if perTagDeadbands:
+        for index, node in enumerate(nodes):
+            deadbands = perTagDeadbands.get(node.nodeid)
+            if deadbands is not None:
+                deadbandFilter.configure(index, *deadbands)
+    indexes = [index for index in range(deadbandFilter.size) if deadbandFilter.percentDeadbands[index] > 0]
+    if indexes:
+        found = readEURanges(session, nodes, indexes, deadbandFilter) if session is not None else 0
+        if found < len(indexes):
+            logger.warning("%d of %d tags with a percent deadband have no EU range, their percent deadband is ignored",
+                           len(indexes) - found, len(indexes))
+    return deadbandFilter
+
+def readEURanges(session, nodes, indexes, deadbandFilter, batchSize=1000):
+    """
+    Set the EU range of the nodes at the indexes from their EURange property: one
+    TranslateBrowsePathsToNodeIds and one Read request per batch of nodes.
+    Returns the number of nodes with an EU range.
+    """
+    found = 0
+    for start in range(0, len(indexes), batchSize):
+        batchIndexes = indexes[start:start + batchSize]
+        browsePaths = []
+        for index in batchIndexes:
+            element = ua.RelativePathElement()
+            element.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HasProperty)
+            element.IsInverse = False
+            element.TargetName = ua.QualifiedName("EURange", 0)
+            browsePath = ua.BrowsePath()
+            browsePath.StartingNode = nodes[index].nodeid
+            browsePath.RelativePath.Elements.append(element)
+            browsePaths.append(browsePath)
+        try:
+            pathResults = session.uaclient.translate_browsepaths_to_nodeids(browsePaths)
+        except Exception as e:
+            logger.warning("EURange properties not found: %s", e)
+            continue
+
+        params = ua.ReadParameters()
+        propertyIndexes = []
+        for index, pathResult in zip(batchIndexes, pathResults):
+            if pathResult.StatusCode.is_good() and pathResult.Targets:
+                readValueId = ua.ReadValueId()
+                readValueId.NodeId = pathResult.Targets[0].TargetId
+                readValueId.AttributeId = ua.AttributeIds.Value
+                params.NodesToRead.append(readValueId)
+                propertyIndexes.append(index)
+        if not propertyIndexes:
+            continue
+        try:
+            dataValues = session.uaclient.read(params)
+        except Exception as e:
+            logger.warning("EURange properties not read: %s", e)
+            continue
+        for index, dataValue in zip(propertyIndexes, dataValues):
+            euRange = dataValue.Value.Value if dataValue.StatusCode.is_good() and dataValue.Value is not None else None
+            if isinstance(euRange, ua.Range) and euRange.High != euRange.Low:
+                deadbandFilter.setEURange(index, euRange.Low, euRange.High)
+                found += 1
+    return found
+
+def makeDataChangeFilter(deadband):
+    """
+    Server side deadband for a monitored item, None if the tag has no deadband.
+    deadband is DeadbandFilter.getDeadband, so the server applies the same threshold as the
+    client side filter, the percent part included (a Percent filter could only carry one of them).
+    """
+    if deadband <= 0:
+        return None
+    dataChangeFilter = ua.DataChangeFilter()
+    dataChangeFilter.Trigger = ua.DataChangeTrigger.StatusValue
+    dataChangeFilter.DeadbandType = ua.DeadbandType.Absolute
+    dataChangeFilter.DeadbandValue = deadband
+    return dataChangeFilter
@@ -2,6 +2,102 @@ import asyncio
 import sys
 sys.path.insert(0, "..")
 from asyncua import Client, Node, ua
+import metrics
+
+DEFAULT_MAX_CONCURRENT_READS = 50 # Max Read requests in flight at the same time
+WRITER_BATCH_SIZE = 500 # Lines written to the result file in one go
+READ_AHEAD_PER_READ = 4 # Tags read ahead of the next line to write, per concurrent read: bounds the reorder buffer
+
+async def readTag(client, tag):
+    # One Read request for both attributes instead of one round trip per attribute
+    try:
+        var = client.get_node(tag)
+        browseNameValue, dataValue = await var.read_attributes([ua.AttributeIds.BrowseName, ua.AttributeIds.Value])
+    except Exception:
+        return tag + ",Cannot read tag from source"
+
+    if browseNameValue.StatusCode.is_good():
+        name = browseNameValue.Value.Value.Name
+    else:
+        name = "Error reading name"
+    if dataValue.StatusCode.is_good():
+        val = str(dataValue.Value.Value)
+    else:
+        val = "Error reading value"
+    if dataValue.SourceTimestamp is not None:
+        timestamp = dataValue.SourceTimestamp.isoformat('T')+"Z"
+    else:
+        timestamp = "Error reading timestamp"
+    return tag + "," + name + "," + val + "," + timestamp
+
+async def readWorker(client, tagQueue, resultQueue):
+    while True:
+        item = await tagQueue.get()
+        if item is None:
+            return
+        index, tag = item
+        line = await readTag(client, tag)
+        await resultQueue.put((index, line))
+
+async def resultWriter(w, resultQueue, readAhead):
+    """
+    Write the lines in the same order as the tag list.
+    Lines which arrive before their turn wait in a small reorder buffer, kept small by readAhead:
+    a tag is only given to the workers after acquiring it, and it is released here when its line is written.
+    The file writes run in the default executor so they never block the readers.
+    """
+    loop = asyncio.get_running_loop()
+    pending = dict()
+    nextIndex = 0
+    lines = []
+    while True:
+        item = await resultQueue.get()
+        if item is None:
+            break
+        index, line = item
+        pending[index] = line
+        while nextIndex in pending:
+            line = pending.pop(nextIndex)
+            metrics.debugPrint(line)
+            lines.append(line + "\n")
+            nextIndex += 1
+            readAhead.release()
+        if len(lines) >= WRITER_BATCH_SIZE:
+            await loop.run_in_executor(None, w.writelines, lines)
+            lines = []
+    if lines:
+        await loop.run_in_executor(None, w.writelines, lines)
+
+async def readTags(client, f, w, maxConcurrentReads):
+    tagQueue = asyncio.Queue(maxsize=maxConcurrentReads * 2)
+    resultQueue = asyncio.Queue(maxsize=maxConcurrentReads * 2)
+    # At most this many tags between the next line to write and the last tag given to the workers,
+    # so a slow tag cannot make the lines read after it pile up in memory
+    readAhead = asyncio.Semaphore(maxConcurrentReads * READ_AHEAD_PER_READ)
+    writer = asyncio.create_task(resultWriter(w, resultQueue, readAhead))
+    workers = [asyncio.create_task(readWorker(client, tagQueue, resultQueue)) for _ in range(maxConcurrentReads)]
+
+    async def feedTags():
+        index = 0
+        for x in f:
+            await readAhead.acquire()
+            await tagQueue.put((index, x.strip()))
+            index += 1
+        for _ in workers:
+            await tagQueue.put(None)
+        await asyncio.gather(*workers)
+        await resultQueue.put(None)
+
+    # If the writer fails, nothing empties the bounded queues any more: stop the readers instead of waiting forever
+    feeder = asyncio.create_task(feedTags())
+    await asyncio.wait([feeder, writer], return_when=asyncio.FIRST_EXCEPTION)
+    if not feeder.done() or not writer.done():
+        for task in [feeder, writer] + workers:
+            task.cancel()
+        await asyncio.gather(feeder, writer, *workers, return_exceptions=True)
+    for task in (writer, feeder):
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
 
 async def main():
      #local run
@@ -10,45 +106,26 @@ async def main():
     # url = r"opc.tcp://KPC22014549:21381/MatrikonOpcUaWrapper"
 
     #Client run with arguments
-    if len(sys.argv) != 4:
-        print("Syntax: " , sys.argv[0], "[OpcUaUrl]", "[Inputfile]", "[Outputfile]")
+    if len(sys.argv) != 4 and len(sys.argv) != 5:
+        print("Syntax: " , sys.argv[0], "[OpcUaUrl]", "[Inputfile]", "[Outputfile]", "[MaxConcurrentReads]")
         sys.exit(-1)
-        
+
     url = sys.argv[1]
     filename = sys.argv[2]
     outfile =  sys.argv[3]
+    maxConcurrentReads = DEFAULT_MAX_CONCURRENT_READS
+    if len(sys.argv) == 5:
+        maxConcurrentReads = max(1, int(sys.argv[4]))
 
     async with Client(url=url) as client:
         try:
             f = open(filename, "r")
             w = open(outfile, "w", encoding="utf-8")
-            for x in f:
-                tag=x.strip()
-                try:
-                    var = client.get_node(tag)
-                    try:
-                        name = (await var.get_browse_name()).Name
-                    except:
-                        name = "Error reading name"
-                    try:
-                        val =  str(await var.get_value())
-                    except:
-                        val = "Error reading value"
-                    try:
-                        timestamp = (await var.get_data_value()).SourceTimestamp.isoformat('T')+"Z"
-                    except:
-                        timestamp = "Error reading timestamp"
-                    line = tag + "," + name + "," + val + "," + timestamp
-                except:
-                    line = tag + ",Cannot read tag from source"
-                w.write(line)
-                w.write("\n")
-                print(line)
+            await readTags(client, f, w, maxConcurrentReads)
         finally:
             f.close()
             w.close()
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
-    loop.set_debug(True)
     loop.run_until_complete(main())
     loop.close()
\ No newline at end of file
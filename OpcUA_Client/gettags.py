@@ -3,33 +3,33 @@ sys.path.insert(0, "..")
 
 
 from opcua import Client
+from opcua import ua
+import metrics
+from resultwriters import createResultWriter
+from tagencoder import ScanRecord, recordFromDataValue
+from servermetadata import ServerMetadata
 
 
 if __name__ == "__main__":
-    #local run
-    client = Client("opc.tcp://KPC22014549:21381/MatrikonOpcUaWrapper")
-    filename = r"C:\Users\sergioc\OneDrive - KONGSBERG MARITIME AS\Projects\Edge Gateway for Shell\Trond app to read tags unit measures\Taglist.txt"
-    outfile =  r"C:\Users\sergioc\OneDrive - KONGSBERG MARITIME AS\Projects\Edge Gateway for Shell\Trond app to read tags unit measures\resultTagList.txt"
-    
     #Client run with arguments
-    # if len(sys.argv) != 4:
-    #     print("Syntax: " , sys.argv[0], "[OpcUaUrl]", "[Inputfile]", "[Outputfile]")
-    #     sys.exit(-1)
+    if len(sys.argv) != 4:
+        print("Syntax: " , sys.argv[0], "[OpcUaUrl]", "[Inputfile]", "[Outputfile]")
+        sys.exit(-1)
         
-    # url = sys.argv[1]
-    # filename = sys.argv[2]
-    # outfile =  sys.argv[3]
-    # client = Client(url)
+    url = sys.argv[1]
+    filename = sys.argv[2]
+    outfile =  sys.argv[3]
+    client = Client(url)
+    outputFormat = "text" # text (original format), csv, binary or parquet; the tagid of the records is the tag from the file
+    metrics.setDebugPrint(False) # True prints every value (at most 10 lines per second)
     
+    metadata = f = w = None
     try:
         client.connect()
+        metadata = ServerMetadata(client, client.server_url.geturl())  # browse names already read are kept in a local cache
+        metadata.loadTypeDefinitions()
         f = open(filename, "r")
-        w = open(outfile, "w")
-        error = False
-        message = "Tag from file  ,\t Tagid  ,\t BrowseName ,\t Value ,\t StatusCode ,\t Timestamp ,\t Variant value ,\t Error messages"
-                   
-        w.write(message)
-        w.write("\n")
+        w = createResultWriter(outputFormat, outfile, gettagsLayout=True)
         
         for x in f:
             tag=x.strip()
@@ -38,74 +38,39 @@ if __name__ == "__main__":
                 
                 message = ""
 
-                #1st Read the whole variant Value of the tag
-                try:               
-                    browseName = var.get_browse_name().Name
-                except:
-                    error = True
-                    browseName = ""
+                #1st Read the BrowseName of the tag ("" when it cannot be read)
+                browseName = metadata.getBrowseNames([var])[0]
+                if not browseName:
                     message = message + ",\t error trying to read the name from the tag. "
-                
-                #2nd Read the tagId of the tag
-                try:               
-                    tagid = var.nodeid.Identifier
-                except:
-                    error = True
-                    tagid = ""
-                    message = message + ",\t error trying to read the tagId from the tag. "
 
-                #3rd Read the DataValue of the tag
+                #2nd Read the DataValue of the tag (Value, StatusCode and SourceTimestamp)
                 try:               
-                    dataValue = var.get_data_value()                                
-                except:
-                    error = True
-                    dataValue = ""
-                    message = message + ",\t error trying to get the DataValue from the tag. "                               
-                
-                #4th Read the whole variant Value of the tag
-                try:               
-                    variantValue = str(dataValue.Value)
-                except Exception as e:
-                    error = True
-                    variantValue = ". Error message: "  + str(e)
-                    message = message + ",\t error trying to read the variant value from the tag. "
-
-                #5th Read the Value of the tag
-                try:               
-                    value = str(dataValue.Value.Value)
-                except Exception as e:
-                    error = True
-                    value = ". Error message: "  + str(e)
-                    message = message + ",\t error trying to read the value from the tag. "
-
-                #6th Read the StatusCode of the tag
-                try:               
-                    statusCode = str(dataValue.StatusCode)
-                except Exception as e:
-                    error = True
-                    statusCode = ". Error message: "  + str(e)
-                    message = message + ",\t error trying to read the statusCode from the tag. "
-
-                #7th Read the timeStampt of the tag
-                try:               
-                    timestamp =dataValue.SourceTimestamp.isoformat('T')+"Z"
-                except Exception as e:
-                    error = True
-                    timestamp = ". Error message: "  + str(e)
-                    message = message + ",\t error trying to read the SourceTimestamp from the tag. "  
-
+                    record = recordFromDataValue(var, var.get_data_value(), browseName)._replace(tagid=tag)
+                except ua.UaStatusCodeError as e:
+                    record = ScanRecord(tag, browseName, None, ua.VariantType.Null.value, e.code, None, "")
+                    message = message + ",\t error trying to get the DataValue from the tag. "
 
-                if error:
-                    message = tag + " ,\t " + tagid + " ,\t " + browseName + " ,\t " + value + " ,\t " + statusCode + " ,\t " + timestamp + ",\t Whole variant value: " + variantValue + ",\t Error message: " + message + " ."
-                else:
-                    message = tag + " ,\t " + tagid + " ,\t " + browseName + " ,\t " + value + " ,\t " + statusCode + " ,\t " + timestamp + ",\t Whole variant value: " + variantValue + " ."
+                if message:
+                    record = record._replace(errorMessage=message)
 
             except Exception as e: 
                 message = tag + " ,\t Cannot read tag from source. Error message: "  + str(e)
+                w.writeMessage(message)
+                print(message)
+                continue
 
-            line = message
-            w.write(line)
-            w.write("\n")
-            print(line)
+            w.writeRecord(record)
+            metrics.debugPrint(record)
     finally:
-        client.disconnect()
\ No newline at end of file
+        try:
+            if metadata is not None:
+                metadata.save()
+        finally:
+            if f is not None:
+                f.close()
+            if w is not None:
+                w.close()
+            try:
+                client.disconnect()
+            except Exception:
+                pass # the connection failed or is already broken
\ No newline at end of file
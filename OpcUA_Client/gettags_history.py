@@ -0,0 +1,466 @@
+import sys
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from opcua import ua
+import metrics
+from gettags_improvement import opcUaClient
+from resultwriters import RESULT_FILE_EXTENSIONS, createResultWriter
+from tagencoder import encodeChunk, isBadStatusCode, tagidOf
+from tagstream import NodeIdCache, iterTags, iterNodes
+
+# Backfill of the values archived by the server (HistoryRead, raw values) for a tag list
+# and a time range, to fill the gap left by a collector outage.
+# The time range is split into windows of windowSizeInSec and the tag list into batches of
+# nodesPerRequest nodes. Every (window, batch) pair is one unit of work: HistoryReadRawModified
+# requests for the nodes of the batch, following the continuation points until every node
+# has returned all its values of the window. Up to `concurrency` units run at the same time
+# on the one session, their records are written with the same result writers as the live
+# readers (so records of different windows are interleaved in the file).
+#
+# The values of a unit are kept in memory and written when all its nodes are read, so a unit
+# is written once or not at all (memory: nodesPerRequest nodes x the values of one window).
+# Checkpoint: every unit written (and flushed) is appended to the checkpoint file. Running
+# the same command again skips the units already done, so an interrupted backfill goes on
+# where it stopped. A unit whose HistoryRead fails, or where a node returned a transient Bad
+# status, is read again from its start unitRetries times, waiting longer each time; a unit
+# which still fails is not put in the checkpoint and is read again by the next run.
+# A node with a Bad status which will not change (TERMINAL_STATUS_CODES: no history, unknown
+# node...) gets a message in the result file and counts as read.
+#
+# StartTime and EndTime are UTC, ISO 8601: 2024-03-01T00:00:00. Without EndTime the backfill
+# goes up to now, give it explicitly to be able to resume (the checkpoint is for one time range).
+
+DEFAULT_WINDOW_SIZE_IN_SEC = 3600
+DEFAULT_NODES_PER_REQUEST = 100 # When the server does not report MaxNodesPerHistoryReadData
+DEFAULT_MAX_VALUES_PER_NODE = 1000 # Values per node returned in one response, the rest comes through continuation points
+DEFAULT_CONCURRENCY = 4
+DEFAULT_UNIT_RETRIES = 3 # Attempts after the first one when a HistoryRead of a unit fails
+RETRY_DELAY_IN_SEC = 1 # Wait before the first retry of a unit, doubled at every retry
+CHECKPOINT_VERSION = 1
+# Bad statuses of a node which a new HistoryRead will not change: the node is done for the unit
+TERMINAL_STATUS_CODES = set([ua.StatusCodes.BadNoData, ua.StatusCodes.BadHistoryOperationUnsupported, ua.StatusCodes.BadHistoryOperationInvalid,
+                             ua.StatusCodes.BadNodeIdUnknown, ua.StatusCodes.BadNodeIdInvalid, ua.StatusCodes.BadNotReadable,
+                             ua.StatusCodes.BadUserAccessDenied])
+
+HISTORY_READ_LATENCY = metrics.histogram("opcua_history_read_request_seconds", "Round trip time of the HistoryRead requests")
+HISTORY_READ_REQUESTS = metrics.counter("opcua_history_read_requests_total", "HistoryRead requests sent")
+HISTORY_VALUES_READ = metrics.counter("opcua_history_values_read_total", "Historical values read")
+HISTORY_UNITS_DONE = metrics.counter("opcua_history_units_done_total", "Backfill units (window, batch of nodes) written")
+HISTORY_UNITS_FAILED = metrics.counter("opcua_history_units_failed_total", "Backfill units left for the next run (error or Bad results)")
+
+now = datetime.now()
+current_time = now.strftime("_%Y_%m_%d_%H_%M_%S")
+
+def getParameters():
+
+        if len(sys.argv) < 5 or len(sys.argv) > 6:
+            print("Syntax: " , sys.argv[0], "[OpcUaUrl]", "[Inputfile]", "[OutputfileName]", "[StartTime]", "[EndTime]")
+            sys.exit(-1)
+
+        url = sys.argv[1]
+        filename = sys.argv[2]
+        outputFormat = "binary" # text, csv, binary or parquet
+        outfile = sys.argv[3] + current_time + RESULT_FILE_EXTENSIONS[outputFormat]
+        startTime = parseUtcTime(sys.argv[4])
+        endTime = parseUtcTime(sys.argv[5]) if len(sys.argv) > 5 else datetime.utcnow()
+
+        d = dict();
+        d['opcServerUrl'] = url
+        d['taglist_file'] = open(filename, "r")
+        d['result_writer'] = createResultWriter(outputFormat, outfile)
+        d['startTime'] = startTime
+        d['endTime'] = endTime
+        d['checkpointFile'] = sys.argv[3] + ".checkpoint" # Same name for every run of the backfill, so it can be resumed
+        d['windowSizeInSec'] = DEFAULT_WINDOW_SIZE_IN_SEC
+        d['nodesPerRequest'] = DEFAULT_NODES_PER_REQUEST
+        d['maxValuesPerNode'] = DEFAULT_MAX_VALUES_PER_NODE
+        d['concurrency'] = DEFAULT_CONCURRENCY # Units read at the same time
+        d['unitRetries'] = DEFAULT_UNIT_RETRIES # Retries of a unit whose HistoryRead fails, before leaving it for the next run
+        d['statusIntervalInSec'] = 60 # Time between two prints of the progress
+        d['metricsEnabled'] = None # Timers and counters (see metrics.py): None follows OPCUA_METRICS, True/False forces them on/off
+        d['metricsHttpPort'] = None # ex: 9108 to serve http://127.0.0.1:9108/metrics
+        d['metricsJsonFile'] = None # File where a JSON line of metrics is appended every metricsJsonIntervalInSec
+        d['metricsJsonIntervalInSec'] = 60
+
+        return d
+
+def parseUtcTime(text):
+    """ ISO 8601 time -> naive UTC datetime, like the SourceTimestamps. A time with "Z" or an offset is converted to UTC. """
+    text = text.strip()
+    if text.endswith("Z") or text.endswith("z"):
+        text = text[:-1] + "+00:00"
+    value = datetime.fromisoformat(text)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def splitTimeRange(startTime, endTime, windowSizeInSec):
+    """ List of (windowStart, windowEnd) covering startTime .. endTime, oldest first. """
+    windows = []
+    windowSize = timedelta(seconds=windowSizeInSec)
+    windowStart = startTime
+    while windowStart < endTime:
+        windowEnd = min(windowStart + windowSize, endTime)
+        windows.append((windowStart, windowEnd))
+        windowStart = windowEnd
+    return windows
+
+class HistoryUnitError(Exception):
+    """ A node of a unit returned a Bad status which may go away when the unit is read again. """
+
+class Checkpoint(object):
+    """
+    Append-only file of the units already written.
+    First line: the parameters of the backfill. Then one line per unit done: [windowIndex, batchIndex].
+    A checkpoint written for other parameters (tags, time range, window size...) is started again.
+    """
+    def __init__(self, fileName, key):
+        self.fileName = fileName
+        self.key = key
+        self.doneUnits = self.load()
+        self.file = None
+
+    def load(self):
+        try:
+            with open(self.fileName, "r") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return set()
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            header = None
+        if header != self.key:
+            print("Checkpoint", self.fileName, "was written for another backfill, starting from the beginning")
+            return set()
+        doneUnits = set()
+        for line in lines[1:]:
+            try:
+                windowIndex, batchIndex = json.loads(line)
+            except ValueError:
+                continue # last line cut by the interruption
+            doneUnits.add((windowIndex, batchIndex))
+        return doneUnits
+
+    def open(self):
+        if self.doneUnits:
+            self.file = open(self.fileName, "a")
+        else:
+            self.file = open(self.fileName, "w")
+            self.file.write(json.dumps(self.key) + "\n")
+            self.file.flush()
+
+    def isDone(self, unit):
+        return unit in self.doneUnits
+
+    def markDone(self, unit):
+        self.doneUnits.add(unit)
+        self.file.write(json.dumps(list(unit)) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+def checkpointKey(url, tagids, windows, nodesPerRequest):
+    """ Parameters which give the units of a backfill: a checkpoint is only valid for the same ones. """
+    d = dict()
+    d['version'] = CHECKPOINT_VERSION
+    d['url'] = url
+    d['tags'] = len(tagids)
+    d['tagsHash'] = hashlib.sha1("\n".join(tagids).encode("utf-8")).hexdigest()
+    d['startTime'] = windows[0][0].isoformat() if windows else ""
+    d['endTime'] = windows[-1][1].isoformat() if windows else ""
+    d['windows'] = len(windows)
+    d['nodesPerRequest'] = nodesPerRequest
+    return d
+
+class HistoryBackfill(object):
+    """
+    Read the raw history of nodes between startTime and endTime and write it with resultWriter.
+    run() returns True when every unit is done, False when stopped (stop() or Ctrl+C) before the end
+    or when some units failed.
+    """
+    def __init__(self, opcua_client, nodes, resultWriter, startTime, endTime, checkpointFile, windowSizeInSec=DEFAULT_WINDOW_SIZE_IN_SEC,
+                 nodesPerRequest=DEFAULT_NODES_PER_REQUEST, maxValuesPerNode=DEFAULT_MAX_VALUES_PER_NODE, concurrency=DEFAULT_CONCURRENCY,
+                 unitRetries=DEFAULT_UNIT_RETRIES):
+        self.opcua_client = opcua_client
+        self.nodes = nodes
+        self.tagids = [tagidOf(node) for node in nodes]
+        self.resultWriter = resultWriter
+        self.maxValuesPerNode = maxValuesPerNode
+        self.concurrency = max(1, concurrency)
+        self.nodesPerRequest = max(1, nodesPerRequest)
+        self.unitRetries = max(0, unitRetries)
+        self.windows = splitTimeRange(startTime, endTime, windowSizeInSec)
+        self.checkpoint = Checkpoint(checkpointFile, checkpointKey(opcua_client.session.server_url.geturl(), self.tagids, self.windows, self.nodesPerRequest))
+        self.writerLock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.statisticsLock = threading.Lock()
+        self.startTime = None
+
+        self.unitsTotal = len(self.windows) * ((len(nodes) + self.nodesPerRequest - 1) // self.nodesPerRequest)
+        self.unitsSkipped = 0
+        self.unitsDone = 0
+        self.unitsFailed = 0
+        self.retries = 0
+        self.requests = 0
+        self.continuationRequests = 0
+        self.valuesRead = 0
+        self.badResults = 0
+
+    def iterUnits(self):
+        """ (windowIndex, batchIndex) of the units still to do, oldest window first. """
+        batches = (len(self.nodes) + self.nodesPerRequest - 1) // self.nodesPerRequest
+        for windowIndex in range(len(self.windows)):
+            for batchIndex in range(batches):
+                unit = (windowIndex, batchIndex)
+                if self.checkpoint.isDone(unit):
+                    self.unitsSkipped += 1
+                else:
+                    yield unit
+
+    def run(self):
+        self.startTime = time.perf_counter()
+        self.checkpoint.open()
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="HistoryRead") as pool:
+                pending = set(pool.submit(self.readUnitWithRetries, unit) for unit in self.iterUnits())
+                try:
+                    while pending and not self.stopEvent.is_set():
+                        done, pending = wait(pending, timeout=1)
+                        for future in done:
+                            future.result() # the HistoryRead errors are handled by the unit, raise any other one here
+                except BaseException: # KeyboardInterrupt too: the units running stop cleanly before the pool is closed
+                    self.stop()
+                    for future in pending:
+                        future.cancel()
+                    raise
+        finally:
+            self.checkpoint.close()
+        return not self.stopEvent.is_set() and self.unitsDone + self.unitsSkipped == self.unitsTotal
+
+    def stop(self):
+        """ Units running finish their current request and release their continuation points. """
+        self.stopEvent.set()
+
+    def readUnitWithRetries(self, unit):
+        """ readUnit, tried again after a growing delay when it fails. A unit which still fails is left for the next run. """
+        delayInSec = RETRY_DELAY_IN_SEC
+        for attempt in range(self.unitRetries + 1):
+            try:
+                done = self.readUnit(unit)
+                break
+            except Exception as e:
+                if attempt == self.unitRetries or self.stopEvent.is_set():
+                    logging.warning("Backfill unit %s failed: %s", unit, e)
+                    self.writeUnitError(unit, e)
+                    done = False
+                    break
+                logging.info("Backfill unit %s failed, retry in %s sec: %s", unit, delayInSec, e)
+                with self.statisticsLock:
+                    self.retries += 1
+                if self.stopEvent.wait(delayInSec):
+                    return
+                delayInSec *= 2
+        if not done and not self.stopEvent.is_set():
+            with self.statisticsLock:
+                self.unitsFailed += 1
+            HISTORY_UNITS_FAILED.inc()
+
+    def writeUnitError(self, unit, error):
+        windowIndex, batchIndex = unit
+        windowStart, windowEnd = self.windows[windowIndex]
+        first = batchIndex * self.nodesPerRequest
+        tagCount = len(self.tagids[first:first + self.nodesPerRequest])
+        message = (self.tagids[first] + " ,\t Cannot read history from " + windowStart.isoformat() + " to " + windowEnd.isoformat() +
+                   " (batch of " + str(tagCount) + " tags starting with this one). Error message: " + str(error))
+        with self.writerLock:
+            self.resultWriter.writeMessage(message)
+
+    def readUnit(self, unit):
+        """
+        Read the values of a unit, then write them and put the unit in the checkpoint.
+        Returns True when it is done, False when stopped (nothing written).
+        Raises HistoryUnitError when a node returned a transient Bad status.
+        """
+        if self.stopEvent.is_set():
+            return False
+        windowIndex, batchIndex = unit
+        windowStart, windowEnd = self.windows[windowIndex]
+        first = batchIndex * self.nodesPerRequest
+        nodes = self.nodes[first:first + self.nodesPerRequest]
+        tagids = self.tagids[first:first + self.nodesPerRequest]
+
+        details = ua.ReadRawModifiedDetails()
+        details.IsReadModified = False
+        details.StartTime = windowStart
+        details.EndTime = windowEnd
+        details.NumValuesPerNode = self.maxValuesPerNode
+        details.ReturnBounds = False
+
+        continuationPoints = [None] * len(nodes)
+        pending = list(range(len(nodes))) # nodes which still have values to return in this window
+        records = []  # of the whole unit, written at the end
+        messages = []
+        while pending:
+            if self.stopEvent.is_set():
+                self.releaseContinuationPoints(details, nodes, continuationPoints, pending)
+                return False
+            results = self.historyRead(details, [(nodes[i], continuationPoints[i]) for i in pending])
+            with self.statisticsLock:
+                self.requests += 1
+                if any(continuationPoints[i] for i in pending):
+                    self.continuationRequests += 1
+            nextPending = []
+            for i, result in zip(pending, results):
+                if isBadStatusCode(result.StatusCode.value):
+                    if result.StatusCode.value not in TERMINAL_STATUS_CODES:
+                        self.releaseContinuationPoints(details, nodes, continuationPoints, [j for j in pending if j != i])
+                        raise HistoryUnitError(tagids[i] + ": " + result.StatusCode.name)
+                    messages.append(tagids[i] + " ,\t Cannot read history from " + windowStart.isoformat() + " to " + windowEnd.isoformat()
+                                    + ". Error message: " + result.StatusCode.name)
+                    continue
+                dataValues = result.HistoryData.DataValues if result.HistoryData is not None else []
+                if dataValues and dataValues[-1].SourceTimestamp is not None and dataValues[-1].SourceTimestamp >= windowEnd:
+                    # EndTime is not part of the window, but some servers return its value: it belongs to the next window
+                    dataValues = [dataValue for dataValue in dataValues if dataValue.SourceTimestamp is None or dataValue.SourceTimestamp < windowEnd]
+                if dataValues:
+                    records.extend(encodeChunk(None, dataValues, [tagids[i]] * len(dataValues)))
+                if result.ContinuationPoint:
+                    continuationPoints[i] = result.ContinuationPoint
+                    nextPending.append(i)
+            pending = nextPending
+
+        # Only flushed units go in the checkpoint, the file lock keeps the two in the same order
+        with self.writerLock:
+            for message in messages:
+                self.resultWriter.writeMessage(message)
+            self.resultWriter.writeRecords(records)
+            self.resultWriter.flush()
+            self.checkpoint.markDone(unit)
+        with self.statisticsLock:
+            self.unitsDone += 1
+            self.valuesRead += len(records)
+            self.badResults += len(messages)
+        HISTORY_VALUES_READ.inc(len(records))
+        HISTORY_UNITS_DONE.inc()
+        return True
+
+    def historyRead(self, details, nodesAndContinuationPoints, releaseContinuationPoints=False):
+        params = ua.HistoryReadParameters()
+        params.HistoryReadDetails = details
+        params.TimestampsToReturn = ua.TimestampsToReturn.Both
+        params.ReleaseContinuationPoints = releaseContinuationPoints
+        for node, continuationPoint in nodesAndContinuationPoints:
+            valueId = ua.HistoryReadValueId()
+            valueId.NodeId = node.nodeid
+            valueId.ContinuationPoint = continuationPoint
+            params.NodesToRead.append(valueId)
+        with HISTORY_READ_LATENCY.time():
+            results = self.opcua_client.session.uaclient.history_read(params)
+        HISTORY_READ_REQUESTS.inc()
+        return results
+
+    def releaseContinuationPoints(self, details, nodes, continuationPoints, pending):
+        """ Tell the server the continuation points will not be used, it frees them without waiting for the session to end. """
+        nodesAndContinuationPoints = [(nodes[i], continuationPoints[i]) for i in pending if continuationPoints[i]]
+        if not nodesAndContinuationPoints:
+            return
+        try:
+            self.historyRead(details, nodesAndContinuationPoints, releaseContinuationPoints=True)
+        except Exception as e:
+            logging.warning("Continuation points not released: %s", e)
+
+    def getStatistics(self):
+        elapsedTimeInSec = time.perf_counter() - self.startTime if self.startTime is not None else 0
+        d = dict()
+        d['units'] = self.unitsTotal
+        d['unitsDone'] = self.unitsDone
+        d['unitsSkipped'] = self.unitsSkipped # done by a previous run (checkpoint)
+        d['unitsFailed'] = self.unitsFailed # left for the next run
+        d['retries'] = self.retries
+        d['requests'] = self.requests
+        d['continuationRequests'] = self.continuationRequests
+        d['values'] = self.valuesRead
+        d['badResults'] = self.badResults
+        d['elapsedTimeInSec'] = round(elapsedTimeInSec, 3)
+        d['valuesPerSec'] = round(self.valuesRead / elapsedTimeInSec, 1) if elapsedTimeInSec > 0 else 0
+        return d
+
+def getMaxNodesPerHistoryRead(opcua_client, defaultValue):
+    """ MaxNodesPerHistoryReadData operation limit of the server, defaultValue when not exposed or 0 (no limit). """
+    try:
+        maxNodes = opcua_client.session.get_node(ua.ObjectIds.Server_ServerCapabilities_OperationLimits_MaxNodesPerHistoryReadData).get_value()
+    except Exception:
+        return defaultValue
+    if not maxNodes:
+        return defaultValue
+    return min(int(maxNodes), defaultValue)
+
+class ProgressPrinter(threading.Thread):
+    def __init__(self, backfill, intervalInSec):
+        threading.Thread.__init__(self, name="BackfillProgress", daemon=True)
+        self.backfill = backfill
+        self.intervalInSec = intervalInSec
+        self.stopEvent = threading.Event()
+
+    def run(self):
+        while not self.stopEvent.wait(self.intervalInSec):
+            print("Backfill", self.backfill.getStatistics())
+
+    def stop(self):
+        self.stopEvent.set()
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.ERROR)
+
+    parameters = getParameters()
+    jsonDump = metrics.configure(parameters)
+    opcua_client = None
+    progressPrinter = None
+
+    try:
+        # Init Opcua Client Session
+        opcua_client = opcUaClient(parameters['opcServerUrl'])
+
+        def onError(tag, e):
+            parameters['result_writer'].writeMessage(tag + " ,\t Cannot read tag from source. Error message: "  + str(e))
+        nodes = list(iterNodes(opcua_client.session, iterTags(parameters['taglist_file']), NodeIdCache(), onError))
+
+        nodesPerRequest = getMaxNodesPerHistoryRead(opcua_client, parameters['nodesPerRequest'])
+        backfill = HistoryBackfill(opcua_client, nodes, parameters['result_writer'], parameters['startTime'], parameters['endTime'],
+                                   parameters['checkpointFile'], parameters['windowSizeInSec'], nodesPerRequest,
+                                   parameters['maxValuesPerNode'], parameters['concurrency'], parameters['unitRetries'])
+        progressPrinter = ProgressPrinter(backfill, parameters['statusIntervalInSec'])
+        progressPrinter.start()
+        try:
+            completed = backfill.run()
+        except KeyboardInterrupt:
+            completed = False
+        print("Backfill", backfill.getStatistics())
+        if completed:
+            print("Backfill complete, the checkpoint file", parameters['checkpointFile'], "can be deleted")
+        elif backfill.unitsFailed:
+            print("Backfill incomplete,", backfill.unitsFailed, "units failed (see the messages in the result file), run the same command again to read them")
+        else:
+            print("Backfill interrupted, run the same command again to resume it")
+
+    finally:
+        if progressPrinter is not None:
+            progressPrinter.stop()
+        if opcua_client is not None:
+            opcua_client.disconnect()
+        parameters['taglist_file'].close()
+        parameters['result_writer'].close()
+        if jsonDump is not None:
+            jsonDump.stop()
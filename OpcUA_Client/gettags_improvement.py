@@ -1,135 +1,309 @@
 import sys
+import threading
 import time
 
 from datetime import datetime
+from itertools import islice
 from opcua import Client
+from opcua import ua
+import metrics
+from adaptiveread import DEFAULT_MAX_CHUNK_SIZE, DEFAULT_MAX_REQUESTS_IN_FLIGHT, DEFAULT_TARGET_LATENCY_IN_SEC, READ_LATENCY, READ_REQUESTS, PipelinedReader, ReadTuner, readOperationLimits
+from resultwriters import RESULT_FILE_EXTENSIONS, createResultWriter
+from servermetadata import DEFAULT_CACHE_DIR, ServerMetadata
+from tagencoder import ScanRecord, encodeChunk
+from tagstream import NodeIdCache, iterTags, iterNodes, prefetch
 sys.path.insert(0, "..")
 
+DEFAULT_CHUNK_SIZE = 1000 # ReadValueIds sent in one Read request (starting point with adaptiveRead), never more than the MaxNodesPerRead of the server
+STREAM_BUFFER_CHUNKS = 2 # Chunks read ahead of the writer in stream mode
+
+now = datetime.now()
+current_time = now.strftime("_%Y_%m_%d_%H_%M_%S")
+
+CONNECT_TIME = metrics.gauge("opcua_connect_seconds", "Time taken by the last connect, type definitions included")
+NODE_CREATION_TIME = metrics.histogram("opcua_node_creation_seconds", "Time to create the nodes of a tag list")
+FORMAT_TIME = metrics.histogram("record_format_seconds", "Time to format a chunk of DataValues into records")
+
 def getParameters():
-    
-        now = datetime.now()
-        current_time = now.strftime("_%Y_%m_%d_%H_%M_%S")
-        url = "opc.tcp://KPC22014549.kongsberg.master.int:53530/OPCUA/SimulationServer"  # Prosys server       
-        filename = r"C:\Users\sergioc\OneDrive - KONGSBERG MARITIME AS\Projects\Edge Gateway for Shell\GetTags Python App\Taglist.txt"
-        outfile =  r"C:\Users\sergioc\OneDrive - KONGSBERG MARITIME AS\Projects\Edge Gateway for Shell\GetTags Python App\resultTagList-" + current_time +".csv"
 
-        taglist_file_opened = open(filename, "r")
-        result_file_opened = open(outfile, "w")
+        if len(sys.argv) != 4:
+            print("Syntax: " , sys.argv[0], "[OpcUaUrl]", "[Inputfile]", "[OutputfileName]")
+            sys.exit(-1)
+
+        return buildParameters(sys.argv[1], sys.argv[2], sys.argv[3])
+
+def getDefaultParameters():
 
         d = dict();
-        d['opcServerUrl'] = url
-        d['taglist_file'] = taglist_file_opened
-        d['result_file']  = result_file_opened 
+        d['outputFormat'] = "text" # text (original format), csv, binary or parquet
+        d['readMode'] = "stream"   # "stream": parse, read and write chunk by chunk, "batch": one Read request per chunk, "node": one Read request per tag, "compare": time both
+        d['chunkSize'] = DEFAULT_CHUNK_SIZE
+        d['adaptiveRead'] = True # Adjust chunkSize and requestsInFlight to the server while reading (see adaptiveread.py), False to use them as they are
+        d['requestsInFlight'] = 1 # Read requests sent before the answer of the first one is received
+        d['maxRequestsInFlight'] = DEFAULT_MAX_REQUESTS_IN_FLIGHT
+        d['targetReadLatencyInSec'] = DEFAULT_TARGET_LATENCY_IN_SEC
+        d['metricsEnabled'] = None # Timers and counters (see metrics.py): None follows OPCUA_METRICS, True/False forces them on/off
+        d['metricsHttpPort'] = None # ex: 9108 to serve http://127.0.0.1:9108/metrics
+        d['metricsJsonFile'] = None # File where a JSON line of metrics is appended every metricsJsonIntervalInSec
+        d['metricsJsonIntervalInSec'] = 60
+        d['debugPrint'] = False # Print every value on the console (slow), at most debugPrintMaxLinesPerSec lines per second
+        d['debugPrintMaxLinesPerSec'] = 10
 
         return d
 
+def buildParameters(url, taglistFileName, outputFileName, options=None):
+    """
+    Parameters of run(): getDefaultParameters overridden by options, the tag list opened and the result writer created.
+    The start time and the extension of the output format are appended to outputFileName.
+    """
+    d = getDefaultParameters()
+    d.update(checkOptions(d, options))
+    d['opcServerUrl'] = url
+    d['taglist_file'] = open(taglistFileName, "r")
+    d['result_writer'] = createResultWriter(d['outputFormat'], outputFileName + current_time + RESULT_FILE_EXTENSIONS[d['outputFormat']])
+    return d
+
+def checkOptions(defaultParameters, options):
+    """ options, raising ValueError if one of them is not a parameter. """
+    options = options or dict()
+    unknown = sorted(set(options) - set(defaultParameters))
+    if unknown:
+        raise ValueError("Unknown parameters: " + ", ".join(unknown))
+    return options
+
 class opcUaClient():
     
-    def __init__(self, url):
+    def __init__(self, url, metadataCacheDir=DEFAULT_CACHE_DIR):
+        startTime = time.perf_counter()
         self.session = Client(url)
         self.session.connect()
-        self.session.load_type_definitions()  # load definition of server specific structures/extension objects 
+        # load definition of server specific structures/extension objects, from the local cache while the server is unchanged
+        self.metadata = ServerMetadata(self.session, url, metadataCacheDir)
+        fromCache = self.metadata.loadTypeDefinitions()
+        print("Type definitions loaded from", "cache" if fromCache else "server", "in", round(self.metadata.loadTimeInSec, 3), "sec")
+        self.nodeIdCache = NodeIdCache()
+        self.reader = None
+        self.readerLock = threading.RLock() # the reader is created once even when several threads read at the same time
+        CONNECT_TIME.set(time.perf_counter() - startTime)
              
 
-    def getArrayNodesFromOpcServer(self, tagList, resultFile):
-        localArrayNodes = []
-        for x in tagList:
-            tag=x.strip()
-            try:  
-                var = self.session.get_node(tag)                
-                
-                localArrayNodes.append(var)
+    def getArrayNodesFromOpcServer(self, tagList, resultWriter):
+        def onError(tag, e):
+            errorMessage = tag + " ,\t Cannot read tag from source. Error message: "  + str(e) 
+            writeMessageInFile(resultWriter, errorMessage)       
+        with NODE_CREATION_TIME.time():
+            return list(iterNodes(self.session, iterTags(tagList), self.nodeIdCache, onError))
 
-            except Exception as e: 
-                errorMessage = tag + " ,\t Cannot read tag from source. Error message: "  + str(e) 
-                writeMessageInFile(resultFile, errorMessage)       
-        return localArrayNodes
+    def getMaxNodesPerRead(self, defaultValue):
+        """
+        Read the MaxNodesPerRead operation limit of the server.
+        Returns defaultValue when the server does not expose it or reports 0 (no limit).
+        """
+        try:
+            maxNodesPerRead = self.session.get_node(ua.ObjectIds.Server_ServerCapabilities_OperationLimits_MaxNodesPerRead).get_value()
+        except Exception:
+            return defaultValue
+        if not maxNodesPerRead:
+            return defaultValue
+        return min(int(maxNodesPerRead), defaultValue)
+
+    def configureReads(self, chunkSize=DEFAULT_CHUNK_SIZE, requestsInFlight=1, adaptive=True, maxRequestsInFlight=DEFAULT_MAX_REQUESTS_IN_FLIGHT,
+                       targetLatencyInSec=DEFAULT_TARGET_LATENCY_IN_SEC):
+        """
+        Set how readDataValuesInChunks sends its Read requests (see adaptiveread.py).
+        chunkSize and requestsInFlight are the starting point when adaptive, the values used otherwise.
+        The chunk size never goes over the MaxNodesPerRead operation limit of the server.
+        Call it before starting threads which read: the previous reader is closed.
+        """
+        with self.readerLock:
+            if self.reader is not None:
+                self.reader.close()
+            self.operationLimits = readOperationLimits(self.session)
+            maxChunkSize = self.operationLimits['MaxNodesPerRead'] or max(chunkSize, DEFAULT_MAX_CHUNK_SIZE)
+            tuner = ReadTuner(chunkSize, requestsInFlight, maxChunkSize, maxRequestsInFlight, adaptive, targetLatencyInSec)
+            self.reader = PipelinedReader(self.session, tuner, self.readOneDataValue)
+            return tuner
+
+    def getReadTuning(self):
+        """ Parameters used by the last reads, to pin them with configureReads(chunkSize, requestsInFlight, adaptive=False). """
+        return self.reader.tuner.getTuning() if self.reader is not None else None
+
+    def readDataValuesInChunks(self, nodes, chunkSize, attributeIds=(ua.AttributeIds.Value,)):
+        """
+        Read the attributes of the nodes sending multi-node Read requests.
+        The requests are of chunkSize ReadValueIds (at most MaxNodesPerRead), one at a time without a call to configureReads first,
+        with as many in flight as it set otherwise. When configureReads made the reads adaptive, the tuner sizes them instead.
+        Returns one list of DataValues (one per attributeId) for each node, in the same order as nodes.
+        A node which cannot be read gets a DataValue with a bad StatusCode, it does not fail the chunk:
+        a request rejected for its size is sent again in smaller chunks, for any other reason its nodes are read one by one.
+        """
+        reader = self.reader
+        if reader is None:
+            with self.readerLock:
+                if self.reader is None:
+                    self.configureReads(chunkSize, adaptive=False)
+                reader = self.reader
+        return reader.read(nodes, attributeIds, chunkSize)
+
+    def readOneDataValue(self, readValueId):
+        params = ua.ReadParameters()
+        params.TimestampsToReturn = ua.TimestampsToReturn.Both
+        params.NodesToRead.append(readValueId)
+        startTime = time.perf_counter()
+        try:
+            dataValue = self.session.uaclient.read(params)[0]
+            READ_LATENCY.observe(time.perf_counter() - startTime)
+            READ_REQUESTS.inc()
+            return dataValue
+        except ua.UaStatusCodeError as e:
+            return ua.DataValue(status=ua.StatusCode(e.code))
+        except Exception:
+            return ua.DataValue(status=ua.StatusCode(ua.StatusCodes.BadCommunicationError))
 
     def disconnect(self):
+        if self.reader is not None:
+            self.reader.close()
+        self.metadata.save()
         self.session.disconnect()
 
-def readNodeValues (var):
-    message = ""
-    error = False
-    dataValue = var.get_data_value() 
-       
-    #2nd Read the tagId of the tag
-    try:               
-        tagid = var.nodeid.Identifier
-    except Exception as e:
-        error = True
-        tagid = ". Error message: "  + str(e)
-        message = message + ",\t error trying to read the tagId from the tag. "                     
-    
-    #4th Read the whole variant Value of the tag
-    try:               
-        variantValue = str(dataValue.Value).replace(",", ";")
-    except Exception as e:
-        error = True
-        variantValue = ". Error message: "  + str(e)
-        message = message + ",\t error trying to read the variant value from the tag. "
-
-    #5th Read the Value of the tag
-    try:               
-        value = str(dataValue.Value.Value).replace(",", ";")
-    except Exception as e:
-        error = True
-        value = ". Error message: "  + str(e)
-        message = message + ",\t error trying to read the value from the tag. "
-
-    #6th Read the StatusCode of the tag
-    try:               
-        statusCode = str(dataValue.StatusCode).replace(",", ";")
-    except Exception as e:
-        error = True
-        statusCode = ". Error message: "  + str(e)
-        message = message + ",\t error trying to read the statusCode from the tag. "
-
-    #7th Read the timeStamp of the tag
-    try:               
-        timestamp =dataValue.SourceTimestamp.isoformat('T')+"Z"
-    except Exception as e:
-        error = True
-        timestamp = ". Error message: "  + str(e)
-        message = message + ",\t error trying to read the SourceTimestamp from the tag. "  
-
-
-    if error:
-        message = tagid + " ,\t " + value + " ,\t " + statusCode + " ,\t " + timestamp + ",\t Whole variant value: " + variantValue + ",\t Error message: " + message + " ."
-    else:
-        message = tagid + " ,\t " + value + " ,\t " + statusCode + " ,\t " + timestamp + ",\t Whole variant value: " + variantValue + " ."
-    
-    print("ReadNodeValues \n" , message)
-    return message + "\n"
+def readNodeValues (var, dataValue=None):
+    if dataValue is None:
+        dataValue = var.get_data_value() 
+    return encodeChunk([var], [dataValue])[0]
 
-def writeMessageInFile(fileOpened, messageToWrite):
-    fileOpened.write(messageToWrite)
-    fileOpened.write("\n")
+def cannotReadRecord(tagid, e):
+    return ScanRecord(tagid, "", None, ua.VariantType.Null.value, ua.StatusCodes.BadNodeIdInvalid, None, "Cannot read tag from source. Error message: " + str(e))
 
-def closeProgram(client, sourceFile, resultFile):
-    sourceFile.close()
-    resultFile.close()
-    client.disconnect()
+def writeMessageInFile(resultWriter, messageToWrite):
+    resultWriter.writeMessage(messageToWrite)
 
-if __name__ == "__main__":
+def batch(iterable, n=1):
+    l = len(iterable)
+    for ndx in range(0, l, n):
+        yield iterable[ndx:min(ndx + n, l)]
 
-    try:
-        parameters = getParameters()
+def readValuesNodeByNode(arrayNodes):
+    records = []
+    for node in arrayNodes:
+        try:
+            records.append(readNodeValues(node))
+        except Exception as e:
+            records.append(cannotReadRecord(str(node.nodeid.Identifier), e))
+    return records
+
+def readValuesInChunks(opcua_client, arrayNodes, chunkSize):
+    dataValues = opcua_client.readDataValuesInChunks(arrayNodes, chunkSize)
+    with FORMAT_TIME.time():
+        return encodeChunk(arrayNodes, [nodeDataValues[0] for nodeDataValues in dataValues])
+
+def iterValuesStreaming(opcua_client, tagList, chunkSize):
+    """
+    Parse, read and format the tag list chunk by chunk, yielding the records in tag-list order
+    (the records of the tags which cannot be parsed included, as in the list).
+    Only a few chunks are in memory at any time, so memory stays flat whatever the size of the list,
+    and the next chunk is read from the server while the current one is written.
+    A chunk of the stream is enough nodes for maxRequestsInFlight Read requests of chunkSize (see configureReads).
+    """
+    if opcua_client.reader is None:
+        opcua_client.configureReads(chunkSize, adaptive=False)
+    tuner = opcua_client.reader.tuner
+
+    def readChunks():
+        errors = [] # (number of nodes before the tag in the list, error record)
+        nodeCount = 0
+        def onError(tag, e):
+            errors.append((nodeCount, cannotReadRecord(tag, e)))
+        def countedNodes():
+            nonlocal nodeCount
+            for node in iterNodes(opcua_client.session, iterTags(tagList), opcua_client.nodeIdCache, onError):
+                nodeCount += 1
+                yield node
+
+        nodes = countedNodes()
+        chunkStart = 0
+        while True:
+            # Sized with the chunk size of the moment, so every request in flight has a full chunk
+            chunkNodes = list(islice(nodes, max(chunkSize, tuner.chunkSize) * tuner.maxRequestsInFlight))
+            if not chunkNodes:
+                break
+            dataValues = opcua_client.readDataValuesInChunks(chunkNodes, chunkSize)
+            # Positions of the errors in the chunk, so they are written between the same tags as in the list
+            yield [(position - chunkStart, record) for position, record in errors], chunkNodes, dataValues
+            errors = []
+            chunkStart += len(chunkNodes)
+        if errors:
+            yield [(0, record) for position, record in errors], [], []
+
+    for errors, chunkNodes, dataValues in prefetch(readChunks(), STREAM_BUFFER_CHUNKS):
+        with FORMAT_TIME.time():
+            records = encodeChunk(chunkNodes, [nodeDataValues[0] for nodeDataValues in dataValues])
+        nextRecord = 0
+        for position, errorRecord in errors:
+            while nextRecord < position:
+                yield records[nextRecord]
+                nextRecord += 1
+            yield errorRecord
+        for record in records[nextRecord:]:
+            yield record
+
+def compareReadModes(opcua_client, arrayNodes, chunkSize):
+    """
+    Read all nodes with one Read request per node and then with one Read request per chunk.
+    Prints the time taken by each mode and returns the records from the chunked read.
+    """
+    startTime = time.perf_counter()
+    readValuesNodeByNode(arrayNodes)
+    nodeByNodeTime = time.perf_counter() - startTime
 
-        # Write header
-        header = "Tagid  ,\t Value ,\t StatusCode ,\t Timestamp ,\t Variant value "                   
-        writeMessageInFile(parameters['result_file'], header)
+    startTime = time.perf_counter()
+    records = readValuesInChunks(opcua_client, arrayNodes, chunkSize)
+    chunkTime = time.perf_counter() - startTime
+
+    print("Read of", len(arrayNodes), "tags. Node by node:", round(nodeByNodeTime, 3), "sec. In chunks:", round(chunkTime, 3), "sec.")
+    if chunkTime > 0:
+        print("Speed-up:", round(nodeByNodeTime / chunkTime, 1), "x")
+    return records
+
+def run(parameters):
+    """ Read every tag of parameters['taglist_file'] once and write the values. Closes the files. """
+    jsonDump = None
+    opcua_client = None
+    try:
+        jsonDump = metrics.configure(parameters)
 
         # create client and connect to server
         opcua_client = opcUaClient(parameters['opcServerUrl'])
+        opcua_client.configureReads(parameters['chunkSize'], parameters['requestsInFlight'], parameters['adaptiveRead'],
+                                    parameters['maxRequestsInFlight'], parameters['targetReadLatencyInSec'])
+
+        if parameters['readMode'] == "stream":
+            # Read the nodes from server while the tag list is being parsed
+            records = iterValuesStreaming(opcua_client, parameters['taglist_file'], parameters['chunkSize'])
+        else:
+            # Read the nodes from server 
+            arrayNodes = opcua_client.getArrayNodesFromOpcServer(parameters['taglist_file'],parameters['result_writer'])  
 
-        # Read the nodes from server 
-        arrayNodes = opcua_client.getArrayNodesFromOpcServer(parameters['taglist_file'],parameters['result_file'])  
+            # Read values from the Nodes
+            if parameters['readMode'] == "node":
+                records = readValuesNodeByNode(arrayNodes)
+            elif parameters['readMode'] == "compare":
+                records = compareReadModes(opcua_client, arrayNodes, parameters['chunkSize'])
+            else:
+                records = readValuesInChunks(opcua_client, arrayNodes, parameters['chunkSize'])
 
-        # Read values from the Nodes
-        for node in arrayNodes:
-             nodeValue = readNodeValues (node)
-             writeMessageInFile(parameters['result_file'], nodeValue)  
+        for record in records:
+             parameters['result_writer'].writeRecord(record)
+        # The chunkSize and requestsInFlight found, to set in getParameters with adaptiveRead False
+        print("Read tuning:", opcua_client.getReadTuning())
 
     finally:
-        closeProgram(opcua_client,parameters['taglist_file'],parameters['result_file'])
\ No newline at end of file
+        parameters['taglist_file'].close()
+        parameters['result_writer'].close()
+        if opcua_client is not None:
+            opcua_client.disconnect()
+        if jsonDump is not None:
+            jsonDump.stop()
+
+if __name__ == "__main__":
+
+    run(getParameters())
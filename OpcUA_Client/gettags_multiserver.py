@@ -0,0 +1,177 @@
+import sys
+import logging
+import multiprocessing
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from gettags_improvement import opcUaClient, DEFAULT_CHUNK_SIZE
+from resultwriters import RESULT_FILE_EXTENSIONS, createResultWriter
+from tagencoder import ScanRecord, encodeChunk, isGoodStatusCode
+from tagstream import iterTags, iterNodes, iterChunks
+
+# Read the tags of many OPC UA servers in one run.
+# Every server is scanned in a worker process of a pool (one session per server), so
+# decoding the responses of a busy server does not slow down the others, and the work
+# scales across the cores. The workers send their records chunk by chunk to the main
+# process, which merges them into one output file.
+#
+# Manifest: one server per line "name,OpcUaUrl,Inputfile" (name is optional)
+#     plant1,opc.tcp://server1:53530/OPCUA/SimulationServer,C:\Taglists\plant1.txt
+#     opc.tcp://server2:21381/MatrikonOpcUaWrapper,C:\Taglists\plant2.txt
+# The tag ids in the output are prefixed with the server name ("plant1/0:FIC-31-0114:Z.X.Value")
+# so the same NodeId on two servers can be told apart.
+# The Read requests of every server are sized and pipelined for that server (adaptiveread.py),
+# the parameters found are in the statistics printed at the end ("readTuning").
+
+RECORD_QUEUE_CHUNKS_PER_WORKER = 4 # Chunks waiting to be written per worker before the workers are blocked
+SIMPLE_VALUE_TYPES = (bool, int, float, str, bytes, datetime, type(None))
+
+now = datetime.now()
+current_time = now.strftime("_%Y_%m_%d_%H_%M_%S")
+
+def getParameters():
+
+        if len(sys.argv) < 3 or len(sys.argv) > 4:
+            print("Syntax: " , sys.argv[0], "[ManifestFile]", "[OutputfileName]", "[Workers]")
+            sys.exit(-1)
+
+        manifestFile = sys.argv[1]
+        outputFormat = "binary" # text, csv, binary or parquet
+        outfile = sys.argv[2] + current_time + RESULT_FILE_EXTENSIONS[outputFormat]
+        servers = loadManifest(manifestFile)
+        workers = int(sys.argv[3]) if len(sys.argv) > 3 else min(len(servers), os.cpu_count() or 1)
+
+        d = dict();
+        d['servers'] = servers
+        d['result_writer'] = createResultWriter(outputFormat, outfile)
+        d['workers'] = max(1, workers)
+        d['chunkSize'] = DEFAULT_CHUNK_SIZE
+
+        return d
+
+def loadManifest(fileName):
+    """ Returns a list of (serverName, url, tagListFile). """
+    servers = []
+    with open(fileName, "r") as f:
+        for x in f:
+            line = x.strip()
+            if not line or line.startswith("#"):
+                continue
+            # The url never contains a comma, the tag list file name might
+            fields = line.split(",")
+            if fields[0].startswith("opc.tcp://"):
+                serverName, url, tagListFile = "", fields[0], ",".join(fields[1:])
+            else:
+                serverName, url, tagListFile = fields[0], fields[1], ",".join(fields[2:])
+            if not serverName:
+                serverName = url[len("opc.tcp://"):].split("/")[0] # host:port
+            serverName = serverName.strip()
+            if serverName in (name for name, serverUrl, serverTagListFile in servers):
+                serverName += "#" + str(len(servers) + 1) # names are the keys of the statistics and the tag prefix
+            servers.append((serverName, url.strip(), tagListFile.strip()))
+    return servers
+
+recordQueue = None
+
+def initWorker(queue):
+    global recordQueue
+    recordQueue = queue
+
+def toPicklableRecord(serverName, record):
+    """ Prefix the tag id with the server name. Values of server specific types are sent as text. """
+    value = record.value
+    if not isinstance(value, SIMPLE_VALUE_TYPES):
+        value = str(value)
+    return ScanRecord(serverName + "/" + record.tagid, record.browseName, value, record.variantType, record.statusCode,
+                      record.sourceTimestamp, record.errorMessage)
+
+def scanServer(serverName, url, tagListFile, chunkSize):
+    """
+    Worker process: read all the tags of one server and put the records on the record queue, one list per chunk.
+    The last item put on the queue is the statistics of the server.
+    """
+    statistics = {"server": serverName, "url": url, "tags": 0, "badTags": 0, "unknownTags": 0, "error": ""}
+    startTime = time.perf_counter()
+    opcua_client = None
+    try:
+        opcua_client = opcUaClient(url)
+        statistics['connectTimeInSec'] = round(time.perf_counter() - startTime, 3)
+        tuner = opcua_client.configureReads(chunkSize)
+
+        errorMessages = []
+        def onError(tag, e):
+            statistics['unknownTags'] += 1
+            errorMessages.append(serverName + "/" + tag + " ,\t Cannot read tag from source. Error message: "  + str(e))
+
+        with open(tagListFile, "r") as tagList:
+            nodes = iterNodes(opcua_client.session, iterTags(tagList), opcua_client.nodeIdCache, onError)
+            for chunkNodes in iterChunks(nodes, chunkSize * tuner.maxRequestsInFlight):
+                dataValues = opcua_client.readDataValuesInChunks(chunkNodes, chunkSize)
+                records = [toPicklableRecord(serverName, record) for record in encodeChunk(chunkNodes, [nodeDataValues[0] for nodeDataValues in dataValues])]
+                statistics['tags'] += len(records)
+                statistics['badTags'] += sum(1 for record in records if not isGoodStatusCode(record.statusCode))
+                recordQueue.put((records, errorMessages))
+                errorMessages = []
+        if errorMessages:
+            recordQueue.put(([], errorMessages))
+    except Exception as e:
+        statistics['error'] = repr(e)
+        recordQueue.put(([], [serverName + " ,\t Cannot scan server " + url + ". Error message: " + str(e)]))
+    finally:
+        if opcua_client is not None:
+            statistics['readTuning'] = opcua_client.getReadTuning()
+            try:
+                opcua_client.disconnect()
+            except Exception:
+                pass
+        statistics['durationInSec'] = round(time.perf_counter() - startTime, 3)
+        statistics['tagsPerSec'] = round(statistics['tags'] / statistics['durationInSec'], 1) if statistics['durationInSec'] > 0 else 0
+        recordQueue.put((None, statistics))
+
+def scanServers(servers, resultWriter, workers, chunkSize):
+    """
+    Scan every server in a pool of worker processes and write the merged records with resultWriter
+    as they arrive. Returns the statistics of every server, in the manifest order.
+    """
+    queue = multiprocessing.Queue(maxsize=RECORD_QUEUE_CHUNKS_PER_WORKER * workers)
+    statisticsByServer = dict()
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(queue,)) as pool:
+        futures = dict((pool.submit(scanServer, serverName, url, tagListFile, chunkSize), serverName) for serverName, url, tagListFile in servers)
+        while len(statisticsByServer) < len(servers):
+            try:
+                records, payload = queue.get(timeout=1)
+            except Exception: # queue.Empty
+                # A worker process which died (ex: killed) never sends its statistics
+                for future, serverName in futures.items():
+                    if future.done() and future.exception() is not None and serverName not in statisticsByServer:
+                        statisticsByServer[serverName] = {"server": serverName, "tags": 0, "error": repr(future.exception())}
+                continue
+            if records is None:
+                statisticsByServer[payload['server']] = payload
+                continue
+            for message in payload:
+                resultWriter.writeMessage(message)
+            resultWriter.writeRecords(records)
+    return [statisticsByServer[serverName] for serverName, url, tagListFile in servers]
+
+def printStatistics(statistics, elapsedTimeInSec):
+    for serverStatistics in statistics:
+        print("Server", serverStatistics)
+    totalTags = sum(serverStatistics['tags'] for serverStatistics in statistics)
+    print("Read of", totalTags, "tags from", len(statistics), "servers in", round(elapsedTimeInSec, 3), "sec.",
+          round(totalTags / elapsedTimeInSec, 1) if elapsedTimeInSec > 0 else 0, "tags/sec")
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.ERROR)
+
+    parameters = getParameters()
+
+    try:
+        startTime = time.perf_counter()
+        statistics = scanServers(parameters['servers'], parameters['result_writer'], parameters['workers'], parameters['chunkSize'])
+        printStatistics(statistics, time.perf_counter() - startTime)
+    finally:
+        parameters['result_writer'].close()
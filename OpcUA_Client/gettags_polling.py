@@ -0,0 +1,265 @@
+import sys
+import logging
+import threading
+import time
+
+from datetime import datetime
+import metrics
+from deadband import createDeadbandFilter, loadDeadbandFile
+from gettags_improvement import checkOptions, opcUaClient, DEFAULT_CHUNK_SIZE
+from resultwriters import RESULT_FILE_EXTENSIONS, createResultWriter
+from storeforward import StoreForwardWriter
+from tagencoder import encodeChunk, tagidOf
+from tagstream import iterNodes, splitTagRate
+
+# Long running collector: one session stays open and the tags are read again and again.
+# Every tag belongs to a scan class (its read period). Each scan class runs on its own
+# timer and reads all its tags with batched Read requests. When a scan takes longer
+# than the period (overrun) the missed ticks are skipped instead of being queued.
+#
+# Tag list: one tag per line, optionally followed by ",<scan rate in sec>"
+#     ns=2;s=0:FIC-31-0114:Z.X.Parameters.Unit,60
+#     ns=2;s=0:FIC-31-0114:Z.X.Value,1
+#     ns=2;s=0:FIC-31-0114:Z.Y.Value                  (uses DefaultScanRateInSec)
+
+now = datetime.now()
+current_time = now.strftime("_%Y_%m_%d_%H_%M_%S")
+
+def num(s, defaultValue):
+    try:
+        if not s is None:
+            return float(s)
+        else :
+            return defaultValue
+    except :
+        return defaultValue
+
+def getParameters():
+
+        if len(sys.argv) < 4 or len(sys.argv) > 6:
+            print("Syntax: " , sys.argv[0], "[OpcUaUrl]", "[Inputfile]", "[OutputfileName]", "[DefaultScanRateInSec]", "[RunTimeInSec]")
+            sys.exit(-1)
+
+        defaults = getDefaultParameters()
+        options = dict()
+        options['defaultScanRateInSec'] = num(sys.argv[4] if len(sys.argv) > 4 else None, defaults['defaultScanRateInSec'])
+        options['runTimeInSec'] = num(sys.argv[5] if len(sys.argv) > 5 else None, defaults['runTimeInSec'])
+        return buildParameters(sys.argv[1], sys.argv[2], sys.argv[3], options)
+
+def getDefaultParameters():
+
+        d = dict();
+        d['outputFormat'] = "binary" # text, csv, binary or parquet
+        d['storeForwardDir'] = None # Folder of the store and forward log: the results are buffered on disk before the result file (see storeforward.py)
+        d['defaultScanRateInSec'] = 10 # Scan rate of the tags without one in the tag list
+        d['runTimeInSec'] = 0 # 0: run until stopped (Ctrl+C)
+        d['chunkSize'] = DEFAULT_CHUNK_SIZE
+        d['statusIntervalInSec'] = 60 # Time between two prints of the scan class statistics
+        d['absoluteDeadband'] = 0 # Default deadbands of the tags, 0 = disabled (see deadband.py)
+        d['percentDeadband'] = 0
+        d['maxSilenceInSec'] = 0 # Write the value at least every maxSilenceInSec even if it did not change, 0 = disabled
+        d['deadbandFile'] = None # Optional CSV with per tag deadbands: tag,absoluteDeadband,percentDeadband,maxSilenceInSec
+        d['metricsEnabled'] = None # Timers and counters (see metrics.py): None follows OPCUA_METRICS, True/False forces them on/off
+        d['metricsHttpPort'] = None # ex: 9108 to serve http://127.0.0.1:9108/metrics
+        d['metricsJsonFile'] = None # File where a JSON line of metrics is appended every metricsJsonIntervalInSec
+        d['metricsJsonIntervalInSec'] = 60
+
+        return d
+
+def buildParameters(url, taglistFileName, outputFileName, options=None):
+    """
+    Parameters of run(): getDefaultParameters overridden by options, the tag list opened and the result writer created.
+    The start time and the extension of the output format are appended to outputFileName.
+    """
+    d = getDefaultParameters()
+    d.update(checkOptions(d, options))
+    d['opcServerUrl'] = url
+    d['perTagDeadbands'] = loadDeadbandFile(d['deadbandFile']) if d['deadbandFile'] else None
+    d['taglist_file'] = open(taglistFileName, "r")
+    d['result_writer'] = createResultWriter(d['outputFormat'], outputFileName + current_time + RESULT_FILE_EXTENSIONS[d['outputFormat']])
+    if d['storeForwardDir']:
+        d['result_writer'] = StoreForwardWriter(d['storeForwardDir'], d['result_writer'])
+    return d
+
+def parseTagList(tagList, defaultScanRateInSec):
+    """ Returns a dict scan rate in sec -> list of tags. """
+    scanClasses = dict()
+    for x in tagList:
+        line = x.strip()
+        if not line:
+            continue
+        tag, scanRateInSec = splitTagRate(line)
+        if scanRateInSec is None:
+            scanRateInSec = defaultScanRateInSec
+        scanClasses.setdefault(scanRateInSec, []).append(tag)
+    return scanClasses
+
+class ScanClass(threading.Thread):
+    """
+    Reads its nodes every scanRateInSec on its own thread.
+    Ticks are aligned to the start time (start + k * scanRateInSec), so a slow scan does not shift the next ones.
+    If a scan ends after the next tick (overrun) the ticks already missed are skipped and counted.
+    The nodes are nodes firstIndex .. firstIndex + len(nodes) - 1 of the deadbandFilter.
+    """
+    def __init__(self, scanRateInSec, nodes, opcua_client, chunkSize, resultWriter, writerLock, stopEvent, deadbandFilter=None, firstIndex=0):
+        threading.Thread.__init__(self, name="ScanClass-" + str(scanRateInSec), daemon=True)
+        self.scanRateInSec = scanRateInSec
+        self.nodes = nodes
+        self.tagids = [tagidOf(node) for node in nodes]
+        self.opcua_client = opcua_client
+        self.chunkSize = chunkSize
+        self.resultWriter = resultWriter
+        self.writerLock = writerLock
+        self.stopEvent = stopEvent
+        self.deadbandFilter = deadbandFilter
+        self.firstIndex = firstIndex
+        self.scanCount = 0
+        self.overrunCount = 0
+        self.skippedTicks = 0
+        self.errorCount = 0
+        self.lastScanTimeInSec = 0
+        self.maxScanTimeInSec = 0
+
+    def run(self):
+        startTime = time.monotonic()
+        tick = 0
+        while not self.stopEvent.is_set():
+            self.scan()
+            tick += 1
+            nextTickTime = startTime + tick * self.scanRateInSec
+            now = time.monotonic()
+            if now > nextTickTime:
+                # Overrun: go to the next tick still ahead instead of catching up
+                self.overrunCount += 1
+                missedTicks = int((now - nextTickTime) // self.scanRateInSec) + 1
+                self.skippedTicks += missedTicks
+                tick += missedTicks
+                nextTickTime = startTime + tick * self.scanRateInSec
+            self.stopEvent.wait(nextTickTime - time.monotonic())
+
+    def scan(self):
+        scanStartTime = time.perf_counter()
+        try:
+            dataValues = self.opcua_client.readDataValuesInChunks(self.nodes, self.chunkSize)
+            records = encodeChunk(self.nodes, [nodeDataValues[0] for nodeDataValues in dataValues], self.tagids)
+            if self.deadbandFilter is not None:
+                now = time.monotonic()
+                isReportable = self.deadbandFilter.isReportable
+                firstIndex = self.firstIndex
+                records = [record for i, record in enumerate(records) if isReportable(firstIndex + i, record.value, record.statusCode, now)]
+            with self.writerLock:
+                self.resultWriter.writeRecords(records)
+                self.resultWriter.flush()
+        except Exception as e:
+            self.errorCount += 1
+            logging.error("Scan class %s sec failed: %s", self.scanRateInSec, e)
+        self.scanCount += 1
+        self.lastScanTimeInSec = time.perf_counter() - scanStartTime
+        self.maxScanTimeInSec = max(self.maxScanTimeInSec, self.lastScanTimeInSec)
+
+    def getStatistics(self):
+        d = dict()
+        d['scanRateInSec'] = self.scanRateInSec
+        d['tags'] = len(self.nodes)
+        d['scans'] = self.scanCount
+        d['overruns'] = self.overrunCount
+        d['skippedTicks'] = self.skippedTicks
+        d['errors'] = self.errorCount
+        d['lastScanTimeInSec'] = round(self.lastScanTimeInSec, 3)
+        d['maxScanTimeInSec'] = round(self.maxScanTimeInSec, 3)
+        return d
+
+class PollingCollector(object):
+    """ One session, one ScanClass thread per scan rate, one deadband filter for all the nodes. """
+    def __init__(self, opcua_client, scanClassTags, resultWriter, chunkSize, deadbands=(0, 0, 0), perTagDeadbands=None):
+        self.opcua_client = opcua_client
+        self.resultWriter = resultWriter
+        self.writerLock = threading.Lock()
+        self.stopEvent = threading.Event()
+        chunkSize = opcua_client.getMaxNodesPerRead(chunkSize)
+        if opcua_client.reader is None:
+            opcua_client.configureReads(chunkSize, adaptive=False) # before the scan class threads read in parallel
+
+        def onError(tag, e):
+            resultWriter.writeMessage(tag + " ,\t Cannot read tag from source. Error message: "  + str(e))
+
+        scanClassNodes = []
+        for scanRateInSec in sorted(scanClassTags):
+            nodes = list(iterNodes(opcua_client.session, scanClassTags[scanRateInSec], opcua_client.nodeIdCache, onError))
+            if nodes:
+                scanClassNodes.append((scanRateInSec, nodes))
+
+        allNodes = [node for scanRateInSec, nodes in scanClassNodes for node in nodes]
+        absoluteDeadband, percentDeadband, maxSilenceInSec = deadbands
+        self.deadbandFilter = createDeadbandFilter(allNodes, absoluteDeadband, percentDeadband, maxSilenceInSec, perTagDeadbands,
+                                                   opcua_client.session)
+
+        self.scanClasses = []
+        firstIndex = 0
+        for scanRateInSec, nodes in scanClassNodes:
+            self.scanClasses.append(ScanClass(scanRateInSec, nodes, opcua_client, chunkSize, resultWriter, self.writerLock, self.stopEvent,
+                                              self.deadbandFilter, firstIndex))
+            firstIndex += len(nodes)
+
+    def start(self):
+        for scanClass in self.scanClasses:
+            scanClass.start()
+
+    def stop(self):
+        self.stopEvent.set()
+        for scanClass in self.scanClasses:
+            scanClass.join()
+
+    def getStatistics(self):
+        return [scanClass.getStatistics() for scanClass in self.scanClasses]
+
+def printStatistics(collector):
+    for statistics in collector.getStatistics():
+        print("Scan class", statistics)
+    if collector.deadbandFilter is not None:
+        print("Deadband filter", collector.deadbandFilter.getStatistics())
+    if isinstance(collector.resultWriter, StoreForwardWriter):
+        print("Store and forward", collector.resultWriter.getStatistics())
+
+def run(parameters):
+    """ Read the tags of parameters['taglist_file'] at their scan rates for runTimeInSec (0: until Ctrl+C). Closes the files. """
+    jsonDump = metrics.configure(parameters)
+    opcua_client = None
+
+    try:
+        scanClassTags = parseTagList(parameters['taglist_file'], parameters['defaultScanRateInSec'])
+
+        # Init Opcua Client Session, kept open for the whole run
+        opcua_client = opcUaClient(parameters['opcServerUrl'])
+
+        deadbands = (parameters['absoluteDeadband'], parameters['percentDeadband'], parameters['maxSilenceInSec'])
+        collector = PollingCollector(opcua_client, scanClassTags, parameters['result_writer'], parameters['chunkSize'], deadbands, parameters['perTagDeadbands'])
+        collector.start()
+
+        stopTime = time.monotonic() + parameters['runTimeInSec'] if parameters['runTimeInSec'] > 0 else None
+        try:
+            while stopTime is None or time.monotonic() < stopTime:
+                waitTimeInSec = parameters['statusIntervalInSec']
+                if stopTime is not None:
+                    waitTimeInSec = min(waitTimeInSec, stopTime - time.monotonic())
+                time.sleep(max(waitTimeInSec, 0))
+                printStatistics(collector)
+        except KeyboardInterrupt:
+            pass
+
+        collector.stop()
+        printStatistics(collector)
+
+    finally:
+        if opcua_client is not None:
+            opcua_client.disconnect()
+        parameters['taglist_file'].close()
+        parameters['result_writer'].close()
+        if jsonDump is not None:
+            jsonDump.stop()
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.ERROR)
+
+    run(getParameters())
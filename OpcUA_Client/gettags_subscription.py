@@ -1,10 +1,36 @@
 import sys
 import logging
+import math
+import threading
 import time
 
+from collections import deque
 from datetime import datetime
-from opcua import Client
 from opcua import ua
+import metrics
+from deadband import createDeadbandFilter, loadDeadbandFile, makeDataChangeFilter
+from gettags_improvement import checkOptions, opcUaClient as BaseOpcUaClient
+from resultwriters import RESULT_FILE_EXTENSIONS, createResultWriter
+from servermetadata import DEFAULT_CACHE_DIR
+from storeforward import StoreForwardWriter
+from tagencoder import encodeChunk
+from sessionsupervisor import SessionSupervisor, RECONNECT_MIN_DELAY_IN_SEC, RECONNECT_MAX_DELAY_IN_SEC
+from tagstream import iterTags, iterNodes, splitTagRate
+
+BATCH_DELAY_LATENCY_FACTOR = 1 # Delay between subscription batches = factor * time the server took to create the last batch
+DEFAULT_MAX_ITEMS_PER_SUBSCRIPTION = 5000 # Monitored items per subscription, more tags are split across several subscriptions
+DEFAULT_MIN_PUBLISHING_INTERVAL_IN_SEC = 1 # Tags sampled faster are queued on the server and published at this interval
+DEFAULT_MAX_NOTIFICATIONS_PER_PUBLISH = 10000
+DEFAULT_KEEP_ALIVE_TIME_IN_SEC = 10 # Time without notifications before the server sends a keep-alive
+DEFAULT_LIFETIME_IN_SEC = 600 # Time without Publish requests before the server deletes the subscription (transfer after a reconnect needs it alive)
+PUBLISH_REQUESTS_PER_SUBSCRIPTION = 2 # python-opcua sends two Publish requests per subscription (Subscription.__init__ and its ready callback), and a new one per response
+
+NODE_CREATION_TIME = metrics.histogram("opcua_node_creation_seconds", "Time to create the nodes of a tag list")
+NOTIFICATIONS = metrics.counter("opcua_notifications_total", "Data change notifications received")
+NOTIFICATIONS_FILTERED = metrics.counter("opcua_notifications_filtered_total", "Notifications not written because of the deadband filter")
+NOTIFICATIONS_DROPPED = metrics.counter("opcua_notifications_dropped_total", "Notifications dropped because the writer queue was full")
+HEARTBEATS = metrics.counter("opcua_heartbeats_total", "Last values written again because the tag was silent for maxSilenceInSec")
+NOTIFICATION_QUEUE_DEPTH = metrics.gauge("opcua_notification_queue_depth", "Notifications waiting to be written")
 
 now = datetime.now()
 current_time = now.strftime("_%Y_%m_%d_%H_%M_%S")
@@ -18,129 +44,266 @@ def num(s, defaultValue):
     except :
         return defaultValue #if any error the programm will set subscriptions for defaultValue
 
-class opcUaClient():
+class opcUaClient(BaseOpcUaClient):
     
-    def __init__(self, url):
-        self.session = Client(url)
-        self.session.connect()
-        self.session.load_type_definitions()  # load definition of server specific structures/extension objects 
-             
-
-    def getArrayNodesFromOpcServer(self, tagList, resultFile):
-        localArrayNodes = []
-        for x in tagList:
-            tag=x.strip()
-            try:  
-                var = self.session.get_node(tag)                
-                
-                localArrayNodes.append(var)
-
-            except Exception as e: 
-                errorMessage = tag + " ,\t Cannot read tag from source. Error message: "  + str(e) 
-                writeMessageInFile(resultFile, errorMessage)       
-        return localArrayNodes
+    def __init__(self, url, metadataCacheDir=DEFAULT_CACHE_DIR):
+        BaseOpcUaClient.__init__(self, url, metadataCacheDir)
+        self.samplingIntervals = dict() # NodeId -> sampling interval in sec asked in the tag list
+
+    def getArrayNodesFromOpcServer(self, tagList, resultWriter):
+        """ Nodes of the tag list. A line can end with ",<sampling interval in sec>" (kept in samplingIntervals). """
+        def onError(tag, e):
+            errorMessage = tag + " ,\t Cannot read tag from source. Error message: "  + str(e) 
+            writeMessageInFile(resultWriter, errorMessage)       
+        def iterTagsWithRates():
+            for line in iterTags(tagList):
+                tag, samplingIntervalInSec = splitTagRate(line)
+                if samplingIntervalInSec is not None:
+                    try:
+                        self.samplingIntervals[self.nodeIdCache.get(tag)] = samplingIntervalInSec
+                    except Exception:
+                        pass # reported by iterNodes
+                yield tag
+        with NODE_CREATION_TIME.time():
+            return list(iterNodes(self.session, iterTagsWithRates(), self.nodeIdCache, onError))
 
 def getParameters():
-    
-        # Client run with arguments
-        # if len(sys.argv) != 8 and len(sys.argv) != 4:
-        #     print("Syntax: " , sys.argv[0], "[OpcUaUrl]", "[Inputfile]", "[OutputfileName]", "[SusbcriptionTimeInSec]", "[DelayTimeToReadTagsInSec]")
-        #     sys.exit(-1)
-            
-        # url = sys.argv[1]
-        # filename = sys.argv[2]
-        # outfile =  sys.argv[3] + current_time + ".csv"
-
-        # susbcriptionTimeInSec = num(sys.argv[4], 1000) #This is the sampling rate of the subscription for each tag in MSEC
-        # delayTimeToReadTagsInSec= num(sys.argv[5], 30) # This is the time that we will delay to read the values of the tags in SEC
-        # batchLoadSizeItems = num(sys.argv[6], 200) # This is the size of the batch. How many tags should we load at a time (1000 tags)
-        # delayLoadBatchTimeInSec = num (sys.argv[7], 60) # This is the time in milleseconds that we will wait to load each of the batches
-
-        url = "opc.tcp://KPC22014549.kongsberg.master.int:53530/OPCUA/SimulationServer"  # Prosys server
-        # url ="opc.tcp://KPC22014549:21381/MatrikonOpcUaWrapper" # Matrikon server
-        filename = r"C:\Users\sergioc\OneDrive - KONGSBERG MARITIME AS\Projects\Edge Gateway for Shell\GetTags Python App\Taglist.txt"
-        outfile =  r"C:\Users\sergioc\OneDrive - KONGSBERG MARITIME AS\Projects\Edge Gateway for Shell\GetTags Python App\resultTagList-" + current_time +".csv"
-        susbcriptionTimeInSec = num(15, 10)
-        delayTimeToReadTagsInSec = num(60, 30)
-        batchLoadSizeItems = num(100, 200)
-        delayLoadBatchTimeInSec = num (0, 60)        
-        
-        taglist_file_opened = open(filename, "r")
-        result_file_opened = open(outfile, "w")
 
-        d = dict();
-        d['opcServerUrl'] = url
-        d['taglist_file'] = taglist_file_opened
-        d['result_file']  = result_file_opened
-        d['susbcriptionTimeInSec'] = susbcriptionTimeInSec
-        d['delayTimeToReadTagsInSec'] = delayTimeToReadTagsInSec
-        d['batchLoadSizeItems'] = batchLoadSizeItems
-        d['delayLoadBatchTimeInSec'] = delayLoadBatchTimeInSec
+        if len(sys.argv) < 4 or len(sys.argv) > 8:
+            print("Syntax: " , sys.argv[0], "[OpcUaUrl]", "[Inputfile]", "[OutputfileName]", "[SusbcriptionTimeInSec]", "[DelayTimeToReadTagsInSec]",
+                  "[BatchLoadSizeItems]", "[DelayLoadBatchTimeInSec]")
+            sys.exit(-1)
 
-        return d
+        defaults = getDefaultParameters()
+        options = dict()
+        for position, name in enumerate(['susbcriptionTimeInSec', 'delayTimeToReadTagsInSec', 'batchLoadSizeItems', 'delayLoadBatchTimeInSec'], 4):
+            if len(sys.argv) > position:
+                options[name] = num(sys.argv[position], defaults[name])
+        return buildParameters(sys.argv[1], sys.argv[2], sys.argv[3], options)
 
-def readNodeValues (var, dataValue):
-    message = ""
-    error = False
-       
-    #2nd Read the tagId of the tag
-    try:               
-        tagid = var.nodeid.Identifier
-    except Exception as e:
-        error = True
-        tagid = ". Error message: "  + str(e)
-        message = message + ",\t error trying to read the tagId from the tag. "                     
-    
-    #4th Read the whole variant Value of the tag
-    try:               
-        variantValue = str(dataValue.Value).replace(",", ";")
-    except Exception as e:
-        error = True
-        variantValue = ". Error message: "  + str(e)
-        message = message + ",\t error trying to read the variant value from the tag. "
-
-    #5th Read the Value of the tag
-    try:               
-        value = str(dataValue.Value.Value).replace(",", ";")
-    except Exception as e:
-        error = True
-        value = ". Error message: "  + str(e)
-        message = message + ",\t error trying to read the value from the tag. "
-
-    #6th Read the StatusCode of the tag
-    try:               
-        statusCode = str(dataValue.StatusCode).replace(",", ";")
-    except Exception as e:
-        error = True
-        statusCode = ". Error message: "  + str(e)
-        message = message + ",\t error trying to read the statusCode from the tag. "
-
-    #7th Read the timeStamp of the tag
-    try:               
-        timestamp =dataValue.SourceTimestamp.isoformat('T')+"Z"
-    except Exception as e:
-        error = True
-        timestamp = ". Error message: "  + str(e)
-        message = message + ",\t error trying to read the SourceTimestamp from the tag. "  
+def getDefaultParameters():
 
+        d = dict();
+        d['outputFormat'] = "text" # text (original format), csv, binary or parquet
+        d['susbcriptionTimeInSec'] = 15 # Publishing interval (and sampling interval of the tags without one in the tag list)
+        d['delayTimeToReadTagsInSec'] = 60 # Time the subscriptions stay open
+        d['batchLoadSizeItems'] = 100 # Monitored items created by one CreateMonitoredItems request
+        d['delayLoadBatchTimeInSec'] = 0 # Max delay between two batches
+        d['notificationQueueSize'] = 100000 # Max notifications waiting to be written
+        d['writerBatchSize'] = 1000 # Records written to the result file in one go
+        d['writerFlushIntervalInSec'] = 1 # Max time a record waits before it is written
+        d['backPressurePolicy'] = "drop_newest" # What to do when the queue is full: drop_newest, drop_oldest or block
+        d['absoluteDeadband'] = 0 # Default deadbands of the tags, 0 = disabled (see deadband.py)
+        d['percentDeadband'] = 0
+        d['maxSilenceInSec'] = 0 # Write the value at least every maxSilenceInSec even if it did not change, 0 = disabled
+        d['deadbandFile'] = None # Optional CSV with per tag deadbands: tag,absoluteDeadband,percentDeadband,maxSilenceInSec
+        d['reconnect'] = True # Reconnect and restore the subscription when the connection is lost (see sessionsupervisor.py)
+        d['keepAliveIntervalInSec'] = 5 # Time between two reads of the server state to detect a lost connection
+        d['reconnectMinDelayInSec'] = RECONNECT_MIN_DELAY_IN_SEC
+        d['reconnectMaxDelayInSec'] = RECONNECT_MAX_DELAY_IN_SEC
+        d['storeForwardDir'] = None # Folder of the store and forward log: the results are buffered on disk before the result file (see storeforward.py)
+        d['maxItemsPerSubscription'] = DEFAULT_MAX_ITEMS_PER_SUBSCRIPTION # Tags per subscription, more tags (or tags with their own sampling interval) use several
+        d['minPublishingIntervalInSec'] = DEFAULT_MIN_PUBLISHING_INTERVAL_IN_SEC
+        d['maxNotificationsPerPublish'] = DEFAULT_MAX_NOTIFICATIONS_PER_PUBLISH
+        d['queueSize'] = None # Server queue of every monitored item, None = the samples of one publishing interval
+        d['maxKeepAliveCount'] = None # None = DEFAULT_KEEP_ALIVE_TIME_IN_SEC in publishing intervals
+        d['lifetimeCount'] = None # None = DEFAULT_LIFETIME_IN_SEC in publishing intervals
+        d['publishRequestsPerSubscription'] = PUBLISH_REQUESTS_PER_SUBSCRIPTION # Publish requests kept waiting on the server for each subscription, also after a reconnect (python-opcua sends 2, more are sent on top)
+        d['metricsEnabled'] = None # Timers and counters (see metrics.py): None follows OPCUA_METRICS, True/False forces them on/off
+        d['metricsHttpPort'] = None # ex: 9108 to serve http://127.0.0.1:9108/metrics
+        d['metricsJsonFile'] = None # File where a JSON line of metrics is appended every metricsJsonIntervalInSec
+        d['metricsJsonIntervalInSec'] = 60
+        d['debugPrint'] = False # Print every value on the console (slow), at most debugPrintMaxLinesPerSec lines per second
+        d['debugPrintMaxLinesPerSec'] = 10
 
-    if error:
-        message = tagid + " ,\t " + value + " ,\t " + statusCode + " ,\t " + timestamp + ",\t Whole variant value: " + variantValue + ",\t Error message: " + message + " ."
-    else:
-        message = tagid + " ,\t " + value + " ,\t " + statusCode + " ,\t " + timestamp + ",\t Whole variant value: " + variantValue + " ."
-    
-    print("ReadNodeValues \n" , message)
-    return message + "\n"
+        return d
 
-def writeMessageInFile(fileOpened, messageToWrite):
-    fileOpened.write(messageToWrite)
-    fileOpened.write("\n")
+def buildParameters(url, taglistFileName, outputFileName, options=None):
+    """
+    Parameters of run(): getDefaultParameters overridden by options, the tag list opened and the result writer created.
+    The start time and the extension of the output format are appended to outputFileName.
+    """
+    d = getDefaultParameters()
+    d.update(checkOptions(d, options))
+    d['opcServerUrl'] = url
+    d['perTagDeadbands'] = loadDeadbandFile(d['deadbandFile']) if d['deadbandFile'] else None
+    d['taglist_file'] = open(taglistFileName, "r")
+    d['result_writer'] = createResultWriter(d['outputFormat'], outputFileName + current_time + RESULT_FILE_EXTENSIONS[d['outputFormat']])
+    if d['storeForwardDir']:
+        d['result_writer'] = StoreForwardWriter(d['storeForwardDir'], d['result_writer'])
+    return d
+
+def writeMessageInFile(resultWriter, messageToWrite):
+    resultWriter.writeMessage(messageToWrite)
 
 def batch(iterable, n=1):
     l = len(iterable)
     for ndx in range(0, l, n):
         yield iterable[ndx:min(ndx + n, l)]
 
+class NotificationWriter(threading.Thread):
+    """
+    Formats and writes the data change notifications in its own thread.
+    The subscription handler only appends (node, dataValue) to a bounded deque and wakes
+    the writer up through a condition variable: nothing is formatted nor written on the
+    receiving thread. Records are written in batches, when writerBatchSize records are
+    ready or flushIntervalInSec has passed since the last write.
+    Messages (pushMessage) go through the same queue, so they count in maxQueueSize too.
+    When the queue is full the backPressurePolicy decides what happens:
+        drop_newest: the new notification is dropped
+        drop_oldest: the oldest queued notification is dropped
+        block:       the receiving thread waits up to blockTimeoutInSec, then drops the new one
+    """
+    def __init__(self, result_writer, maxQueueSize, writerBatchSize, flushIntervalInSec, backPressurePolicy="drop_newest", blockTimeoutInSec=1):
+        threading.Thread.__init__(self, name="NotificationWriter", daemon=True)
+        self.result_writer = result_writer
+        self.maxQueueSize = maxQueueSize
+        self.writerBatchSize = writerBatchSize
+        self.flushIntervalInSec = flushIntervalInSec
+        self.backPressurePolicy = backPressurePolicy
+        self.blockTimeoutInSec = blockTimeoutInSec
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.notEmpty = threading.Condition(self.lock) # the writer waits on it for work
+        self.notFull = threading.Condition(self.lock) # the receiving threads wait on it with the block policy
+        self.running = True
+        self.enqueuedCount = 0
+        self.droppedCount = 0
+        self.writtenCount = 0
+        self.flushCount = 0
+        self.maxQueueDepth = 0
+        NOTIFICATION_QUEUE_DEPTH.setFunction(lambda: len(self.queue))
+
+    def push(self, node, dataValue):
+        """ Called from the receiving thread. Never formats nor writes. """
+        return self.enqueue((node, dataValue))
+
+    def pushMessage(self, message):
+        """ Write a text line (ex: an error) through the writer so it does not interleave with the data lines. """
+        return self.enqueue((None, message))
+
+    def enqueue(self, item):
+        """ Append the item unless the backPressurePolicy drops it. Returns False when it was dropped. """
+        with self.lock:
+            if len(self.queue) >= self.maxQueueSize:
+                if self.backPressurePolicy == "drop_oldest":
+                    self.queue.popleft()
+                    self.droppedCount += 1
+                    NOTIFICATIONS_DROPPED.inc()
+                elif self.backPressurePolicy == "block" and self.notFull.wait_for(
+                        lambda: len(self.queue) < self.maxQueueSize or not self.running, self.blockTimeoutInSec) \
+                        and len(self.queue) < self.maxQueueSize:
+                    pass
+                else:
+                    self.droppedCount += 1
+                    NOTIFICATIONS_DROPPED.inc()
+                    return False
+            self.queue.append(item)
+            self.enqueuedCount += 1
+            queueDepth = len(self.queue)
+            if queueDepth > self.maxQueueDepth:
+                self.maxQueueDepth = queueDepth
+            self.notEmpty.notify()
+        return True
+
+    def run(self):
+        nodes, dataValues = [], [] # formatted in one go when flushed
+        lastFlushTime = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.queue:
+                    if not self.running:
+                        break
+                    # Wake up for new items, or when the pending records are due
+                    timeout = lastFlushTime + self.flushIntervalInSec - time.monotonic() if nodes else None
+                    if timeout is None or timeout > 0:
+                        self.notEmpty.wait(timeout)
+                items = [self.queue.popleft() for _ in range(min(len(self.queue), self.writerBatchSize))]
+                if items:
+                    self.notFull.notify_all()
+
+            for node, item in items:
+                if node is None:
+                    # Keep the messages in order with the records
+                    self.flush(nodes, dataValues)
+                    nodes, dataValues = [], []
+                    self.result_writer.writeMessage(item)
+                    continue
+                nodes.append(node)
+                dataValues.append(item)
+                if len(nodes) >= self.writerBatchSize:
+                    self.flush(nodes, dataValues)
+                    nodes, dataValues = [], []
+                    lastFlushTime = time.monotonic()
+            if nodes and time.monotonic() - lastFlushTime >= self.flushIntervalInSec:
+                self.flush(nodes, dataValues)
+                nodes, dataValues = [], []
+                lastFlushTime = time.monotonic()
+        self.flush(nodes, dataValues)
+
+    def flush(self, nodes, dataValues):
+        if nodes:
+            self.result_writer.writeRecords(encodeChunk(nodes, dataValues))
+        self.result_writer.flush()
+        self.writtenCount += len(nodes)
+        self.flushCount += 1
+
+    def stop(self):
+        """ Stop the thread once every queued notification has been written. """
+        with self.lock:
+            self.running = False
+            self.notEmpty.notify()
+            self.notFull.notify_all()
+        self.join()
+
+    def getStatistics(self):
+        d = dict()
+        d['queueDepth'] = len(self.queue)
+        d['maxQueueDepth'] = self.maxQueueDepth
+        d['enqueued'] = self.enqueuedCount
+        d['dropped'] = self.droppedCount
+        d['written'] = self.writtenCount
+        d['flushes'] = self.flushCount
+        return d
+
+class HeartbeatTimer(threading.Thread):
+    """
+    Heartbeat of the subscribed tags: the server sends nothing while a tag does not change, so this
+    thread writes the last value of every tag silent for longer than its maxSilenceInSec again,
+    with the current time as timestamps. nodes are in the order of the deadbandFilter indexes.
+    """
+    def __init__(self, deadbandFilter, nodes, notificationWriter):
+        threading.Thread.__init__(self, name="HeartbeatTimer", daemon=True)
+        self.deadbandFilter = deadbandFilter
+        self.nodes = nodes
+        self.notificationWriter = notificationWriter
+        self.indexes = [index for index in range(deadbandFilter.size) if deadbandFilter.maxSilences[index] > 0]
+        self.lastDataValues = dict() # index -> last DataValue written, set by the subscription handler
+        maxSilences = [deadbandFilter.maxSilences[index] for index in self.indexes]
+        self.checkIntervalInSec = min(1.0, min(maxSilences) / 2) if maxSilences else 1.0
+        self.stopEvent = threading.Event()
+
+    def remember(self, index, dataValue):
+        """ Called from the receiving thread for every value written. """
+        if self.deadbandFilter.maxSilences[index] > 0:
+            self.lastDataValues[index] = dataValue
+
+    def run(self):
+        while not self.stopEvent.wait(self.checkIntervalInSec):
+            now = time.monotonic()
+            for index in self.indexes:
+                dataValue = self.lastDataValues.get(index)
+                if dataValue is not None and self.deadbandFilter.heartbeat(index, now):
+                    timestamp = datetime.utcnow()
+                    heartbeatValue = ua.DataValue(dataValue.Value, dataValue.StatusCode)
+                    heartbeatValue.SourceTimestamp = heartbeatValue.ServerTimestamp = timestamp
+                    self.notificationWriter.push(self.nodes[index], heartbeatValue)
+                    HEARTBEATS.inc()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.join()
+
 class subHandler(object):
     """
     Subscription Handler. To receive events from server for a subscription
@@ -152,73 +315,292 @@ class subHandler(object):
         self.obj = obj        
         
     def datachange_notification(self, node, val, data):          
-        line = readNodeValues(node, data.monitored_item.Value)         
-        writeMessageInFile(self.obj.result_file, line) 
+        NOTIFICATIONS.inc()
+        self.obj.notificationCount += 1
+        dataValue = data.monitored_item.Value
+        deadbandFilter = self.obj.deadbandFilter
+        if deadbandFilter is not None:
+            index = self.obj.nodeIndexes.get(node.nodeid)
+            statusCode = dataValue.StatusCode.value if dataValue.StatusCode is not None else 0
+            if index is not None and not deadbandFilter.isReportable(index, val, statusCode):
+                NOTIFICATIONS_FILTERED.inc()
+                return
+            if index is not None and self.obj.heartbeatTimer is not None:
+                self.obj.heartbeatTimer.remember(index, dataValue)
+        self.obj.notificationWriter.push(node, dataValue)
+
+class SubscriptionParameters(object):
+    """
+    Parameters of one subscription (CreateSubscription request) and of its monitored items.
+    samplingIntervalInSec defaults to the publishing interval and queueSize to the samples taken in one publishing interval.
+    maxKeepAliveCount and lifetimeCount default to DEFAULT_KEEP_ALIVE_TIME_IN_SEC and DEFAULT_LIFETIME_IN_SEC in publishing intervals.
+    publishRequests: Publish requests kept waiting on the server for this subscription.
+    """
+    def __init__(self, publishingIntervalInSec, samplingIntervalInSec=None, queueSize=None, maxNotificationsPerPublish=DEFAULT_MAX_NOTIFICATIONS_PER_PUBLISH,
+                 maxKeepAliveCount=None, lifetimeCount=None, priority=0, publishRequests=PUBLISH_REQUESTS_PER_SUBSCRIPTION):
+        self.publishingIntervalInSec = publishingIntervalInSec
+        self.samplingIntervalInSec = publishingIntervalInSec if samplingIntervalInSec is None else samplingIntervalInSec
+        if queueSize is None:
+            queueSize = max(1, int(math.ceil(publishingIntervalInSec / self.samplingIntervalInSec))) if self.samplingIntervalInSec > 0 else 1
+        if maxKeepAliveCount is None:
+            maxKeepAliveCount = max(1, int(math.ceil(DEFAULT_KEEP_ALIVE_TIME_IN_SEC / publishingIntervalInSec))) if publishingIntervalInSec > 0 else 1
+        if lifetimeCount is None:
+            lifetimeCount = int(math.ceil(DEFAULT_LIFETIME_IN_SEC / publishingIntervalInSec)) if publishingIntervalInSec > 0 else 0
+        self.queueSize = queueSize
+        self.maxNotificationsPerPublish = maxNotificationsPerPublish
+        self.maxKeepAliveCount = maxKeepAliveCount
+        self.lifetimeCount = max(lifetimeCount, 3 * maxKeepAliveCount) # the server revises a lifetime under 3 keep-alives anyway
+        self.priority = priority
+        self.publishRequests = max(1, publishRequests)
+
+    def getCreateSubscriptionParameters(self):
+        params = ua.CreateSubscriptionParameters()
+        params.RequestedPublishingInterval = self.publishingIntervalInSec * 1000
+        params.RequestedLifetimeCount = self.lifetimeCount
+        params.RequestedMaxKeepAliveCount = self.maxKeepAliveCount
+        params.MaxNotificationsPerPublish = self.maxNotificationsPerPublish
+        params.PublishingEnabled = True
+        params.Priority = self.priority
+        return params
+
+def planSubscriptionShards(nodes, publishingIntervalInSec, maxItemsPerSubscription=DEFAULT_MAX_ITEMS_PER_SUBSCRIPTION, samplingIntervals=None,
+                           minPublishingIntervalInSec=DEFAULT_MIN_PUBLISHING_INTERVAL_IN_SEC, **parameters):
+    """
+    Split the nodes across subscriptions: one group per sampling interval (samplingIntervals: NodeId -> sec, the nodes
+    without one are sampled every publishingIntervalInSec), cut in subscriptions of at most maxItemsPerSubscription items.
+    A group sampled faster than minPublishingIntervalInSec is published every minPublishingIntervalInSec, its samples
+    queued on the server in between. parameters: the other SubscriptionParameters (maxNotificationsPerPublish...).
+    Returns a list of (SubscriptionParameters, nodes), fastest first.
+    """
+    groups = dict()
+    for node in nodes:
+        samplingIntervalInSec = samplingIntervals.get(node.nodeid) if samplingIntervals else None
+        groups.setdefault(samplingIntervalInSec or publishingIntervalInSec, []).append(node)
+    shards = []
+    for samplingIntervalInSec in sorted(groups):
+        groupPublishingIntervalInSec = max(samplingIntervalInSec, min(minPublishingIntervalInSec, publishingIntervalInSec))
+        subscriptionParameters = SubscriptionParameters(groupPublishingIntervalInSec, samplingIntervalInSec, **parameters)
+        for shardNodes in batch(groups[samplingIntervalInSec], max(1, maxItemsPerSubscription)):
+            shards.append((subscriptionParameters, shardNodes))
+    return shards
+
+def createSubscriptions(opcua_client_session, result_writer, shards, notificationWriter, deadbandFilter=None, allNodes=None,
+                        batchLoadSizeItems=1000, delayLoadBatchTimeInSec=0, heartbeatTimer=None):
+    """
+    One OpcUaSubscription per shard of planSubscriptionShards, its monitored items created batch by batch.
+    allNodes: the nodes in the order of the deadbandFilter indexes (all the nodes of the shards by default).
+    heartbeatTimer (optional) gets the values written, to write them again when their tag stays silent.
+    """
+    if allNodes is None:
+        allNodes = [node for subscriptionParameters, nodes in shards for node in nodes]
+    nodeIndexes = dict((node.nodeid, index) for index, node in enumerate(allNodes))
+    subscriptions = []
+    for subscriptionParameters, nodes in shards:
+        subscription = OpcUaSubscription(opcua_client_session, result_writer, subscriptionParameters, notificationWriter, deadbandFilter, nodeIndexes)
+        subscription.heartbeatTimer = heartbeatTimer
+        subscription.start_Subscription_LazyLoad(nodes, batchLoadSizeItems, delayLoadBatchTimeInSec)
+        subscriptions.append(subscription)
+    return subscriptions
 
 class OpcUaSubscription(object):
-
-    def __init__(self, opcua_client_session, result_file, susbcriptionTimeInSec):
-        self.result_file = result_file
-
-        handler = subHandler(self)
-        susbcriptionTimeInMSec = susbcriptionTimeInSec * 1000   # Converted from Sec into Msec
-        self.sub = opcua_client_session.create_subscription(susbcriptionTimeInMSec, handler)
+    """
+    One subscription and its monitored items.
+    susbcriptionTimeInSec is the publishing interval (python-opcua default parameters), or a SubscriptionParameters.
+    nodeIndexes (optional) is the NodeId -> deadbandFilter index map shared by the subscriptions of one deadbandFilter.
+    """
+    def __init__(self, opcua_client_session, result_writer, susbcriptionTimeInSec, notificationWriter, deadbandFilter=None, nodeIndexes=None):
+        self.result_writer = result_writer
+        self.notificationWriter = notificationWriter
+        self.deadbandFilter = deadbandFilter   # DeadbandFilter indexed by the position of the node in the subscribed list
+        self.nodeIndexes = nodeIndexes if nodeIndexes is not None else dict()   # NodeId -> index in deadbandFilter
+        self.heartbeatTimer = None   # HeartbeatTimer of the deadbandFilter, if any tag has a heartbeat
+
+        self.session = opcua_client_session
+        self.handler = subHandler(self)
+        if isinstance(susbcriptionTimeInSec, SubscriptionParameters):
+            self.parameters = susbcriptionTimeInSec
+        else:
+            self.parameters = SubscriptionParameters(susbcriptionTimeInSec, queueSize=0, maxNotificationsPerPublish=10000, maxKeepAliveCount=3000, lifetimeCount=10000)
+        self.createSubscription()
+        self.nodes = []   # all the nodes subscribed, to create the subscription again after a session loss
         self.arraynodesHandlers = []        
+        self.failedNodes = []   # (node, StatusCode) of the nodes the server did not accept
+        self.notificationCount = 0
+
+    def createSubscription(self):
+        """ CreateSubscription request, then the Publish requests beyond the ones python-opcua sends. """
+        self.sub = self.session.create_subscription(self.parameters.getCreateSubscriptionParameters(), self.handler)
+        for i in range(self.parameters.publishRequests - PUBLISH_REQUESTS_PER_SUBSCRIPTION):
+            self.session.uaclient.publish()
     
     def start_Subscription_LazyLoad(self, nodes, batchLoadSizeItems, delayLoadBatchTimeInSec ):
-        delayToSubscribeBetweenNodes = delayLoadBatchTimeInSec/batchLoadSizeItems
-
-        for batchNodes in batch(arrayNodes, batchLoadSizeItems):
+        """
+        Subscribe the nodes batch by batch, one CreateMonitoredItems request per batch.
+        The delay between batches follows the server: we wait as long as the last request took
+        (a busy server gets more time to recover), never more than delayLoadBatchTimeInSec.
+        """
+        for index, node in enumerate(nodes):
+            self.nodeIndexes.setdefault(node.nodeid, index)
+        self.nodes.extend(nodes)
+
+        batches = list(batch(nodes, batchLoadSizeItems))
+        for idx, batchNodes in enumerate(batches):
             # Add all nodes into a subscription and start listening
-            self.start_Subscription(batchNodes) 
+            requestTimeInSec = self.start_Subscription(batchNodes) 
 
             # Add a small delay between subscription
-            time.sleep(delayLoadBatchTimeInSec )    
-
-
+            if idx < len(batches) - 1:
+                time.sleep(min(requestTimeInSec * BATCH_DELAY_LATENCY_FACTOR, delayLoadBatchTimeInSec))
 
     def start_Subscription(self, nodes):
-        for node in nodes:
+        """
+        Create the monitored items of all the nodes with a single CreateMonitoredItems request.
+        Tags with a deadband get a server side DataChangeFilter; items whose
+        filter is rejected by the server are created again without it (the client side filter still applies).
+        Returns the time in seconds the server took to answer.
+        """
+        nodes = list(nodes)
+        startTime = time.perf_counter()
+        try:
+            requests = [self.makeMonitoredItemRequest(node) for node in nodes]
+            results = self.sub.create_monitored_items(requests)
+            retryIndexes = [i for i, result in enumerate(results) if isinstance(result, ua.StatusCode) and requests[i].RequestedParameters.Filter is not None]
+            if retryIndexes:
+                retryResults = self.sub.create_monitored_items([self.makeMonitoredItemRequest(nodes[i], False) for i in retryIndexes])
+                for i, result in zip(retryIndexes, retryResults):
+                    results[i] = result
+        except Exception as e:
+            results = [e] * len(nodes)
+        requestTimeInSec = time.perf_counter() - startTime
+
+        for node, result in zip(nodes, results):
+            if isinstance(result, int):
+                self.arraynodesHandlers.append(result)
+            else:
+                self.failedNodes.append((node, result))
+                errorMessage = ". Error adding node " + str(node.nodeid) + ": " + str(result)
+                self.notificationWriter.pushMessage(errorMessage)        
+        return requestTimeInSec
+
+    def recreate_Subscription(self, batchSize=1000):
+        """
+        Create the subscription again with all its nodes, after the session and its subscriptions were lost.
+        The monitored items are created in bulk, without the lazy load delays.
+        """
+        self.session.uaclient._publishcallbacks.pop(self.sub.subscription_id, None)
+        self.createSubscription()
+        self.arraynodesHandlers = []
+        self.failedNodes = []
+        for batchNodes in batch(self.nodes, batchSize):
+            self.start_Subscription(batchNodes)
+
+    def makeMonitoredItemRequest(self, node, withFilter=True):
+        dataChangeFilter = None
+        index = self.nodeIndexes.get(node.nodeid)
+        # The heartbeats do not come from the server (see HeartbeatTimer), the tags with one keep the server side deadband
+        if withFilter and self.deadbandFilter is not None and index is not None:
+            dataChangeFilter = makeDataChangeFilter(self.deadbandFilter.getDeadband(index))
+        request = self.sub._make_monitored_item_request(node, ua.AttributeIds.Value, dataChangeFilter, self.parameters.queueSize)
+        request.RequestedParameters.SamplingInterval = self.parameters.samplingIntervalInSec * 1000
+        return request
+
+    def close_Subscription(self, batchSize=1000):
+        # One DeleteMonitoredItems request per batch of handles
+        for handles in batch(self.arraynodesHandlers, batchSize):
             try:
-                nodehandle = self.sub.subscribe_data_change(node)
-                self.arraynodesHandlers.append(nodehandle)    
+                self.sub.unsubscribe(handles)
             except Exception as e:
-                error = True
-                errorMessage = ". Error adding node " + str(node.nodeid) + ": " + str(e)
-                writeMessageInFile(self.result_file, errorMessage)        
-
-    def close_Subscription(self):
-        for handle in self.arraynodesHandlers:
-            self.sub.unsubscribe(handle)
+                self.notificationWriter.pushMessage(". Error removing monitored items: " + str(e))
+        self.arraynodesHandlers = []
         self.sub.delete()   
 
-if __name__ == "__main__":  
-
-    logging.basicConfig(level=logging.ERROR)      
+    def getStatistics(self):
+        d = dict()
+        d['subscriptionId'] = self.sub.subscription_id
+        d['items'] = len(self.arraynodesHandlers)
+        d['failedItems'] = len(self.failedNodes)
+        d['publishingIntervalInSec'] = self.parameters.publishingIntervalInSec
+        d['samplingIntervalInSec'] = self.parameters.samplingIntervalInSec
+        d['queueSize'] = self.parameters.queueSize
+        d['notifications'] = self.notificationCount
+        return d
 
-    parameters = getParameters()
+def run(parameters):
+    """ Subscribe to every tag of parameters['taglist_file'] for delayTimeToReadTagsInSec and write the notifications. Closes the files. """
+    jsonDump = metrics.configure(parameters)
+    opcua_client = None
 
     try:               
-        firstLineMessage = "Tagid  ,\t Value ,\t StatusCode ,\t Timestamp ,\t Variant value ,\t Error messages"                   
-        writeMessageInFile(parameters['result_file'], firstLineMessage)
-        
         # Init Opcua Client Session
         opcua_client = opcUaClient(parameters['opcServerUrl'])
 
         # Read the nodes from server 
-        arrayNodes = opcua_client.getArrayNodesFromOpcServer(parameters['taglist_file'],parameters['result_file'])
-
-        # Create OpcUa Susbcription
-        subscription = OpcUaSubscription(opcua_client.session, parameters['result_file'], parameters['susbcriptionTimeInSec'])
-
-        # Add items into susbcription with a delay between addings
-        subscription.start_Subscription_LazyLoad(arrayNodes, parameters['batchLoadSizeItems'], parameters['delayLoadBatchTimeInSec'])               
+        arrayNodes = opcua_client.getArrayNodesFromOpcServer(parameters['taglist_file'],parameters['result_writer'])
+
+        # Start the thread which writes the notifications into the result file
+        notificationWriter = NotificationWriter(parameters['result_writer'], parameters['notificationQueueSize'], parameters['writerBatchSize'],
+                                                parameters['writerFlushIntervalInSec'], parameters['backPressurePolicy'])
+        notificationWriter.start()
+
+        # Deadbands and heartbeat of the tags, None if not configured
+        deadbandFilter = createDeadbandFilter(arrayNodes, parameters['absoluteDeadband'], parameters['percentDeadband'],
+                                              parameters['maxSilenceInSec'], parameters['perTagDeadbands'], opcua_client.session)
+
+        # Split the tags across subscriptions, by sampling interval and size
+        shards = planSubscriptionShards(arrayNodes, parameters['susbcriptionTimeInSec'], parameters['maxItemsPerSubscription'], opcua_client.samplingIntervals,
+                                        parameters['minPublishingIntervalInSec'], queueSize=parameters['queueSize'],
+                                        maxNotificationsPerPublish=parameters['maxNotificationsPerPublish'], maxKeepAliveCount=parameters['maxKeepAliveCount'],
+                                        lifetimeCount=parameters['lifetimeCount'], publishRequests=parameters['publishRequestsPerSubscription'])
+
+        # Write the last value again of the tags silent for longer than their maxSilenceInSec
+        heartbeatTimer = None
+        if deadbandFilter is not None and any(maxSilence > 0 for maxSilence in deadbandFilter.maxSilences):
+            heartbeatTimer = HeartbeatTimer(deadbandFilter, arrayNodes, notificationWriter)
+            heartbeatTimer.start()
+
+        # Create OpcUa Susbcriptions and add their items with a delay between addings
+        subscriptions = createSubscriptions(opcua_client.session, parameters['result_writer'], shards, notificationWriter, deadbandFilter, arrayNodes,
+                                            parameters['batchLoadSizeItems'], parameters['delayLoadBatchTimeInSec'], heartbeatTimer)
+
+        # Reconnect and restore the subscription if the connection is lost while reading
+        supervisor = None
+        if parameters['reconnect']:
+            supervisor = SessionSupervisor(opcua_client.session, subscriptions, notificationWriter, keepAliveIntervalInSec=parameters['keepAliveIntervalInSec'],
+                                           minDelayInSec=parameters['reconnectMinDelayInSec'], maxDelayInSec=parameters['reconnectMaxDelayInSec'])
+            supervisor.start()
 
         # Delay the program to read the values 
         time.sleep(parameters['delayTimeToReadTagsInSec'] ) #Default 30 sec to read the value of all tags
 
-        # Close the subscription
-        subscription.close_Subscription()
+        if supervisor is not None:
+            supervisor.stop()
+            print("Session supervisor statistics:", supervisor.getStatistics())
+
+        # Close the subscriptions
+        for subscription in subscriptions:
+            print("Subscription statistics:", subscription.getStatistics())
+            subscription.close_Subscription()
+
+        # Write what is still queued and show the queue statistics
+        if heartbeatTimer is not None:
+            heartbeatTimer.stop()
+        notificationWriter.stop()
+        print("Notification writer statistics:", notificationWriter.getStatistics())
+        if deadbandFilter is not None:
+            print("Deadband filter statistics:", deadbandFilter.getStatistics())
+        if isinstance(parameters['result_writer'], StoreForwardWriter):
+            print("Store and forward statistics:", parameters['result_writer'].getStatistics())
         
     finally:
-        opcua_client.session.disconnect()
\ No newline at end of file
+        if opcua_client is not None:
+            opcua_client.disconnect()
+        parameters['taglist_file'].close()
+        parameters['result_writer'].close()
+        if jsonDump is not None:
+            jsonDump.stop()
+
+if __name__ == "__main__":  
+
+    logging.basicConfig(level=logging.ERROR)      
+
+    run(getParameters())
\ No newline at end of file
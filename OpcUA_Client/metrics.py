@@ -0,0 +1,316 @@
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Lightweight in-process metrics: counters, gauges and histograms kept in a registry.
+#   - setEnabled(False) (or the environment variable OPCUA_METRICS=0) turns every update into a no-op
+#   - startHttpServer(port) serves them on http://127.0.0.1:port/metrics (Prometheus text format)
+#     and http://127.0.0.1:port/metrics.json
+#   - startJsonDump(fileName, intervalInSec) appends one JSON line per interval, with the rate per
+#     second of every counter since the previous line
+#   - debugPrint replaces the console print of every value: off by default, and at most
+#     maxLinesPerSec lines per second when on
+# The metrics are created once by name (counter/gauge/histogram return the existing one), so
+# every module can declare the ones it updates at import time.
+
+LATENCY_BUCKETS_IN_SEC = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_enabledByEnvironment = os.environ.get("OPCUA_METRICS", "1") != "0"
+_enabled = _enabledByEnvironment
+_registry = dict() # name -> metric, in creation order
+_registryLock = threading.Lock()
+
+def setEnabled(enabled):
+    global _enabled
+    _enabled = enabled
+
+def isEnabled():
+    return _enabled
+
+class Counter(object):
+    """ Value which only goes up (requests, values read, bytes...). """
+    kind = "counter"
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        if _enabled:
+            with self.lock:
+                self.value += amount
+
+    def getValue(self):
+        return self.value
+
+class Gauge(object):
+    """ Value which goes up and down. With setFunction the value is computed when the metrics are exported. """
+    kind = "gauge"
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        if _enabled:
+            self.value = value
+
+    def setFunction(self, function):
+        self.function = function
+
+    def getValue(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return None
+        return self.value
+
+class Histogram(object):
+    """ Distribution of durations (seconds) in fixed buckets, plus their count and sum. """
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS_IN_SEC):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        if _enabled:
+            index = bisect.bisect_left(self.buckets, value)
+            with self.lock:
+                self.counts[index] += 1
+                self.count += 1
+                self.sum += value
+
+    def time(self):
+        """ Context manager observing the time spent in the with block. """
+        return HistogramTimer(self)
+
+    def getValue(self):
+        with self.lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        d = dict()
+        d['count'] = count
+        d['sum'] = round(total, 6)
+        d['mean'] = round(total / count, 6) if count else None
+        d['p50'] = self.percentile(counts, count, 50)
+        d['p99'] = self.percentile(counts, count, 99)
+        return d
+
+    def percentile(self, counts, count, p):
+        """ Upper bound of the bucket holding the p-th percentile. """
+        if not count:
+            return None
+        rank = count * p / 100.0
+        cumulative = 0
+        for bound, bucketCount in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucketCount
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+class HistogramTimer(object):
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.startTime = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.histogram.observe(time.perf_counter() - self.startTime)
+        return False
+
+def _getOrCreate(metricClass, name, description, *args):
+    with _registryLock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = metricClass(name, description, *args)
+            _registry[name] = metric
+        return metric
+
+def counter(name, description=""):
+    return _getOrCreate(Counter, name, description)
+
+def gauge(name, description=""):
+    return _getOrCreate(Gauge, name, description)
+
+def histogram(name, description="", buckets=LATENCY_BUCKETS_IN_SEC):
+    return _getOrCreate(Histogram, name, description, buckets)
+
+def timeCalls(function, histogram):
+    """ Wrap function so the duration of every call is observed by histogram. """
+    def timed(*args, **kwargs):
+        if not _enabled:
+            return function(*args, **kwargs)
+        startTime = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - startTime)
+    return timed
+
+def snapshot():
+    """ dict name -> value (dict for the histograms) of all the metrics. """
+    with _registryLock:
+        metrics = list(_registry.values())
+    return dict((metric.name, metric.getValue()) for metric in metrics)
+
+def renderPrometheus():
+    """ All the metrics in the Prometheus text exposition format. """
+    with _registryLock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.append("# HELP " + metric.name + " " + metric.description)
+        lines.append("# TYPE " + metric.name + " " + metric.kind)
+        if metric.kind == "histogram":
+            with metric.lock:
+                counts, count, total = list(metric.counts), metric.count, metric.sum
+            cumulative = 0
+            for bound, bucketCount in zip(metric.buckets, counts):
+                cumulative += bucketCount
+                lines.append('%s_bucket{le="%s"} %d' % (metric.name, bound, cumulative))
+            lines.append('%s_bucket{le="+Inf"} %d' % (metric.name, count))
+            lines.append("%s_sum %s" % (metric.name, repr(total)))
+            lines.append("%s_count %d" % (metric.name, count))
+        else:
+            value = metric.getValue()
+            lines.append("%s %s" % (metric.name, "NaN" if value is None else repr(value)))
+    return "\n".join(lines) + "\n"
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = renderPrometheus().encode("utf-8")
+            contentType = "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body = json.dumps(snapshot()).encode("utf-8")
+            contentType = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # no console line per scrape
+
+def startHttpServer(port, host="127.0.0.1"):
+    """ Serve the metrics from a daemon thread. Returns the server (call shutdown() to stop it). """
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="MetricsHttpServer", daemon=True).start()
+    return server
+
+class JsonDump(threading.Thread):
+    """ Append a snapshot of the metrics to fileName every intervalInSec (JSON lines), and a last one on stop. """
+    def __init__(self, fileName, intervalInSec):
+        threading.Thread.__init__(self, name="MetricsJsonDump", daemon=True)
+        self.fileName = fileName
+        self.intervalInSec = intervalInSec
+        self.stopEvent = threading.Event()
+        self.lastCounters = dict()
+        self.lastTime = time.monotonic()
+
+    def run(self):
+        while not self.stopEvent.wait(self.intervalInSec):
+            self.dump()
+
+    def dump(self):
+        now = time.monotonic()
+        metrics = snapshot()
+        elapsed = now - self.lastTime
+        rates = dict()
+        with _registryLock:
+            registry = list(_registry.items())
+        for name, metric in registry:
+            if metric.kind == "counter":
+                rates[name] = round((metrics[name] - self.lastCounters.get(name, 0)) / elapsed, 3) if elapsed > 0 else 0
+                self.lastCounters[name] = metrics[name]
+        self.lastTime = now
+        with open(self.fileName, "a") as f:
+            f.write(json.dumps({"time": time.time(), "metrics": metrics, "ratesPerSec": rates}) + "\n")
+
+    def stop(self):
+        self.stopEvent.set()
+        self.join()
+        self.dump()
+
+def startJsonDump(fileName, intervalInSec=60):
+    jsonDump = JsonDump(fileName, intervalInSec)
+    jsonDump.start()
+    return jsonDump
+
+class DebugPrinter(object):
+    """ Print at most maxLinesPerSec lines per second, then one line with the number of lines skipped. """
+    def __init__(self, maxLinesPerSec):
+        self.maxLinesPerSec = maxLinesPerSec
+        self.windowStart = time.monotonic()
+        self.linesInWindow = 0
+        self.skippedLines = 0
+        self.lock = threading.Lock()
+
+    def print(self, *args):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.windowStart >= 1:
+                if self.skippedLines:
+                    print("...", self.skippedLines, "lines not printed")
+                self.windowStart = now
+                self.linesInWindow = 0
+                self.skippedLines = 0
+            if self.linesInWindow >= self.maxLinesPerSec:
+                self.skippedLines += 1
+                return
+            self.linesInWindow += 1
+        print(*args)
+
+_debugPrinter = None
+
+def setDebugPrint(enabled, maxLinesPerSec=10):
+    global _debugPrinter
+    _debugPrinter = DebugPrinter(maxLinesPerSec) if enabled else None
+
+def isDebugPrintEnabled():
+    return _debugPrinter is not None
+
+def debugPrint(*args):
+    """ Console line for one value, only in debug mode (see setDebugPrint). """
+    if _debugPrinter is not None:
+        _debugPrinter.print(*args)
+
+def configure(parameters):
+    """
+    Apply the metrics entries of getParameters: metricsEnabled, metricsHttpPort, metricsJsonFile,
+    metricsJsonIntervalInSec, debugPrint, debugPrintMaxLinesPerSec. Returns the JsonDump or None.
+    metricsEnabled None (the default) follows the environment variable OPCUA_METRICS.
+    """
+    enabled = parameters.get('metricsEnabled')
+    setEnabled(_enabledByEnvironment if enabled is None else enabled)
+    setDebugPrint(parameters.get('debugPrint', False), parameters.get('debugPrintMaxLinesPerSec', 10))
+    if _enabled and parameters.get('metricsHttpPort'):
+        try:
+            startHttpServer(parameters['metricsHttpPort'])
+        except OSError as e:
+            print("Metrics endpoint not started:", e, file=sys.stderr)
+    if _enabled and parameters.get('metricsJsonFile'):
+        return startJsonDump(parameters['metricsJsonFile'], parameters.get('metricsJsonIntervalInSec', 60))
+    return None
@@ -0,0 +1,173 @@
+import argparse
+import importlib
+import json
+import logging
+import sys
+
+# One command for the tag readers, configured from the command line and/or a config file
+# instead of the parameters written in every script:
+#   python opcuatags.py read      --url opc.tcp://server:53530/OPCUA/SimulationServer --taglist taglist.txt --output resultTagList
+#   python opcuatags.py subscribe --config plant.json --interval 1 --duration 3600
+#   python opcuatags.py poll      --config plant.json --scan-rate 10 --format csv
+#   python opcuatags.py bench     --tags 5000 --readers stream,adaptive     (the options of benchmark.py)
+#   python opcuatags.py aggregate resultTagList.bin --windows 60,3600        (the options of aggregate.py)
+# read, subscribe and poll run gettags_improvement.py, gettags_subscription.py and gettags_polling.py.
+# Every parameter of their getDefaultParameters can be set: the common ones have an option
+# (opcuatags.py <command> --help), any other one with --set name=value (value in JSON: 10, true, "text").
+#
+# Config file (--config): a JSON object with "url", "taglist", "output" and parameters. The ones at
+# the top level apply to every command which has them, the ones in the "read", "subscribe" and
+# "poll" objects to that command only:
+#     {"url": "opc.tcp://server:53530/OPCUA/SimulationServer", "taglist": "taglist.txt", "output": "resultTagList",
+#      "outputFormat": "binary", "read": {"chunkSize": 2000}, "subscribe": {"susbcriptionTimeInSec": 1}}
+# The command line wins over the config file, which wins over the defaults of the scripts.
+# The OPC UA stack and the readers are imported only when a command runs, so --help answers at once.
+# One file executable: pyinstaller --onefile opcuatags.py
+
+COMMANDS = {"read": "gettags_improvement", "subscribe": "gettags_subscription", "poll": "gettags_polling"}
+TOOL_COMMANDS = {"bench": "benchmark", "aggregate": "aggregate"} # scripts with their own options, given the rest of the command line
+COMMAND_HELP = [("read", "read every tag once"),
+                ("subscribe", "subscribe to the tags and write their changes"),
+                ("poll", "read the tags again and again at their scan rates"),
+                ("bench", "benchmark the readers against a simulated server (opcuatags.py bench --help)"),
+                ("aggregate", "per tag aggregates of result files in time windows (opcuatags.py aggregate --help)")]
+CONFIG_FILE_KEYS = ["url", "taglist", "output"] + list(COMMANDS)
+
+def parseBool(value):
+    if value.lower() in ("1", "true", "yes", "on"):
+        return True
+    if value.lower() in ("0", "false", "no", "off"):
+        return False
+    raise argparse.ArgumentTypeError("true or false expected, not " + value)
+
+def parseSetting(setting):
+    """ "name=value" -> (name, value), value read as JSON when it is JSON, as text otherwise. """
+    name, separator, value = setting.partition("=")
+    if not separator or not name.strip():
+        raise argparse.ArgumentTypeError("name=value expected, not " + setting)
+    try:
+        return name.strip(), json.loads(value)
+    except ValueError:
+        return name.strip(), value
+
+# (option, parameter, type, commands, help)
+OPTIONS = [
+    ("--format", "outputFormat", str, "read subscribe poll", "output format: text, csv, binary or parquet"),
+    ("--store-forward-dir", "storeForwardDir", str, "subscribe poll", "buffer the results on disk in this folder before the result file"),
+    ("--mode", "readMode", str, "read", "stream, batch, node or compare"),
+    ("--chunk-size", "chunkSize", int, "read poll", "ReadValueIds per Read request (starting point when adaptive)"),
+    ("--adaptive", "adaptiveRead", parseBool, "read", "true: adjust chunk size and requests in flight to the server, false: use them as given"),
+    ("--requests-in-flight", "requestsInFlight", int, "read", "Read requests in flight on the session (starting point when adaptive)"),
+    ("--max-requests-in-flight", "maxRequestsInFlight", int, "read", "max Read requests in flight when adaptive"),
+    ("--target-latency", "targetReadLatencyInSec", float, "read", "Read round trip (sec) under which the requests grow when adaptive"),
+    ("--interval", "susbcriptionTimeInSec", float, "subscribe", "publishing interval in sec (and sampling interval of the tags without one)"),
+    ("--duration", "delayTimeToReadTagsInSec", float, "subscribe", "sec the subscriptions stay open"),
+    ("--batch-size", "batchLoadSizeItems", int, "subscribe", "monitored items per CreateMonitoredItems request"),
+    ("--batch-delay", "delayLoadBatchTimeInSec", float, "subscribe", "max sec between two CreateMonitoredItems requests"),
+    ("--max-items-per-subscription", "maxItemsPerSubscription", int, "subscribe", "tags per subscription, more tags use several subscriptions"),
+    ("--min-publishing-interval", "minPublishingIntervalInSec", float, "subscribe", "tags sampled faster are published at this interval"),
+    ("--max-notifications-per-publish", "maxNotificationsPerPublish", int, "subscribe", "notifications per Publish response"),
+    ("--queue-size", "queueSize", int, "subscribe", "server queue of every monitored item"),
+    ("--publish-requests", "publishRequestsPerSubscription", int, "subscribe", "Publish requests kept waiting on the server per subscription (2: the ones python-opcua sends)"),
+    ("--notification-queue-size", "notificationQueueSize", int, "subscribe", "notifications waiting to be written before back pressure"),
+    ("--back-pressure", "backPressurePolicy", str, "subscribe", "drop_newest, drop_oldest or block"),
+    ("--writer-batch-size", "writerBatchSize", int, "subscribe", "records written in one go"),
+    ("--writer-flush-interval", "writerFlushIntervalInSec", float, "subscribe", "max sec a record waits before it is written"),
+    ("--reconnect", "reconnect", parseBool, "subscribe", "reconnect and restore the subscriptions when the connection is lost"),
+    ("--scan-rate", "defaultScanRateInSec", float, "poll", "scan rate in sec of the tags without one in the tag list"),
+    ("--run-time", "runTimeInSec", float, "poll", "sec to run, 0 until Ctrl+C"),
+    ("--status-interval", "statusIntervalInSec", float, "poll", "sec between two prints of the statistics"),
+    ("--absolute-deadband", "absoluteDeadband", float, "subscribe poll", "default absolute deadband of the tags, 0 disabled"),
+    ("--percent-deadband", "percentDeadband", float, "subscribe poll", "default percent deadband (of the EU range), 0 disabled"),
+    ("--max-silence", "maxSilenceInSec", float, "subscribe poll", "write a value at least every this many sec, 0 disabled"),
+    ("--deadband-file", "deadbandFile", str, "subscribe poll", "CSV of per tag deadbands: tag,absoluteDeadband,percentDeadband,maxSilenceInSec"),
+    ("--metrics", "metricsEnabled", parseBool, "read subscribe poll", "timers and counters on (true) or off (false)"),
+    ("--metrics-port", "metricsHttpPort", int, "read subscribe poll", "serve the metrics on http://127.0.0.1:PORT/metrics"),
+    ("--metrics-json", "metricsJsonFile", str, "read subscribe poll", "append a JSON line of metrics to this file"),
+    ("--metrics-json-interval", "metricsJsonIntervalInSec", float, "read subscribe poll", "sec between two JSON lines of metrics"),
+    ("--debug-print", "debugPrint", parseBool, "read subscribe", "print every value on the console (slow)"),
+]
+
+def buildParser():
+    parser = argparse.ArgumentParser(prog="opcuatags", description="Read OPC UA tags into a result file")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+    for command, description in COMMAND_HELP:
+        if command not in COMMANDS:
+            subparsers.add_parser(command, help=description, add_help=False)
+            continue
+        subparser = subparsers.add_parser(command, help=description, description=description)
+        subparser.add_argument("--config", help="JSON config file")
+        subparser.add_argument("--url", help="OPC UA server url")
+        subparser.add_argument("--taglist", help="file with the tag list")
+        subparser.add_argument("--output", help="result file name, the start time and the extension of the format are appended")
+        subparser.add_argument("--set", dest="settings", action="append", type=parseSetting, default=[], metavar="NAME=VALUE",
+                               help="any other parameter of the command")
+        subparser.add_argument("--log-level", default="ERROR", help="logging level: DEBUG, INFO, WARNING, ERROR")
+        for option, parameter, optionType, commands, help in OPTIONS:
+            if command in commands.split():
+                subparser.add_argument(option, dest=parameter, type=optionType, metavar="VALUE", help=help)
+    return parser
+
+def loadConfig(fileName):
+    with open(fileName) as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError(fileName + ": a JSON object is expected")
+    return config
+
+def getOptions(command, args, config):
+    """
+    Parameters of the command set by the config file and the command line, without its defaults.
+    Returns (url, taglist, output, options).
+    """
+    module = importlib.import_module(COMMANDS[command])
+    defaults = module.getDefaultParameters()
+    section = config.get(command) or dict()
+
+    # A top level key must be a parameter of one of the commands, a typo would be ignored otherwise
+    allParameters = set()
+    for moduleName in COMMANDS.values():
+        allParameters.update(importlib.import_module(moduleName).getDefaultParameters())
+    unknown = sorted(key for key in config if key not in allParameters and key not in CONFIG_FILE_KEYS)
+    if unknown:
+        raise ValueError("Unknown parameters in the config file: " + ", ".join(unknown))
+
+    options = dict((key, value) for key, value in config.items() if key in defaults)
+    options.update((key, value) for key, value in section.items() if key not in CONFIG_FILE_KEYS)
+    options.update(args.settings)
+    for option, parameter, optionType, commands, help in OPTIONS:
+        value = getattr(args, parameter, None)
+        if value is not None:
+            options[parameter] = value
+
+    def setting(name):
+        value = getattr(args, name)
+        if value is None:
+            value = section.get(name, config.get(name))
+        return value
+    return setting("url"), setting("taglist"), setting("output"), options
+
+def main(argv=None):
+    parser = buildParser()
+    args, rest = parser.parse_known_args(argv)
+    if args.command in TOOL_COMMANDS:
+        importlib.import_module(TOOL_COMMANDS[args.command]).main(rest, prog="opcuatags " + args.command)
+        return
+    if rest:
+        parser.error("unrecognized arguments: " + " ".join(rest))
+
+    logging.basicConfig(level=args.log_level.upper())
+    try:
+        config = loadConfig(args.config) if args.config else dict()
+        url, taglist, output, options = getOptions(args.command, args, config)
+        if not url or not taglist or not output:
+            parser.error("--url, --taglist and --output are needed (on the command line or in the config file)")
+        module = importlib.import_module(COMMANDS[args.command])
+        parameters = module.buildParameters(url, taglist, output, options)
+    except (OSError, ValueError) as e:
+        sys.exit("opcuatags " + args.command + ": " + str(e))
+    module.run(parameters)
+
+if __name__ == "__main__":
+    main()
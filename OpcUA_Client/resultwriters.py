@@ -0,0 +1,436 @@
+import csv
+import os
+import struct
+import time
+
+from datetime import datetime, timedelta
+from opcua import ua
+import metrics
+from tagencoder import ScanRecord, TextRowEncoder
+
+# Result writers shared by gettags.py, gettags_improvement.py and gettags_subscription.py.
+# Every reader builds one ScanRecord per value and hands it to a ResultWriter, the
+# writer decides how the record is stored:
+#   text:    the original ",\t" separated lines (lossy, kept for compatibility)
+#   csv:     proper CSV, one column per field, values not altered
+#   binary:  struct-packed append log, numeric values stored natively (see BinaryResultWriter)
+#   parquet: columnar file, needs pyarrow
+
+RESULT_FILE_EXTENSIONS = {"text": ".csv", "csv": ".csv", "binary": ".bin", "parquet": ".parquet"}
+
+EPOCH = datetime(1970, 1, 1)
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+METRICS_UPDATE_RECORDS = 1000 # records written one by one between two updates of the records/bytes written gauges
+
+def toMicroseconds(timestamp):
+    """ Microseconds since 1970-01-01 of a UTC datetime, BinaryResultWriter.NO_TIMESTAMP for None. """
+    if timestamp is None:
+        return BinaryResultWriter.NO_TIMESTAMP
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.replace(tzinfo=None) - timestamp.utcoffset()
+    delta = timestamp - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+class ResultWriter(object):
+    """
+    Base class of the result writers.
+    writeRecord stores one ScanRecord, writeMessage stores a free text line (errors).
+    bytesWritten and recordsWritten can be used to compare the backends.
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.recordsWritten = 0
+
+    def writeRecord(self, record):
+        raise NotImplementedError()
+
+    def writeRecords(self, records):
+        for record in records:
+            self.writeRecord(record)
+
+    def writeMessage(self, message):
+        raise NotImplementedError()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    @property
+    def bytesWritten(self):
+        raise NotImplementedError()
+
+class TextResultWriter(ResultWriter):
+    """ The original output: ",\t" separated columns, commas in the values replaced by ";". """
+
+    def __init__(self, fileName, header=None, gettagsLayout=False):
+        ResultWriter.__init__(self, fileName)
+        self.gettagsLayout = gettagsLayout
+        self.encoder = TextRowEncoder(gettagsLayout)
+        self.file = open(fileName, "w")
+        if header is None:
+            if gettagsLayout:
+                header = "Tag from file  ,\t Tagid  ,\t BrowseName ,\t Value ,\t StatusCode ,\t Timestamp ,\t Variant value ,\t Error messages"
+            else:
+                header = "Tagid  ,\t Value ,\t StatusCode ,\t Timestamp ,\t Variant value ,\t Error messages"
+        self.writeMessage(header)
+
+    def writeRecord(self, record):
+        self.file.write(self.encoder.encode(record))
+        self.recordsWritten += 1
+
+    def writeRecords(self, records):
+        encode = self.encoder.encode
+        lines = [encode(record) for record in records]
+        self.file.write("".join(lines))
+        self.recordsWritten += len(lines)
+
+    def writeMessage(self, message):
+        self.file.write(message)
+        self.file.write("\n")
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def bytesWritten(self):
+        return self.file.tell()
+
+class CsvResultWriter(ResultWriter):
+    """
+    RFC 4180 CSV through the csv module: values are quoted instead of altered.
+    StatusCode is written as its numeric value and the timestamp in ISO 8601 (UTC).
+    Messages are written as a row with only the errorMessage column set.
+    """
+    COLUMNS = ["tagid", "browseName", "value", "variantType", "statusCode", "sourceTimestamp", "errorMessage"]
+
+    def __init__(self, fileName):
+        ResultWriter.__init__(self, fileName)
+        self.file = open(fileName, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.COLUMNS)
+
+    def writeRecord(self, record):
+        if record.sourceTimestamp is not None:
+            timestamp = record.sourceTimestamp.isoformat('T')+"Z"
+        else:
+            timestamp = ""
+        self.writer.writerow((record.tagid, record.browseName, record.value, record.variantType, record.statusCode, timestamp, record.errorMessage))
+        self.recordsWritten += 1
+
+    def writeRecords(self, records):
+        rows = []
+        for record in records:
+            if record.sourceTimestamp is not None:
+                timestamp = record.sourceTimestamp.isoformat('T')+"Z"
+            else:
+                timestamp = ""
+            rows.append((record.tagid, record.browseName, record.value, record.variantType, record.statusCode, timestamp, record.errorMessage))
+        self.writer.writerows(rows)
+        self.recordsWritten += len(rows)
+
+    def writeMessage(self, message):
+        self.writer.writerow(("", "", "", "", "", "", message))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def bytesWritten(self):
+        return self.file.tell()
+
+class BinaryResultWriter(ResultWriter):
+    """
+    Append log of struct-packed records (little endian).
+    File header: MAGIC.
+    Every entry starts with one kind byte:
+        KIND_TAG:     tagIndex (uint32), length (uint16), tagid (utf-8)          first time a tag is seen
+        KIND_MESSAGE: length (uint32), message (utf-8)
+        any other:    a sample, tagIndex (uint32), statusCode (uint32), sourceTimestamp (int64, microseconds
+                      since 1970-01-01, NO_TIMESTAMP if missing), variantType (uint8) and the value:
+                      VALUE_BOOL uint8, VALUE_INT int64, VALUE_UINT uint64, VALUE_DOUBLE float64,
+                      VALUE_NULL nothing, VALUE_TEXT length (uint32) + utf-8 of str(value)
+    The tagid is only stored once, samples refer to it by index.
+    """
+    MAGIC = b"OPCUALOG\x01"
+    KIND_TAG = 0xFF
+    KIND_MESSAGE = 0xFE
+    VALUE_NULL = 0
+    VALUE_BOOL = 1
+    VALUE_INT = 2
+    VALUE_UINT = 3
+    VALUE_DOUBLE = 4
+    VALUE_TEXT = 5
+    NO_TIMESTAMP = -(2 ** 63)
+
+    SAMPLE_HEADER = struct.Struct("<BIIqB")
+    TAG_HEADER = struct.Struct("<BIH")
+    MESSAGE_HEADER = struct.Struct("<BI")
+    LENGTH = struct.Struct("<I")
+    VALUE_STRUCTS = {VALUE_BOOL: struct.Struct("<?"), VALUE_INT: struct.Struct("<q"), VALUE_UINT: struct.Struct("<Q"), VALUE_DOUBLE: struct.Struct("<d")}
+
+    # VariantTypes stored natively, any other type is stored as VALUE_TEXT
+    VALUE_KINDS = {ua.VariantType.Boolean.value: VALUE_BOOL,
+                   ua.VariantType.SByte.value: VALUE_INT, ua.VariantType.Int16.value: VALUE_INT,
+                   ua.VariantType.Int32.value: VALUE_INT, ua.VariantType.Int64.value: VALUE_INT,
+                   ua.VariantType.Byte.value: VALUE_UINT, ua.VariantType.UInt16.value: VALUE_UINT,
+                   ua.VariantType.UInt32.value: VALUE_UINT, ua.VariantType.UInt64.value: VALUE_UINT,
+                   ua.VariantType.Float.value: VALUE_DOUBLE, ua.VariantType.Double.value: VALUE_DOUBLE}
+
+    def __init__(self, fileName):
+        ResultWriter.__init__(self, fileName)
+        self.file = open(fileName, "wb")
+        self.file.write(self.MAGIC)
+        self.encoder = BinaryRecordEncoder()
+
+    def writeRecord(self, record):
+        self.file.write(self.encoder.encodeRecord(record))
+        self.recordsWritten += 1
+
+    def writeRecords(self, records):
+        encodeRecord = self.encoder.encodeRecord
+        entries = [encodeRecord(record) for record in records]
+        self.file.write(b"".join(entries))
+        self.recordsWritten += len(entries)
+
+    def writeMessage(self, message):
+        self.file.write(self.encoder.encodeMessage(message))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def bytesWritten(self):
+        return self.file.tell()
+
+class BinaryRecordEncoder(object):
+    """
+    The entries of BinaryResultWriter as bytes, without the file (also used by the store-and-forward segments).
+    The tag table starts empty: the first record of a tag also gets its KIND_TAG entry.
+    """
+    def __init__(self):
+        self.tagIndexes = dict()
+
+    def getTagEntry(self, tagid):
+        """ (tagIndex, KIND_TAG entry or b"" when the tag was already seen). """
+        tagIndex = self.tagIndexes.get(tagid)
+        if tagIndex is not None:
+            return tagIndex, b""
+        w = BinaryResultWriter
+        tagIndex = len(self.tagIndexes)
+        self.tagIndexes[tagid] = tagIndex
+        encodedTag = tagid.encode("utf-8")
+        return tagIndex, w.TAG_HEADER.pack(w.KIND_TAG, tagIndex, len(encodedTag)) + encodedTag
+
+    def encodeValue(self, value, variantType):
+        w = BinaryResultWriter
+        if value is None:
+            return w.VALUE_NULL, b""
+        valueKind = w.VALUE_KINDS.get(variantType)
+        if valueKind is None or isinstance(value, list):
+            encodedValue = str(value).encode("utf-8")
+            return w.VALUE_TEXT, w.LENGTH.pack(len(encodedValue)) + encodedValue
+        return valueKind, w.VALUE_STRUCTS[valueKind].pack(value)
+
+    def encodeRecord(self, record):
+        w = BinaryResultWriter
+        tagIndex, tagEntry = self.getTagEntry(record.tagid)
+        timestamp = toMicroseconds(record.sourceTimestamp)
+        try:
+            valueKind, encodedValue = self.encodeValue(record.value, record.variantType)
+        except (struct.error, TypeError):
+            encodedValue = str(record.value).encode("utf-8")
+            valueKind, encodedValue = w.VALUE_TEXT, w.LENGTH.pack(len(encodedValue)) + encodedValue
+        entry = tagEntry + w.SAMPLE_HEADER.pack(valueKind, tagIndex, record.statusCode, timestamp, record.variantType) + encodedValue
+        if record.errorMessage:
+            entry = entry + self.encodeMessage(record.tagid + ": " + record.errorMessage)
+        return entry
+
+    def encodeMessage(self, message):
+        w = BinaryResultWriter
+        encodedMessage = message.encode("utf-8")
+        return w.MESSAGE_HEADER.pack(w.KIND_MESSAGE, len(encodedMessage)) + encodedMessage
+
+def iterBinaryLog(fileName):
+    """
+    Read back a file written by BinaryResultWriter.
+    Yields ScanRecords for the samples and strings for the messages.
+    """
+    w = BinaryResultWriter
+    with open(fileName, "rb") as f:
+        data = f.read()
+    if not data.startswith(w.MAGIC):
+        raise ValueError(fileName + " is not a binary result file")
+    return iterBinaryEntries(data, len(w.MAGIC), len(data), [])
+
+def iterBinaryEntries(data, offset, end, tagids):
+    """
+    Decode the entries of data[offset:end] (bytes or any buffer), see BinaryResultWriter.
+    tagids is the tag table, filled by the KIND_TAG entries.
+    Yields ScanRecords for the samples and strings for the messages.
+    """
+    w = BinaryResultWriter
+    while offset < end:
+        kind = data[offset]
+        if kind == w.KIND_TAG:
+            _, tagIndex, length = w.TAG_HEADER.unpack_from(data, offset)
+            offset += w.TAG_HEADER.size
+            tagids.append(bytes(data[offset:offset + length]).decode("utf-8"))
+            offset += length
+        elif kind == w.KIND_MESSAGE:
+            _, length = w.MESSAGE_HEADER.unpack_from(data, offset)
+            offset += w.MESSAGE_HEADER.size
+            yield bytes(data[offset:offset + length]).decode("utf-8")
+            offset += length
+        else:
+            valueKind, tagIndex, statusCode, timestamp, variantType = w.SAMPLE_HEADER.unpack_from(data, offset)
+            offset += w.SAMPLE_HEADER.size
+            if valueKind == w.VALUE_NULL:
+                value = None
+            elif valueKind == w.VALUE_TEXT:
+                length = w.LENGTH.unpack_from(data, offset)[0]
+                offset += w.LENGTH.size
+                value = bytes(data[offset:offset + length]).decode("utf-8")
+                offset += length
+            else:
+                valueStruct = w.VALUE_STRUCTS[valueKind]
+                value = valueStruct.unpack_from(data, offset)[0]
+                offset += valueStruct.size
+            if timestamp == w.NO_TIMESTAMP:
+                sourceTimestamp = None
+            else:
+                sourceTimestamp = EPOCH + timedelta(microseconds=timestamp)
+            yield ScanRecord(tagids[tagIndex], "", value, variantType, statusCode, sourceTimestamp, "")
+
+class ParquetResultWriter(ResultWriter):
+    """
+    Columnar output through pyarrow (optional dependency, only imported when this backend is used).
+    Records are buffered and written as one row group every rowGroupSize records.
+    Values are stored as text plus a float64 column holding the numeric ones natively, and an int64 column holding
+    the integers exactly (float64 rounds the Int64/UInt64 values above 2^53); a UInt64 over the int64 range is kept as text.
+    """
+    def __init__(self, fileName, rowGroupSize=65536):
+        ResultWriter.__init__(self, fileName)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("The parquet output format needs pyarrow: pip install pyarrow")
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([("tagid", pyarrow.string()), ("numericValue", pyarrow.float64()), ("integerValue", pyarrow.int64()),
+                                      ("value", pyarrow.string()),
+                                      ("variantType", pyarrow.uint8()), ("statusCode", pyarrow.uint32()),
+                                      ("sourceTimestamp", pyarrow.timestamp("us")), ("errorMessage", pyarrow.string())])
+        self.writer = pyarrow.parquet.ParquetWriter(fileName, self.schema)
+        self.rowGroupSize = rowGroupSize
+        self.columns = dict((name, []) for name in self.schema.names)
+
+    def writeRecord(self, record):
+        columns = self.columns
+        columns["tagid"].append(record.tagid)
+        value = record.value
+        if isinstance(value, (int, float)):
+            columns["numericValue"].append(float(value))
+            isInt64 = isinstance(value, int) and INT64_MIN <= value <= INT64_MAX
+            columns["integerValue"].append(int(value) if isInt64 else None)
+            columns["value"].append(str(value) if isinstance(value, int) and not isInt64 else None)
+        else:
+            columns["numericValue"].append(None)
+            columns["integerValue"].append(None)
+            columns["value"].append(None if value is None else str(value))
+        columns["variantType"].append(record.variantType)
+        columns["statusCode"].append(record.statusCode)
+        columns["sourceTimestamp"].append(None if record.sourceTimestamp is None else record.sourceTimestamp.replace(tzinfo=None))
+        columns["errorMessage"].append(record.errorMessage)
+        self.recordsWritten += 1
+        if len(columns["tagid"]) >= self.rowGroupSize:
+            self.flush()
+
+    def writeMessage(self, message):
+        self.writeRecord(ScanRecord("", "", None, ua.VariantType.Null.value, ua.StatusCodes.Good, None, message))
+        self.recordsWritten -= 1
+
+    def flush(self):
+        if not self.columns["tagid"]:
+            return
+        self.writer.write_table(self.pa.table(self.columns, schema=self.schema))
+        self.columns = dict((name, []) for name in self.schema.names)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    @property
+    def bytesWritten(self):
+        # Only exact for the row groups already flushed
+        return os.path.getsize(self.fileName)
+
+def instrumentWriter(writer):
+    """
+    Time the batch writes and flushes of writer and publish its records and bytes written.
+    The gauges are updated by the writing thread (after each batch, flush or METRICS_UPDATE_RECORDS records),
+    the metrics endpoint never touches the file.
+    """
+    writeTime = metrics.histogram("result_write_seconds", "Time spent writing batches of records and flushing the result file")
+    recordsWritten = metrics.gauge("result_records_written", "Records written in the result file")
+    bytesWritten = metrics.gauge("result_bytes_written", "Bytes written in the result file")
+    writeRecord, writeRecords, flush = writer.writeRecord, writer.writeRecords, writer.flush
+
+    def updateGauges():
+        recordsWritten.set(writer.recordsWritten)
+        bytesWritten.set(writer.bytesWritten)
+
+    def countedWriteRecord(record):
+        writeRecord(record)
+        if writer.recordsWritten % METRICS_UPDATE_RECORDS == 0 and metrics.isEnabled():
+            updateGauges()
+
+    def timedWriteRecords(records):
+        if not metrics.isEnabled():
+            return writeRecords(records)
+        startTime = time.perf_counter()
+        writeRecords(records)
+        writeTime.observe(time.perf_counter() - startTime)
+        updateGauges()
+
+    def timedFlush():
+        if not metrics.isEnabled():
+            return flush()
+        startTime = time.perf_counter()
+        flush()
+        writeTime.observe(time.perf_counter() - startTime)
+        updateGauges()
+
+    writer.writeRecord = countedWriteRecord
+    writer.writeRecords = timedWriteRecords
+    writer.flush = timedFlush
+    return writer
+
+def createResultWriter(outputFormat, fileName, gettagsLayout=False):
+    """
+    Create the writer of outputFormat: text, csv, binary or parquet.
+    gettagsLayout writes the text format with the first columns of gettags.py: "Tag from file", Tagid and
+    BrowseName, the tagid of the records being the tag from the file (the other formats always have the BrowseName).
+    """
+    if outputFormat == "text":
+        writer = TextResultWriter(fileName, gettagsLayout=gettagsLayout)
+    elif outputFormat == "csv":
+        writer = CsvResultWriter(fileName)
+    elif outputFormat == "binary":
+        writer = BinaryResultWriter(fileName)
+    elif outputFormat == "parquet":
+        writer = ParquetResultWriter(fileName)
+    else:
+        raise ValueError("Unknown output format: " + str(outputFormat))
+    return instrumentWriter(writer)
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+from enum import EnumMeta
+from opcua import ua
+from opcua.common.structures import StructGenerator
+
+# Local on-disk cache of the server metadata which is slow to get on every connect:
+#   - the custom type definitions (load_type_definitions browses and downloads the whole type dictionary)
+#   - the namespace array
+#   - the browse names already resolved
+# The cache is keyed by the endpoint url and the server URI. It is only used while the
+# server fingerprint (BuildInfo + namespace array) is the same as when it was saved,
+# otherwise everything is downloaded again and the cache refreshed.
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".opcua_client_cache")
+CACHE_VERSION = 1
+
+FINGERPRINT_NODES = [ua.ObjectIds.Server_ServerArray,
+                     ua.ObjectIds.Server_NamespaceArray,
+                     ua.ObjectIds.Server_ServerStatus_BuildInfo_ProductUri,
+                     ua.ObjectIds.Server_ServerStatus_BuildInfo_SoftwareVersion,
+                     ua.ObjectIds.Server_ServerStatus_BuildInfo_BuildNumber,
+                     ua.ObjectIds.Server_ServerStatus_BuildInfo_BuildDate]
+
+logger = logging.getLogger(__name__)
+
+def pythonClassName(name):
+    """
+    Name of the Python class generated for an OPC UA structure: the characters which cannot be
+    in a class name replaced with "_", same rules as StructGenerator applies to the xml.
+    """
+    name = re.sub(r'\W+', '_', name)
+    name = re.sub(r'^[0-9]+', r'_\g<0>', name)
+    return name
+
+class ServerMetadata(object):
+    """
+    Type definitions, namespace array and browse names of one server, backed by a JSON file in cacheDir.
+    loadTypeDefinitions replaces session.load_type_definitions().
+    """
+    def __init__(self, session, url, cacheDir=DEFAULT_CACHE_DIR):
+        self.session = session
+        self.url = url
+        self.cacheDir = cacheDir
+        self.serverUri = ""
+        self.namespaceArray = []
+        self.fingerprint = ""
+        self.typeDictionaries = []   # [{"xml": ..., "registrations": [[className, typeNodeId], ...]}]
+        self.browseNames = dict()    # NodeId string -> BrowseName
+        self.cacheHit = False
+        self.dirty = False
+        self.loadTimeInSec = 0
+
+    def getCacheFile(self):
+        key = hashlib.sha1((self.url + "|" + self.serverUri).encode("utf-8")).hexdigest()
+        return os.path.join(self.cacheDir, "server_" + key + ".json")
+
+    def readFingerprint(self):
+        """ One Read request for the server URI, namespace array and BuildInfo. """
+        params = ua.ReadParameters()
+        for nodeId in FINGERPRINT_NODES:
+            readValueId = ua.ReadValueId()
+            readValueId.NodeId = ua.NodeId(nodeId)
+            readValueId.AttributeId = ua.AttributeIds.Value
+            params.NodesToRead.append(readValueId)
+        dataValues = self.session.uaclient.read(params)
+        values = [str(dataValue.Value.Value) if dataValue.StatusCode.is_good() else "" for dataValue in dataValues]
+        serverArray = dataValues[0].Value.Value if dataValues[0].StatusCode.is_good() else None
+        self.serverUri = serverArray[0] if serverArray else ""
+        self.namespaceArray = dataValues[1].Value.Value if dataValues[1].StatusCode.is_good() else []
+        self.fingerprint = hashlib.sha1("|".join(values).encode("utf-8")).hexdigest()
+
+    def loadTypeDefinitions(self):
+        """
+        Load the custom structures/extension objects of the server, from the cache when the fingerprint
+        did not change. Returns True if the cache was used.
+        """
+        startTime = time.perf_counter()
+        self.readFingerprint()
+        cached = self.readCacheFile()
+        if cached is not None and cached.get("fingerprint") == self.fingerprint:
+            try:
+                self.typeDictionaries = cached["typeDictionaries"]
+                self.browseNames = cached.get("browseNames", dict())
+                self.registerTypeDictionaries()
+                self.cacheHit = True
+            except Exception as e:
+                logger.warning("Cannot use the metadata cache %s: %s", self.getCacheFile(), e)
+                self.cacheHit = False
+        if not self.cacheHit:
+            self.browseNames = dict()
+            self.downloadTypeDefinitions()
+            self.dirty = True
+            self.save()
+        self.loadTimeInSec = time.perf_counter() - startTime
+        return self.cacheHit
+
+    def downloadTypeDefinitions(self):
+        """ Same as opcua.common.structures.load_type_definitions, also keeping what is needed to replay it from the cache. """
+        self.typeDictionaries = []
+        for desc in self.session.nodes.opc_binary.get_children_descriptions():
+            if desc.BrowseName == ua.QualifiedName("Opc.Ua"):
+                continue
+            node = self.session.get_node(desc.NodeId)
+            xml = node.get_value()
+            if isinstance(xml, bytes):
+                xml = xml.decode("utf-8")
+            registrations = []
+            for ndesc in node.get_children_descriptions():
+                ref_desc_list = self.session.get_node(ndesc.NodeId).get_references(refs=ua.ObjectIds.HasDescription, direction=ua.BrowseDirection.Inverse)
+                if ref_desc_list:  # some servers put extra things here
+                    registrations.append([pythonClassName(ndesc.BrowseName.Name), ref_desc_list[0].NodeId.to_string()])
+            self.typeDictionaries.append({"xml": xml, "registrations": registrations})
+        self.registerTypeDictionaries()
+
+    def registerTypeDictionaries(self):
+        """ Generate the Python classes of the type dictionaries and register them in the ua module. """
+        structs_dict = {}
+        for typeDictionary in self.typeDictionaries:
+            generator = StructGenerator()
+            generator.make_model_from_string(typeDictionary["xml"])
+            generator.get_python_classes(structs_dict)
+            for name, nodeId in typeDictionary["registrations"]:
+                if not name in structs_dict:
+                    logger.warning("%s is found as child of binary definition node but is not found in xml", name)
+                    continue
+                ua.register_extension_object(name, ua.NodeId.from_string(nodeId), structs_dict[name])
+            for key, val in structs_dict.items():
+                if isinstance(val, EnumMeta) and key != "IntEnum":
+                    setattr(ua, key, val)
+
+    def getBrowseNames(self, nodes):
+        """ BrowseName of every node, the ones not in the cache are read with a single Read request. """
+        missingNodes = [node for node in nodes if node.nodeid.to_string() not in self.browseNames]
+        if missingNodes:
+            params = ua.ReadParameters()
+            for node in missingNodes:
+                readValueId = ua.ReadValueId()
+                readValueId.NodeId = node.nodeid
+                readValueId.AttributeId = ua.AttributeIds.BrowseName
+                params.NodesToRead.append(readValueId)
+            for node, dataValue in zip(missingNodes, self.session.uaclient.read(params)):
+                if dataValue.StatusCode.is_good():
+                    self.browseNames[node.nodeid.to_string()] = dataValue.Value.Value.Name
+                    self.dirty = True
+        return [self.browseNames.get(node.nodeid.to_string(), "") for node in nodes]
+
+    def readCacheFile(self):
+        try:
+            with open(self.getCacheFile(), "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if cached.get("version") != CACHE_VERSION:
+            return None
+        return cached
+
+    def save(self):
+        """
+        Write the cache file if something changed: written to a temporary file of its own, then renamed,
+        so processes saving the cache of the same server at the same time do not overwrite each other's file.
+        """
+        if not self.dirty:
+            return
+        d = dict()
+        d['version'] = CACHE_VERSION
+        d['url'] = self.url
+        d['serverUri'] = self.serverUri
+        d['fingerprint'] = self.fingerprint
+        d['namespaceArray'] = self.namespaceArray
+        d['typeDictionaries'] = self.typeDictionaries
+        d['browseNames'] = self.browseNames
+        try:
+            os.makedirs(self.cacheDir, exist_ok=True)
+            cacheFile = self.getCacheFile()
+            fd, tmpFile = tempfile.mkstemp(prefix=os.path.basename(cacheFile) + ".", suffix=".tmp", dir=self.cacheDir)
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(d, f)
+                os.replace(tmpFile, cacheFile)
+            except BaseException:
+                os.remove(tmpFile)
+                raise
+            self.dirty = False
+        except (IOError, OSError) as e:
+            logger.warning("Cannot write the metadata cache: %s", e)
@@ -0,0 +1,246 @@
+import importlib.metadata
+import logging
+import random
+import threading
+import time
+
+from opcua import ua
+from opcua.client.client import KeepAlive
+from opcua.ua.ua_binary import struct_from_binary
+
+# Keeps a subscription session alive across connection losses.
+# The supervisor thread checks the receiving thread of the socket every checkIntervalInSec
+# and reads the server state every keepAliveIntervalInSec. When the connection is lost it
+# reconnects with exponential backoff (with jitter) and restores the subscriptions, cheapest
+# way first:
+#   1.- reactivate: new secure channel, ActivateSession on the same session. The subscriptions
+#       and their monitored items are still on the server, publishing just resumes.
+#   2.- transfer: the session is gone, a new session is created and TransferSubscriptions
+#       moves the subscriptions (still alive on the server until their lifetime ends) to it.
+#   3.- recreate: new subscriptions with all their monitored items, created in bulk without
+#       the lazy load delays.
+# Time to recover (loss detected -> subscriptions restored) and data gap (last publish
+# response before the loss -> first one after) are kept as statistics.
+#
+# python-opcua has no public API to reuse a session on a new connection: the supervisor uses
+# some of its internals (see CLIENT_INTERNALS), checked when it is created so that another
+# version of the library fails at startup instead of when the connection is lost.
+
+RECONNECT_MIN_DELAY_IN_SEC = 1
+RECONNECT_MAX_DELAY_IN_SEC = 60
+TESTED_OPCUA_VERSION = "0.98.13" # python-opcua version the internals below were checked against (requirements.txt)
+# (object, attribute) of the opcua Client used to reconnect and watch the publish responses
+CLIENT_INTERNALS = [("session", "_username"), ("session", "_password"), ("session", "user_certificate"), ("session", "connect_socket"),
+                    ("session", "send_hello"), ("session", "open_secure_channel"), ("session", "activate_session"), ("session", "create_session"),
+                    ("uaclient", "_publishcallbacks"), ("uaclient", "_uasocket"), ("uasocket", "authentication_token"), ("uasocket", "_thread"),
+                    ("uasocket", "send_request")]
+
+logger = logging.getLogger(__name__)
+
+def checkClientInternals(session):
+    """ Raise RuntimeError when the opcua Client (connected) lacks one of the CLIENT_INTERNALS the supervisor relies on. """
+    try:
+        version = importlib.metadata.version("opcua")
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    if version != TESTED_OPCUA_VERSION:
+        logger.warning("Reconnect tested with python-opcua %s, not %s", TESTED_OPCUA_VERSION, version)
+    objects = {"session": session, "uaclient": getattr(session, "uaclient", None)}
+    objects["uasocket"] = getattr(objects["uaclient"], "_uasocket", None)
+    missing = [name + "." + attribute for name, attribute in CLIENT_INTERNALS if not hasattr(objects[name], attribute)]
+    if missing:
+        raise RuntimeError("The reconnect cannot work with python-opcua " + str(version) + " (tested with " + TESTED_OPCUA_VERSION +
+                           "), missing: " + ", ".join(missing))
+
+class SessionSupervisor(threading.Thread):
+    """
+    Supervise the session (opcua Client) used by the subscriptions (OpcUaSubscription).
+    notificationWriter (optional) gets a message in the result file for every loss and recovery.
+    """
+    def __init__(self, session, subscriptions, notificationWriter=None, checkIntervalInSec=1, keepAliveIntervalInSec=5,
+                 minDelayInSec=RECONNECT_MIN_DELAY_IN_SEC, maxDelayInSec=RECONNECT_MAX_DELAY_IN_SEC):
+        threading.Thread.__init__(self, name="SessionSupervisor", daemon=True)
+        checkClientInternals(session)
+        self.session = session
+        self.subscriptions = subscriptions
+        self.notificationWriter = notificationWriter
+        self.checkIntervalInSec = checkIntervalInSec
+        self.keepAliveIntervalInSec = keepAliveIntervalInSec
+        self.minDelayInSec = minDelayInSec
+        self.maxDelayInSec = maxDelayInSec
+        self.stopEvent = threading.Event()
+        self.lock = threading.Lock()
+        self.lastPublishTimes = dict()       # subscription id -> time of the last publish response
+        self.lastSequenceNumbers = dict()    # subscription id -> sequence number of the last publish response
+        self.gapStartTime = None             # last publish response before the loss, while waiting for the first one after it
+        self.lastKeepAliveTime = time.monotonic()
+
+        self.connectionLosses = 0
+        self.failedAttempts = 0
+        self.recoveries = {"reactivate": 0, "transfer": 0, "recreate": 0}
+        self.lastTimeToRecoverInSec = 0
+        self.maxTimeToRecoverInSec = 0
+        self.lastDataGapInSec = 0
+        self.maxDataGapInSec = 0
+        self.missedNotificationMessages = 0
+
+        for subscription in subscriptions:
+            self.watchSubscription(subscription)
+
+    def watchSubscription(self, subscription):
+        """ Route the publish responses of the subscription through onPublish. """
+        sub = subscription.sub
+        publishCallback = sub.publish_callback
+        def watchedPublishCallback(publishResult):
+            self.onPublish(sub.subscription_id, publishResult)
+            publishCallback(publishResult)
+        with self.lock:
+            self.lastPublishTimes[sub.subscription_id] = time.monotonic()
+        self.session.uaclient._publishcallbacks[sub.subscription_id] = watchedPublishCallback
+
+    def onPublish(self, subscriptionId, publishResult):
+        now = time.monotonic()
+        sequenceNumber = publishResult.NotificationMessage.SequenceNumber
+        with self.lock:
+            if self.gapStartTime is not None:
+                self.lastDataGapInSec = now - self.gapStartTime
+                self.maxDataGapInSec = max(self.maxDataGapInSec, self.lastDataGapInSec)
+                self.gapStartTime = None
+            lastSequenceNumber = self.lastSequenceNumbers.get(subscriptionId)
+            if lastSequenceNumber is not None and sequenceNumber > lastSequenceNumber + 1:
+                self.missedNotificationMessages += sequenceNumber - lastSequenceNumber - 1
+            if publishResult.NotificationMessage.NotificationData:
+                self.lastSequenceNumbers[subscriptionId] = sequenceNumber
+            self.lastPublishTimes[subscriptionId] = now
+
+    def run(self):
+        while not self.stopEvent.wait(self.checkIntervalInSec):
+            if not self.isConnected():
+                self.recover()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.join()
+
+    def isConnected(self):
+        uasocket = self.session.uaclient._uasocket
+        if uasocket._thread is None or not uasocket._thread.is_alive():
+            return False
+        if time.monotonic() - self.lastKeepAliveTime < self.keepAliveIntervalInSec:
+            return True
+        try:
+            self.session.get_node(ua.ObjectIds.Server_ServerStatus_State).get_value()
+        except Exception as e:
+            logger.warning("Keep-alive read failed: %s", e)
+            return False
+        self.lastKeepAliveTime = time.monotonic()
+        return True
+
+    def recover(self):
+        lossTime = time.monotonic()
+        self.connectionLosses += 1
+        with self.lock:
+            self.gapStartTime = max(self.lastPublishTimes.values()) if self.lastPublishTimes else lossTime
+        self.pushMessage(". Connection to the server lost, reconnecting")
+
+        delayInSec = self.minDelayInSec
+        while not self.stopEvent.is_set():
+            try:
+                method = self.reconnect()
+                break
+            except Exception as e:
+                self.failedAttempts += 1
+                logger.warning("Reconnect failed, next attempt in %s sec: %s", delayInSec, e)
+                self.closeConnection()
+                self.stopEvent.wait(delayInSec * random.uniform(0.5, 1.0))
+                delayInSec = min(delayInSec * 2, self.maxDelayInSec)
+        else:
+            return
+
+        self.recoveries[method] += 1
+        self.lastTimeToRecoverInSec = time.monotonic() - lossTime
+        self.maxTimeToRecoverInSec = max(self.maxTimeToRecoverInSec, self.lastTimeToRecoverInSec)
+        self.lastKeepAliveTime = time.monotonic()
+        self.pushMessage(". Connection to the server recovered (" + method + ") in " + str(round(self.lastTimeToRecoverInSec, 3)) + " sec")
+
+    def reconnect(self):
+        """ One reconnect attempt. Returns the way the subscriptions were restored: reactivate, transfer or recreate. """
+        session = self.session
+        authenticationToken = session.uaclient._uasocket.authentication_token
+        self.closeConnection()
+        session.connect_socket()
+        session.send_hello()
+        session.open_secure_channel()
+
+        # 1.- Same session on the new secure channel
+        try:
+            session.uaclient._uasocket.authentication_token = authenticationToken
+            session.activate_session(username=session._username, password=session._password, certificate=session.user_certificate)
+            session.keepalive = KeepAlive(session, min(session.session_timeout, session.secure_channel_timeout) * 0.7)
+            session.keepalive.start()
+            self.sendPublishRequests(self.subscriptions)
+            return "reactivate"
+        except Exception as e:
+            # Not only a Bad status (session closed by the server): a timeout or a broken answer goes on with a new session too
+            logger.info("Session cannot be reactivated: %s", e)
+            if session.keepalive is not None:
+                session.keepalive.stop() # create_session starts its own
+
+        # 2.- New session, move the subscriptions to it
+        session.uaclient._uasocket.authentication_token = ua.NodeId()
+        session.create_session()
+        session.activate_session(username=session._username, password=session._password, certificate=session.user_certificate)
+        transferred = self.transferSubscriptions()
+        self.sendPublishRequests(transferred)
+        for subscription in self.subscriptions:
+            if subscription not in transferred:
+                # 3.- New subscription and monitored items
+                subscription.recreate_Subscription()
+                self.watchSubscription(subscription)
+        return "transfer" if len(transferred) == len(self.subscriptions) else "recreate"
+
+    def transferSubscriptions(self):
+        """ TransferSubscriptions request for all the subscriptions. Returns the subscriptions transferred. """
+        request = ua.TransferSubscriptionsRequest()
+        request.Parameters.SubscriptionIds = [subscription.sub.subscription_id for subscription in self.subscriptions]
+        request.Parameters.SendInitialValues = True
+        try:
+            data = self.session.uaclient._uasocket.send_request(request)
+            response = struct_from_binary(ua.TransferSubscriptionsResponse, data)
+            response.ResponseHeader.ServiceResult.check()
+        except Exception as e:
+            logger.info("Subscriptions cannot be transferred: %s", e)
+            return []
+        return [subscription for subscription, result in zip(self.subscriptions, response.Parameters.Results) if result.StatusCode.is_good()]
+
+    def sendPublishRequests(self, subscriptions):
+        """ The Publish requests waiting on the server were lost with the connection: send them again. """
+        for subscription in subscriptions:
+            for i in range(subscription.parameters.publishRequests):
+                self.session.uaclient.publish()
+
+    def closeConnection(self):
+        """ Stop the keep-alive thread of the client and close the socket, ignoring errors (the connection is already broken). """
+        if self.session.keepalive is not None:
+            self.session.keepalive.stop()
+        try:
+            self.session.disconnect_socket()
+        except Exception:
+            pass
+
+    def pushMessage(self, message):
+        logger.warning(message)
+        if self.notificationWriter is not None:
+            self.notificationWriter.pushMessage(message)
+
+    def getStatistics(self):
+        d = dict()
+        d['connectionLosses'] = self.connectionLosses
+        d['failedAttempts'] = self.failedAttempts
+        d['recoveries'] = dict(self.recoveries)
+        d['lastTimeToRecoverInSec'] = round(self.lastTimeToRecoverInSec, 3)
+        d['maxTimeToRecoverInSec'] = round(self.maxTimeToRecoverInSec, 3)
+        d['lastDataGapInSec'] = round(self.lastDataGapInSec, 3)
+        d['maxDataGapInSec'] = round(self.maxDataGapInSec, 3)
+        d['missedNotificationMessages'] = self.missedNotificationMessages
+        return d
@@ -0,0 +1,521 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+import metrics
+from resultwriters import ResultWriter, BinaryRecordEncoder, iterBinaryEntries
+
+# Store and forward: the records go first into a local log on disk and a forwarder thread
+# sends them to the real destination (the sink, any ResultWriter). A slow or offline sink
+# does not slow down the readers nor lose data, as long as the disk budget is not exceeded.
+#
+# The log is a folder of segments (segment_<number>.log) of segmentSize bytes, preallocated
+# and memory mapped. A segment holds MAGIC then entries:
+#     length (uint32), crc32 (uint32), payload
+# The payload is a group of records in the BinaryResultWriter encoding, the tag table
+# starting again in every segment. The length is written after the payload, so a length of
+# 0 is the end of the data, and END_OF_SEGMENT marks a segment closed by the rollover.
+# The pages are flushed to disk (fsync) in batches: every syncBytes or syncIntervalInSec.
+# When more than maxSegments segments are waiting the oldest one is dropped (ring).
+#
+# The forwarder reads the segments in bulk, writes batches of records to the sink, and after
+# every batch the sink accepted (written and flushed) saves its position in forwarder.position.
+# Segments completely forwarded are deleted. After a crash the last segment is scanned: the
+# entries with a wrong crc32 (torn writes) are cut, and the forwarder goes on from its saved
+# position (records of the batch in progress may be sent twice).
+# Ingest, forward and recovery times: python bench_storeforward.py [NumberOfRecords]
+
+SEGMENT_MAGIC = b"OPCUASEG\x01"
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_SEGMENTS = 64 # Disk budget: maxSegments * segmentSize
+DEFAULT_SYNC_INTERVAL_IN_SEC = 1
+DEFAULT_SYNC_BYTES = 4 * 1024 * 1024
+DEFAULT_ENTRY_BYTES = 256 * 1024 # Records grouped in one entry (one crc32)
+DEFAULT_FORWARD_BATCH_RECORDS = 10000
+DEFAULT_DRAIN_TIMEOUT_IN_SEC = 30 # Time given to the forwarder to empty the log when the writer is closed
+
+ENTRY_HEADER = struct.Struct("<II")
+END_MARKER = struct.Struct("<I")
+END_OF_SEGMENT = 0xFFFFFFFF
+POSITION_FILE = "forwarder.position"
+
+APPENDED_BYTES = metrics.counter("storeforward_appended_bytes_total", "Bytes appended to the store and forward log")
+SYNC_TIME = metrics.histogram("storeforward_sync_seconds", "Time to flush the dirty pages of the log to disk")
+DROPPED_SEGMENTS = metrics.counter("storeforward_dropped_segments_total", "Segments dropped before being forwarded (disk budget exceeded)")
+FORWARDED_RECORDS = metrics.counter("storeforward_forwarded_records_total", "Records written to the sink")
+SINK_ERRORS = metrics.counter("storeforward_sink_errors_total", "Batches the sink did not accept (retried)")
+LAG_BYTES = metrics.gauge("storeforward_lag_bytes", "Bytes appended to the log and not forwarded yet")
+
+logger = logging.getLogger(__name__)
+
+def segmentFileName(directory, number):
+    return os.path.join(directory, "segment_%010d.log" % number)
+
+def listSegments(directory):
+    numbers = []
+    for fileName in os.listdir(directory):
+        if fileName.startswith("segment_") and fileName.endswith(".log"):
+            try:
+                numbers.append(int(fileName[len("segment_"):-len(".log")]))
+            except ValueError:
+                pass
+    return sorted(numbers)
+
+def iterEntries(data, offset, end):
+    """
+    Entries of data[offset:end]: yields (payloadStart, payloadEnd). Stops at the end of the data (length 0),
+    at an entry not complete in data or with a wrong crc32, and at END_OF_SEGMENT (yields (None, None) for it).
+    """
+    while offset + ENTRY_HEADER.size <= end:
+        length, crc = ENTRY_HEADER.unpack_from(data, offset)
+        if length == END_OF_SEGMENT:
+            yield None, None
+            return
+        payloadStart = offset + ENTRY_HEADER.size
+        payloadEnd = payloadStart + length
+        if length == 0 or payloadEnd > end or zlib.crc32(data[payloadStart:payloadEnd]) != crc:
+            return
+        yield payloadStart, payloadEnd
+        offset = payloadEnd
+    if offset + END_MARKER.size <= end and END_MARKER.unpack_from(data, offset)[0] == END_OF_SEGMENT:
+        yield None, None
+
+class SegmentLog(object):
+    """
+    Writing side of the log. appendRecords and appendMessage can be called from any thread.
+    Opening the log recovers the segments left by the previous run (recoveryTimeInSec).
+    """
+    def __init__(self, directory, segmentSize=DEFAULT_SEGMENT_SIZE, maxSegments=DEFAULT_MAX_SEGMENTS, syncIntervalInSec=DEFAULT_SYNC_INTERVAL_IN_SEC,
+                 syncBytes=DEFAULT_SYNC_BYTES, entryBytes=DEFAULT_ENTRY_BYTES):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.maxSegments = max(2, maxSegments)
+        self.syncIntervalInSec = syncIntervalInSec
+        self.syncBytes = syncBytes
+        self.entryBytes = entryBytes
+        self.lock = threading.Lock()
+        self.newData = threading.Event() # set on every append, for the forwarder
+        self.file = None
+        self.map = None
+        self.bytesAppended = 0
+        self.syncCount = 0
+        self.droppedSegments = 0
+        self.forwardingSegment = None # segment the forwarder is reading, never dropped
+
+        os.makedirs(directory, exist_ok=True)
+        startTime = time.perf_counter()
+        self.segmentNumbers = listSegments(directory)
+        self.recoveredBytes, self.cutBytes = self.recover()
+        self.recoveryTimeInSec = time.perf_counter() - startTime
+        self.openSegment(self.segmentNumbers[-1] + 1 if self.segmentNumbers else 0)
+
+    def recover(self):
+        """ Close the last segment of the previous run at the end of its valid entries. Returns (valid bytes, bytes cut). """
+        if not self.segmentNumbers:
+            return 0, 0
+        number = self.segmentNumbers[-1]
+        fileName = segmentFileName(self.directory, number)
+        size = os.path.getsize(fileName)
+        if size < len(SEGMENT_MAGIC) + END_MARKER.size:
+            # Crash while the segment was being created
+            os.remove(fileName)
+            self.segmentNumbers.remove(number)
+            return 0, size
+        with open(fileName, "r+b") as f:
+            with mmap.mmap(f.fileno(), size) as data:
+                offset = len(SEGMENT_MAGIC)
+                for payloadStart, payloadEnd in iterEntries(data, offset, size):
+                    if payloadStart is None:
+                        return offset, 0 # closed by the rollover
+                    offset = payloadEnd
+                # Everything after the last valid entry is cut: the end marker replaces the first torn header
+                cutBytes = len(data[offset:size].rstrip(b"\x00"))
+                if offset + END_MARKER.size <= size:
+                    END_MARKER.pack_into(data, offset, END_OF_SEGMENT)
+                    data.flush()
+                return offset, cutBytes
+
+    def openSegment(self, number):
+        fileName = segmentFileName(self.directory, number)
+        self.file = open(fileName, "w+b")
+        self.file.truncate(self.segmentSize)
+        self.map = mmap.mmap(self.file.fileno(), self.segmentSize)
+        self.map[0:len(SEGMENT_MAGIC)] = SEGMENT_MAGIC
+        self.segmentNumber = number
+        self.writeOffset = len(SEGMENT_MAGIC)
+        self.syncedOffset = 0
+        self.lastSyncTime = time.monotonic()
+        self.encoder = BinaryRecordEncoder()
+        self.segmentNumbers.append(number)
+        self.dropOldSegments()
+
+    def dropOldSegments(self):
+        """ Ring: beyond maxSegments the oldest segments are deleted, even if they were not forwarded. """
+        while len(self.segmentNumbers) > self.maxSegments:
+            number = self.segmentNumbers[0]
+            if number == self.forwardingSegment:
+                number = self.segmentNumbers[1]
+            try:
+                os.remove(segmentFileName(self.directory, number))
+            except OSError as e:
+                logger.warning("Segment %s not dropped: %s", number, e)
+                return
+            self.segmentNumbers.remove(number)
+            self.droppedSegments += 1
+            DROPPED_SEGMENTS.inc()
+            logger.warning("Store and forward log full, segment %s dropped before being forwarded", number)
+
+    def roomLeft(self):
+        """ Largest payload which still fits in the current segment, with its header and the end marker after it. """
+        return self.segmentSize - self.writeOffset - ENTRY_HEADER.size - END_MARKER.size
+
+    def rollOver(self):
+        END_MARKER.pack_into(self.map, self.writeOffset, END_OF_SEGMENT)
+        self.writeOffset += END_MARKER.size
+        self.sync()
+        self.map.close()
+        self.file.close()
+        self.openSegment(self.segmentNumber + 1)
+
+    def writeEntry(self, payload):
+        offset = self.writeOffset
+        payloadStart = offset + ENTRY_HEADER.size
+        self.map[payloadStart:payloadStart + len(payload)] = payload
+        ENTRY_HEADER.pack_into(self.map, offset, len(payload), zlib.crc32(payload)) # last: the entry is complete
+        self.writeOffset = payloadStart + len(payload)
+        self.bytesAppended += self.writeOffset - offset
+        APPENDED_BYTES.inc(self.writeOffset - offset)
+
+    def appendRecords(self, records):
+        """ Encode the records in entries of up to entryBytes, rolling over to the next segment when one is full. """
+        with self.lock:
+            self.appendEncoded(records)
+            self.syncIfDue()
+        self.newData.set()
+
+    def appendEncoded(self, records):
+        encodeRecord = self.encoder.encodeRecord
+        encoded = [encodeRecord(record) for record in records]
+        payload = b"".join(encoded)
+        if len(payload) <= self.entryBytes and len(payload) <= self.roomLeft():
+            self.writeEntry(payload) # the usual case: the batch is one entry
+            return
+        parts = []
+        size = 0
+        for i, entry in enumerate(encoded):
+            if size + len(entry) > self.roomLeft():
+                if parts:
+                    self.writeEntry(b"".join(parts))
+                    parts = []
+                    size = 0
+                if len(entry) > self.roomLeft():
+                    if self.writeOffset == len(SEGMENT_MAGIC):
+                        raise ValueError("Record larger than a segment of the store and forward log")
+                    self.rollOver()
+                    # The rest is encoded again, with the tag table of the new segment
+                    return self.appendEncoded(records[i:])
+            parts.append(entry)
+            size += len(entry)
+            if size >= self.entryBytes:
+                self.writeEntry(b"".join(parts))
+                parts = []
+                size = 0
+        if parts:
+            self.writeEntry(b"".join(parts))
+
+    def appendMessage(self, message):
+        with self.lock:
+            encoded = self.encoder.encodeMessage(message)
+            if len(encoded) > self.roomLeft():
+                self.rollOver()
+                if len(encoded) > self.roomLeft():
+                    raise ValueError("Message larger than a segment of the store and forward log")
+            self.writeEntry(encoded)
+        self.newData.set()
+
+    def syncIfDue(self):
+        if self.writeOffset - self.syncedOffset >= self.syncBytes or time.monotonic() - self.lastSyncTime >= self.syncIntervalInSec:
+            self.sync()
+
+    def sync(self):
+        """ Flush the pages written since the last sync (msync on the mapped file). """
+        if self.writeOffset > self.syncedOffset:
+            start = self.syncedOffset - self.syncedOffset % mmap.ALLOCATIONGRANULARITY
+            with SYNC_TIME.time():
+                self.map.flush(start, self.writeOffset - start)
+            self.syncedOffset = self.writeOffset
+            self.syncCount += 1
+        self.lastSyncTime = time.monotonic()
+
+    def flush(self, force=False):
+        """ Sync the pages written when a sync is due, or right away with force (ex: before a shutdown). """
+        with self.lock:
+            if force:
+                self.sync()
+            else:
+                self.syncIfDue()
+
+    def setForwardingSegment(self, number):
+        """ Called by the forwarder: the segment it reads is never dropped by dropOldSegments. """
+        with self.lock:
+            self.forwardingSegment = number
+
+    def getReadableEnd(self, number):
+        """ End of the data the forwarder can read in segment number: all of it once the segment is closed. """
+        with self.lock:
+            if number == self.segmentNumber:
+                return self.writeOffset
+            return self.segmentSize
+
+    def getSegmentNumbers(self):
+        with self.lock:
+            return list(self.segmentNumbers)
+
+    def removeSegment(self, number):
+        """ Called by the forwarder once the segment has been forwarded. """
+        with self.lock:
+            if number == self.segmentNumber or number not in self.segmentNumbers:
+                return
+            try:
+                os.remove(segmentFileName(self.directory, number))
+            except OSError as e:
+                logger.warning("Forwarded segment %s not deleted: %s", number, e)
+                return
+            self.segmentNumbers.remove(number)
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.sync()
+                self.map.close()
+                self.file.close()
+                self.map = None
+
+class Forwarder(threading.Thread):
+    """
+    Sends the records of the log to sink (a ResultWriter) in batches of up to batchRecords records.
+    A batch is only acknowledged (position saved) once sink.writeRecords and sink.flush succeeded,
+    a failing sink gets the same batch again after retryDelayInSec (doubled up to maxRetryDelayInSec).
+    """
+    READ_BYTES = 4 * 1024 * 1024 # Bytes read from a segment in one go
+    IDLE_WAIT_IN_SEC = 0.1
+
+    def __init__(self, log, sink, batchRecords=DEFAULT_FORWARD_BATCH_RECORDS, retryDelayInSec=1, maxRetryDelayInSec=30):
+        threading.Thread.__init__(self, name="StoreForwardForwarder", daemon=True)
+        self.log = log
+        self.sink = sink
+        self.batchRecords = batchRecords
+        self.retryDelayInSec = retryDelayInSec
+        self.maxRetryDelayInSec = maxRetryDelayInSec
+        self.positionFile = os.path.join(log.directory, POSITION_FILE)
+        self.stopEvent = threading.Event()
+        self.drainEvent = threading.Event() # stop once the log is empty
+        self.segmentNumber, self.offset = self.loadPosition()
+        self.tagids = None # tag table of the segment being read, rebuilt from its start when needed
+        self.forwardedRecords = 0
+        self.forwardedBatches = 0
+        self.sinkErrors = 0
+        self.lostSegments = 0
+        LAG_BYTES.setFunction(self.getLagBytes)
+
+    def loadPosition(self):
+        try:
+            with open(self.positionFile, "r") as f:
+                position = json.load(f)
+            return position['segment'], position['offset']
+        except (OSError, ValueError, KeyError):
+            return None, len(SEGMENT_MAGIC)
+
+    def savePosition(self):
+        with open(self.positionFile + ".tmp", "w") as f:
+            json.dump({"segment": self.segmentNumber, "offset": self.offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.positionFile + ".tmp", self.positionFile)
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            self.log.newData.clear()
+            try:
+                moved = self.forwardSome()
+            except Exception as e:
+                logger.error("Forwarder error: %s", e)
+                moved = False
+            if not moved:
+                if self.drainEvent.is_set() and self.isDrained():
+                    return
+                self.log.newData.wait(self.IDLE_WAIT_IN_SEC)
+
+    def forwardSome(self):
+        """ Forward the next batch. Returns False when there was nothing to forward. """
+        segmentNumbers = self.log.getSegmentNumbers()
+        if self.segmentNumber not in segmentNumbers:
+            later = [number for number in segmentNumbers if self.segmentNumber is None or number > self.segmentNumber]
+            if not later:
+                return False
+            if self.segmentNumber is not None:
+                # The next segment always exists before one is closed: a missing segment was dropped by the ring
+                self.lostSegments += later[0] - self.segmentNumber
+                logger.warning("Segments %s to %s were dropped before being forwarded", self.segmentNumber, later[0] - 1)
+            self.segmentNumber, self.offset, self.tagids = later[0], len(SEGMENT_MAGIC), []
+        self.log.setForwardingSegment(self.segmentNumber)
+
+        fileName = segmentFileName(self.log.directory, self.segmentNumber)
+        end = self.log.getReadableEnd(self.segmentNumber)
+        if self.tagids is None:
+            self.tagids = self.readTagTable(fileName, self.offset)
+        with open(fileName, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(min(end - self.offset, self.READ_BYTES))
+
+        items = []
+        consumed = 0
+        segmentClosed = False
+        for payloadStart, payloadEnd in iterEntries(data, 0, len(data)):
+            if payloadStart is None:
+                segmentClosed = True
+                break
+            items.extend(iterBinaryEntries(data, payloadStart, payloadEnd, self.tagids))
+            consumed = payloadEnd
+            if len(items) >= self.batchRecords:
+                break
+        if consumed == 0 and not segmentClosed:
+            if len(data) >= self.READ_BYTES:
+                raise ValueError("Entry larger than Forwarder.READ_BYTES in segment " + str(self.segmentNumber))
+            if end < self.log.segmentSize:
+                return False # nothing new in the segment being written
+            # Closed segment with no valid entry nor end marker at this offset (damaged file): skip the rest of it
+            logger.error("Segment %s unreadable after offset %s, rest of the segment skipped", self.segmentNumber, self.offset)
+            segmentClosed = True
+
+        if items:
+            self.deliver(items)
+        self.offset += consumed
+        if segmentClosed:
+            finished = self.segmentNumber
+            self.segmentNumber, self.offset, self.tagids = finished + 1, len(SEGMENT_MAGIC), []
+            self.savePosition()
+            self.log.removeSegment(finished)
+        elif items:
+            self.savePosition()
+        return True
+
+    def readTagTable(self, fileName, offset):
+        """ Tags of the entries before offset (the forwarder starts in the middle of a segment after a restart). """
+        tagids = []
+        with open(fileName, "rb") as f:
+            data = f.read(offset)
+        for payloadStart, payloadEnd in iterEntries(data, len(SEGMENT_MAGIC), len(data)):
+            if payloadStart is None:
+                break
+            for item in iterBinaryEntries(data, payloadStart, payloadEnd, tagids):
+                pass
+        return tagids
+
+    def deliver(self, items):
+        """ Write the items (records and messages, in order) to the sink, until it accepts them or the forwarder is stopped. """
+        delayInSec = self.retryDelayInSec
+        while True:
+            try:
+                records = []
+                for item in items:
+                    if isinstance(item, str):
+                        self.sink.writeRecords(records)
+                        records = []
+                        self.sink.writeMessage(item)
+                    else:
+                        records.append(item)
+                self.sink.writeRecords(records)
+                self.sink.flush()
+                break
+            except Exception as e:
+                self.sinkErrors += 1
+                SINK_ERRORS.inc()
+                logger.warning("Sink did not accept the batch, next attempt in %s sec: %s", delayInSec, e)
+                if self.stopEvent.wait(delayInSec):
+                    raise
+                delayInSec = min(delayInSec * 2, self.maxRetryDelayInSec)
+        recordCount = sum(1 for item in items if not isinstance(item, str))
+        self.forwardedRecords += recordCount
+        self.forwardedBatches += 1
+        FORWARDED_RECORDS.inc(recordCount)
+
+    def isDrained(self):
+        return self.segmentNumber == self.log.segmentNumber and self.offset >= self.log.getReadableEnd(self.segmentNumber)
+
+    def getLagBytes(self):
+        """ Bytes appended and not forwarded yet (whole segments counted at their size). """
+        if self.segmentNumber is None:
+            return self.log.writeOffset
+        pendingSegments = [number for number in self.log.getSegmentNumbers() if self.segmentNumber <= number < self.log.segmentNumber]
+        return len(pendingSegments) * self.log.segmentSize - self.offset + self.log.writeOffset
+
+    def stop(self, drainTimeoutInSec=0):
+        """ Stop, after forwarding everything already in the log when drainTimeoutInSec > 0 (and the sink accepts it). """
+        if drainTimeoutInSec > 0:
+            self.drainEvent.set()
+            self.log.newData.set()
+            self.join(drainTimeoutInSec)
+            if self.is_alive():
+                logger.warning("Store and forward log not drained after %s sec, %s bytes left in %s (forwarded at the next start)",
+                               drainTimeoutInSec, self.getLagBytes(), self.log.directory)
+        self.stopEvent.set()
+        self.join()
+
+    def getStatistics(self):
+        d = dict()
+        d['forwardedRecords'] = self.forwardedRecords
+        d['forwardedBatches'] = self.forwardedBatches
+        d['sinkErrors'] = self.sinkErrors
+        d['lagBytes'] = self.getLagBytes()
+        d['lostSegments'] = self.lostSegments
+        return d
+
+class StoreForwardWriter(ResultWriter):
+    """
+    ResultWriter which stores the records in a SegmentLog and forwards them to sink (another ResultWriter).
+    Drop-in replacement of the sink for the readers: wrap the writer returned by createResultWriter.
+    """
+    def __init__(self, directory, sink, drainTimeoutInSec=DEFAULT_DRAIN_TIMEOUT_IN_SEC, **logOptions):
+        ResultWriter.__init__(self, sink.fileName)
+        self.sink = sink
+        self.drainTimeoutInSec = drainTimeoutInSec
+        self.log = SegmentLog(directory, **logOptions)
+        self.forwarder = Forwarder(self.log, sink)
+        self.forwarder.start()
+
+    def writeRecord(self, record):
+        self.writeRecords([record])
+
+    def writeRecords(self, records):
+        self.log.appendRecords(records)
+        self.recordsWritten += len(records)
+
+    def writeMessage(self, message):
+        self.log.appendMessage(message)
+
+    def flush(self):
+        self.log.flush()
+
+    def close(self):
+        self.log.flush(force=True)
+        self.log.close()
+        self.forwarder.stop(self.drainTimeoutInSec)
+        self.sink.close()
+
+    @property
+    def bytesWritten(self):
+        return self.log.bytesAppended
+
+    def getStatistics(self):
+        d = self.forwarder.getStatistics()
+        d['appendedBytes'] = self.log.bytesAppended
+        d['syncs'] = self.log.syncCount
+        d['droppedSegments'] = self.log.droppedSegments
+        d['recoveryTimeInSec'] = round(self.log.recoveryTimeInSec, 3)
+        return d
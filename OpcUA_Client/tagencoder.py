@@ -0,0 +1,120 @@
+from collections import namedtuple
+from opcua import ua
+import metrics
+
+# Encoder shared by every reader: DataValue (read or notified by the server) -> ScanRecord,
+# and ScanRecord -> line of the text output.
+# The hot path has no try/except: a bad value is recognised by the severity bits of its
+# StatusCode, the Variant type goes through a table built once, and the text line of a tag
+# starts with a prefix (tagid and browse name) built the first time the tag is written.
+# StatusCode texts are computed once per code.
+# Compare with the original formatting: python bench_encoder.py [NumberOfRows]
+
+ScanRecord = namedtuple("ScanRecord", ["tagid", "browseName", "value", "variantType", "statusCode", "sourceTimestamp", "errorMessage"])
+
+GOOD = ua.StatusCodes.Good
+NULL_TYPE = ua.VariantType.Null.value
+SEVERITY_MASK = 0xC0000000 # The two most significant bits give the severity: 00 Good, 01 Uncertain, 10 Bad
+SEVERITY_BAD = 0x80000000
+
+VARIANT_TYPE_NUMBERS = dict((variantType, variantType.value) for variantType in ua.VariantType)
+VARIANT_TYPE_NAMES = dict((variantType.value, str(variantType)) for variantType in ua.VariantType)
+
+RECORDS_FORMATTED = metrics.counter("records_formatted_total", "DataValues formatted into records")
+
+_newRecord = tuple.__new__ # ScanRecord without the keyword handling of its __new__
+
+def isGoodStatusCode(statusCode):
+    return statusCode & SEVERITY_MASK == 0
+
+def isBadStatusCode(statusCode):
+    return statusCode & SEVERITY_MASK == SEVERITY_BAD
+
+def tagidOf(node):
+    return str(node.nodeid.Identifier)
+
+def encodeChunk(nodes, dataValues, tagids=None):
+    """
+    ScanRecords of a chunk, dataValues[i] being the DataValue of nodes[i].
+    tagids (optional) are the precomputed tagids of the nodes, for the callers reading the same nodes again and again.
+    """
+    if tagids is None:
+        tagids = [str(node.nodeid.Identifier) for node in nodes]
+    records = []
+    append = records.append
+    for tagid, dataValue in zip(tagids, dataValues):
+        statusCode = dataValue.StatusCode
+        code = GOOD if statusCode is None else statusCode.value
+        variant = dataValue.Value
+        if variant is None or code & SEVERITY_MASK == SEVERITY_BAD:
+            append(_newRecord(ScanRecord, (tagid, "", None, NULL_TYPE, code, dataValue.SourceTimestamp, "")))
+        else:
+            append(_newRecord(ScanRecord, (tagid, "", variant.Value, VARIANT_TYPE_NUMBERS[variant.VariantType], code, dataValue.SourceTimestamp, "")))
+    RECORDS_FORMATTED.inc(len(records))
+    if metrics.isDebugPrintEnabled():
+        for record in records:
+            metrics.debugPrint("ReadNodeValues \n", record)
+    return records
+
+def recordFromDataValue(node, dataValue, browseName=""):
+    """ ScanRecord of a single node, built by encodeChunk. A bad value has no value (Null), whatever the server sent. """
+    record = encodeChunk([node], [dataValue])[0]
+    return record._replace(browseName=browseName) if browseName else record
+
+def escapeText(value):
+    return value.replace(",", ";") if "," in value else value
+
+# Text of the common scalar values, any other type goes through str() and the comma escaping
+VALUE_FORMATTERS = {float: float.__repr__, int: int.__repr__, bool: bool.__repr__, str: escapeText, type(None): lambda value: "None"}
+
+class TextRowEncoder(object):
+    """
+    ScanRecord -> line of the text output (",\t" separated columns, commas in the values replaced by ";").
+    The lines are the same as the ones of the text output before the encoder.
+    """
+    def __init__(self, gettagsLayout=False):
+        self.gettagsLayout = gettagsLayout
+        self.prefixes = dict()     # tagid -> start of its lines
+        self.statusTexts = dict()  # StatusCode value -> text
+
+    def getPrefix(self, record):
+        if self.gettagsLayout:
+            # Layout of gettags.py: the tag from the file (the tagid of its records), the Identifier of its NodeId and its BrowseName
+            try:
+                identifier = str(ua.NodeId.from_string(record.tagid).Identifier)
+            except Exception:
+                identifier = record.tagid
+            prefix = record.tagid + " ,\t " + identifier + " ,\t " + record.browseName + " ,\t "
+        else:
+            prefix = record.tagid + " ,\t "
+        self.prefixes[record.tagid] = prefix
+        return prefix
+
+    def getStatusText(self, statusCode):
+        text = str(ua.StatusCode(statusCode))
+        self.statusTexts[statusCode] = text
+        return text
+
+    def encode(self, record):
+        prefix = self.prefixes.get(record.tagid)
+        if prefix is None:
+            prefix = self.getPrefix(record)
+        value = record.value
+        formatter = VALUE_FORMATTERS.get(type(value))
+        value = formatter(value) if formatter is not None else str(value).replace(",", ";")
+        statusText = self.statusTexts.get(record.statusCode)
+        if statusText is None:
+            statusText = self.getStatusText(record.statusCode)
+        errorMessage = record.errorMessage
+        if record.sourceTimestamp is not None:
+            timestamp = record.sourceTimestamp.isoformat('T')+"Z"
+        else:
+            timestamp = ". Error message: no SourceTimestamp"
+            errorMessage = errorMessage + ",\t error trying to read the SourceTimestamp from the tag. "
+
+        # One join instead of a chain of concatenations, each of them copying the line again
+        if errorMessage:
+            return "".join((prefix, value, " ,\t ", statusText, " ,\t ", timestamp, ",\t Whole variant value: Variant(val:", value,
+                            ";type:", VARIANT_TYPE_NAMES[record.variantType], "),\t Error message: ", errorMessage, " .\n"))
+        return "".join((prefix, value, " ,\t ", statusText, " ,\t ", timestamp, ",\t Whole variant value: Variant(val:", value,
+                        ";type:", VARIANT_TYPE_NAMES[record.variantType], ") .\n"))
@@ -0,0 +1,122 @@
+import threading
+import queue
+
+from collections import OrderedDict
+from opcua import Node
+from opcua import ua
+
+# Streaming stages to go from a tag list file to the values of the tags without
+# holding the whole list in memory:
+#   iterTags -> iterNodes -> iterChunks -> (read chunk) -> prefetch -> write
+# Every stage is a generator, so at most one chunk per stage (plus the prefetch
+# buffer) is alive at any time, whatever the size of the tag list.
+
+class NodeIdCache(object):
+    """
+    Parsed NodeIds keyed by the raw tag string.
+    Duplicate tags and repeated scans of the same list skip NodeId.from_string.
+    The cache is an LRU limited to maxSize entries so it cannot grow with the list.
+    """
+    def __init__(self, maxSize=100000):
+        self.maxSize = maxSize
+        self.nodeIds = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tag):
+        nodeId = self.nodeIds.get(tag)
+        if nodeId is not None:
+            self.hits += 1
+            self.nodeIds.move_to_end(tag)
+            return nodeId
+
+        self.misses += 1
+        nodeId = ua.NodeId.from_string(tag)
+        self.nodeIds[tag] = nodeId
+        if len(self.nodeIds) > self.maxSize:
+            self.nodeIds.popitem(last=False)
+        return nodeId
+
+    def __len__(self):
+        return len(self.nodeIds)
+
+def iterTags(tagList):
+    """ Yield the stripped tags of an opened tag list file, skipping empty lines. """
+    for x in tagList:
+        tag = x.strip()
+        if tag:
+            yield tag
+
+def splitTagRate(line):
+    """ Split a tag list line "tag,<rate in sec>" into (tag, rate). Without a valid rate: (line, None). """
+    tag, separator, rate = line.rpartition(",")
+    if not separator:
+        return line, None
+    try:
+        rateInSec = float(rate)
+    except ValueError:
+        return line, None
+    if rateInSec <= 0:
+        return line, None
+    return tag.strip(), rateInSec
+
+def iterNodes(session, tags, nodeIdCache, onError=None):
+    """
+    Yield a Node for every tag. Tags which cannot be parsed are passed to onError(tag, exception).
+    """
+    for tag in tags:
+        try:
+            yield Node(session.uaclient, nodeIdCache.get(tag))
+        except Exception as e:
+            if onError is not None:
+                onError(tag, e)
+
+def iterChunks(items, chunkSize):
+    """ Group the items into lists of up to chunkSize items. """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunkSize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def prefetch(items, bufferSize):
+    """
+    Run the upstream generator in its own thread, keeping at most bufferSize items ready.
+    With it the next chunk is read from the server while the current one is being written.
+    Exceptions raised upstream are raised again in the consumer.
+    """
+    buffer = queue.Queue(maxsize=bufferSize)
+    endOfStream = object()
+    stopped = threading.Event()
+
+    def producer():
+        try:
+            for item in items:
+                while not stopped.is_set():
+                    try:
+                        buffer.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stopped.is_set():
+                    return
+        except Exception as e:
+            buffer.put((endOfStream, e))
+            return
+        buffer.put((endOfStream, None))
+
+    thread = threading.Thread(target=producer, name="TagStreamPrefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is endOfStream:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()